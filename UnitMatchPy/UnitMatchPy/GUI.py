@@ -1002,7 +1002,7 @@ def get_table_data(UnitA, UnitB, CV):
                 if i == 3:
                     table[i][j] = str( np.round(spatial_decay_avg[unit_idx_tmp[j]], 3))
                 if i == 4:
-                    table[i][j] = str(np.argwhere( (within_session*output_avg)[unit_idx_tmp[j],:] > match_threshold)).replace('[', '').replace(']', '')
+                    table[i][j] = str(np.argwhere( within_session[unit_idx_tmp[j],:] * output_avg[unit_idx_tmp[j],:] > match_threshold)).replace('[', '').replace(']', '')
                 if i ==5:
                     table[i][j] = str( np.round(output_GUI[0][unit_idx_tmp[j], unit_idx_tmp[j]], 3))
            
@@ -1020,7 +1020,7 @@ def get_table_data(UnitA, UnitB, CV):
                 if i == 3:
                     table[i][j] = str( np.round(spatial_decay[unit_idx_tmp[j],CV[j-1]], 3))
                 if i == 4:
-                    table[i][j] = str(np.argwhere( (within_session*output_GUI[CV[0]])[unit_idx_tmp[j],:] > match_threshold )).replace('[', '').replace(']', '')
+                    table[i][j] = str(np.argwhere( within_session[unit_idx_tmp[j],:] * output_GUI[CV[0]][unit_idx_tmp[j],:] > match_threshold )).replace('[', '').replace(']', '')
                 if i ==5:
                     table[i][j] = str( np.round(output_GUI[0][unit_idx_tmp[j], unit_idx_tmp[j]], 3))
                     
@@ -167,4 +167,75 @@ def assign_unique_id(output_prob_array, param, clus_info):
     print(f'Number of Intermediate Matches: {n_matches}')
     print(f'Number of Conservative Matches: {n_matches_conservative}')
 
-    return [unique_id_liberal, unique_id, unique_id_conservative, ori_unique_id]
\ No newline at end of file
+    return [unique_id_liberal, unique_id, unique_id_conservative, ori_unique_id]
+
+
+def append_unique_id(unique_ids, output_prob_array, n_old_units, param, clus_info):
+    """
+    Gives unique ids to units added after assign_unique_id() was run, see overlord.add_session(), without changing the
+    unique ids of the existing units. Each new unit joins the group of its best matching existing unit if:
+    Conservative - it matches EVERY unit in the group
+    Intermediate - it matches EVERY unit of the group in the previous session
+    Liberal - it matches any unit in the group
+    otherwise it starts a new group.
+
+    Parameters
+    ----------
+    unique_ids : list
+        The unique ids of the existing units, from assign_unique_id()
+    output_prob_array : ndarray (n_units, n_units)
+        The 2d probability matrix of all of the units, where the new units are last
+    n_old_units : int
+        The number of existing units
+    param : dict
+        The param dictionary
+    clus_info : dict
+        The clus_info dictionary, including the new units
+
+    Returns
+    -------
+    List
+        A list of arrays which gives each unit its group ID for each case
+    """
+    n_units = output_prob_array.shape[0]
+    session_id = clus_info['session_id']
+    threshold = param['match_threshold']
+
+    #a match needs both CV to agree, the best match has the highest mean probability
+    prob_new_old = output_prob_array[n_old_units:, :n_old_units]
+    prob_old_new = output_prob_array[:n_old_units, n_old_units:].T
+    is_match = (prob_new_old > threshold) * (prob_old_new > threshold)
+    prob_mean = (prob_new_old + prob_old_new) / 2
+
+    unique_id_liberal, unique_id, unique_id_conservative, ori_unique_id = [np.append(ids, np.arange(n_old_units, n_units)) for ids in unique_ids]
+
+    n_matches_conservative = 0
+    n_matches_liberal = 0
+    n_matches = 0
+    for i, unit in enumerate(range(n_old_units, n_units)):
+        if np.any(is_match[i]) == False:
+            continue
+        best = np.argmax(np.where(is_match[i], prob_mean[i], -np.inf))
+
+        ## Liberal Matches
+        unique_id_liberal[unit] = unique_id_liberal[best]
+        n_matches_liberal += 1
+
+        ## Intermediate Matches, only the units in the previous session are checked
+        group = np.flatnonzero(unique_id[:n_old_units] == unique_id[best])
+        group = group[session_id[group] == session_id[unit] - 1]
+        if np.all(is_match[i, group]):
+            unique_id[unit] = unique_id[best]
+            n_matches += 1
+
+        ## Conservative Matches
+        group = np.flatnonzero(unique_id_conservative[:n_old_units] == unique_id_conservative[best])
+        if np.all(is_match[i, group]):
+            unique_id_conservative[unit] = unique_id_conservative[best]
+            n_matches_conservative += 1
+
+    print(f'Number of new Liberal Matches: {n_matches_liberal}')
+    print(f'Number of new Intermediate Matches: {n_matches}')
+    print(f'Number of new Conservative Matches: {n_matches_conservative}')
+
+    return [unique_id_liberal, unique_id, unique_id_conservative, ori_unique_id]
@@ -1,5 +1,8 @@
 import numpy as np
+from scipy.sparse import issparse
 import UnitMatchPy.param_functions as pf
+import UnitMatchPy.metric_functions as mf
+import UnitMatchPy.utils as util
 
 def get_parameter_kernels(scores_to_include, labels, cond, param, add_one = 1):
     """
@@ -7,13 +10,14 @@ def get_parameter_kernels(scores_to_include, labels, cond, param, add_one = 1):
     Smoothing and add one is done to try and compensate for the fact the histogram used as a prediction for the 
     probability distribution has few values, therefore this smoothing hopes to make it more similar to the true distribution
     by smoothing nearby peaks and trough to reduce shot noise.
+    With param['sparse_scores'] only the scored pairs are counted, weighted by param['pair_weights'].
 
     Parameters
     ----------
     scores_to_include : dict
         Keys are the metrics used, the values are (n_unit, n_unit) arrays containing the scores for that metric
     labels : ndarray (n_unit, n_unit)
-        whether  that unit is a candidate pair or not
+        whether  that unit is a candidate pair or not, e.g the bool candidate_pairs array, sparse if the scores are sparse
     cond : ndarray
         The unique value of labels array
     param : dict
@@ -33,16 +37,21 @@ def get_parameter_kernels(scores_to_include, labels, cond, param, add_one = 1):
 
     parameter_kernels = np.full((len(score_vector), len(scores_to_include), len(cond)), np.nan)
 
+    #sparse scores and labels store the same scored pairs in the same order, see param['sparse_scores']
+    weights = param.get('pair_weights') if issparse(labels) else None
+    labels = mf.get_pair_values(labels)
+
     score_id = 0
     for sc in scores_to_include:
-        scores_tmp = scores_to_include[sc]
+        scores_tmp = mf.get_pair_values(scores_to_include[sc])
 
         smooth_tmp = smooth_prob # Not doing the different ones for now (default the same)
 
+        #the histogram of every label at once
+        hist = mf.get_histograms(mf.get_bin_idx(scores_tmp, bins), labels, len(cond), len(bins) - 1, weights)
 
         for ck in range(len(cond)):           
-            hist_tmp , __ = np.histogram(scores_tmp[labels == ck], bins)
-            parameter_kernels[:,score_id, ck] = pf.smooth(hist_tmp, smooth_tmp)
+            parameter_kernels[:,score_id, ck] = pf.smooth(hist[ck], smooth_tmp)
             parameter_kernels[:,score_id, ck] /= np.sum(parameter_kernels[:,score_id,ck])
             parameter_kernels[:,score_id, ck] += add_one* np.min(parameter_kernels[parameter_kernels[:,score_id, ck] !=0, score_id, ck], axis = 0)
 
@@ -62,7 +71,8 @@ def apply_naive_bayes(parameter_kernels, priors, predictors, param, cond):
     priors : ndarray 
         The prior probability a pair is a match or not
     predictors : ndarray (n_units, n_units, n_metrics)
-        The combined array of all of the metrics for all of the units
+        The combined array of all of the metrics for all of the units, or for a (n_rows, n_cols) block of pairs, 
+        or the sparse (n_units**2, n_metrics) predictors of the scored pairs, see param['sparse_scores']
     param : dict
         The param dictionary
     cond : ndarray
@@ -71,29 +81,46 @@ def apply_naive_bayes(parameter_kernels, priors, predictors, param, cond):
     Returns
     -------
     ndarray
-        The probability the unit is or is not a match
+        The probability the unit is or is not a match, with sparse predictors pairs which were not scored have a match probability of 0
     """
     print('Calculating the match probabilities')
-    
-    score_vector = param['score_vector']
-    n_pairs = predictors.shape[0] ** 2
-
-    unravel = np.reshape(predictors , (predictors.shape[0] * predictors.shape[1], predictors.shape[2],1))
-    x1 = np.tile(unravel, ( 1, 1, len(score_vector)))
-    tmp = np.expand_dims(score_vector, axis = (0,1))
-    x2 = np.tile(tmp, (x1.shape[0], x1.shape[1], 1))
-    min_idx = np.argmin( np.abs(x1 - x2), axis = 2)
-
-    likelihood = np.full((n_pairs, len(cond)), np.nan)
+    dtype = param.get('dtype', 'float64')
+    score_vector = param['score_vector'].astype(dtype)
+
+    if issparse(predictors):
+        #only the scored pairs are stored, with every metric of a pair stored one after the other
+        n_all_pairs, n_scores = predictors.shape
+        predictors = predictors.tocoo()
+        pair_idx = predictors.row[::n_scores]
+        unravel = predictors.data.astype(dtype, copy = False).reshape(-1, n_scores)
+    else:
+        unravel = np.reshape(predictors.astype(dtype, copy = False) , (predictors.shape[0] * predictors.shape[1], predictors.shape[2]))
+    n_pairs = unravel.shape[0]
+    memory_limit = util.plan_memory('apply_naive_bayes', param, n_scores = unravel.shape[1], n_pairs = n_pairs)
+
+    #find the nearest score bin, for chunks of pairs so the distance to every bin fits in param['memory_limit']
+    min_idx = np.zeros(unravel.shape, dtype = np.int64)
+    chunk = max(int(memory_limit // (2 * unravel.shape[1] * len(score_vector) * unravel.itemsize)), 1)
+    for start in range(0, n_pairs, chunk):
+        min_idx[start:start + chunk] = np.argmin( np.abs(unravel[start:start + chunk,:,np.newaxis] - score_vector), axis = 2)
+    min_idx[np.isnan(unravel)] = 0 # pairs which were not scored are given the lowest score
+
+    likelihood = np.full((n_pairs, len(cond)), np.nan, dtype = dtype)
     for ck in range(len(cond)):
-        tmp_prob = np.zeros_like(min_idx, np.float64)
+        tmp_prob = np.zeros_like(min_idx, dtype)
         for yy in range(min_idx.shape[1]):
             tmp_prob[:,yy] = parameter_kernels[min_idx[:,yy],yy,ck]
         likelihood[:,ck] = np.prod(tmp_prob, axis=1)
 
 
-    prob = np.full((n_pairs,2), np.nan )
+    prob = np.full((n_pairs,2), np.nan, dtype = dtype)
     for ck in range(len(cond)):
         prob[:,ck] = priors[ck] * likelihood[:,ck] / np.nansum((priors * likelihood), axis =1)
+
+    if issparse(predictors):
+        scored_prob = prob
+        prob = np.zeros((n_all_pairs, 2), dtype = dtype)
+        prob[:,0] = 1
+        prob[pair_idx] = scored_prob
     
     return prob
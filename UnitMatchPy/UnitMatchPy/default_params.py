@@ -25,7 +25,21 @@ def get_default_param(param = None):
             'min_angle_dist' : 0.1, # smallest distance for and angle to be consider
             'min_new_shank_distance' : 100, #The smallest distance which separates 2 shanks
             'units_per_shank_thrs' : 15, # threshold for doing per shank drift correction
-            'match_threshold' : 0.5 # probability threshold to consider as a match
+            'match_threshold' : 0.5, # probability threshold to consider as a match
+            'n_jobs' : 1, # number of worker processes for extract_parameters and threads for extract_metric_scores, -1 uses all cores
+            'block_size' : 100, # number of units given to each worker at a time when n_jobs != 1
+            'cache_dirs' : None, # a directory per session to cache extracted parameters in, see utils.get_cache_dirs
+            'stage_cache_dir' : None, # a directory to cache the outputs of extract_parameters and extract_metric_scores in, see utils.get_stage_cache_key
+            'dtype' : 'float64', # float type used for waveforms and scores, 'float32' halves the memory used
+            'memory_limit' : 2e9, # max size in bytes of the temporary arrays made when comparing blocks of units
+            'sparse_scores' : False, # only calculate the scores for pairs of units with centroids closer than candidate_dist, and a sample of the other pairs
+            'candidate_dist' : 200, # must be larger than max_dist, to allow for drift
+            'sparse_sample_pairs' : 1000000, # the number of other pairs scored with sparse_scores to find the score statistics, all pairs are used if there are fewer, see metric_functions.get_sample_pairs
+            'quantile_sketch' : False, # estimate quantiles from a histogram instead of sorting, for very large numbers of units
+            'max_memory' : None, # the memory in bytes each stage must fit in, None uses the machine's memory, see utils.plan_memory
+            'session_window' : None, # only match sessions at most this many sessions apart, None matches all sessions, see overlord.get_windowed_probability
+            'anchor_sessions' : [], # sessions matched to every other session when using session_window
+            'partition_shanks' : False # match the units on each shank separately, if the shanks are further apart than max_dist, see overlord.get_partitioned_probability
         }
     
     tmp['score_vector'] = np.arange(tmp['stepsz']/2 ,1 ,tmp['stepsz'])
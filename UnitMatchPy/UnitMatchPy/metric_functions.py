@@ -1,7 +1,124 @@
 import numpy as np
 import UnitMatchPy.param_functions as pf
+import UnitMatchPy.utils as util
 
-def re_scale(vector):
+def get_quantiles(vector, quantiles, param = None):
+    """
+    Finds several quantiles of an array ignoring NaN values, where all of the quantiles are found in one selection pass.
+    If param['quantile_sketch'] is True, the quantiles are instead estimated from a histogram, see sketch_quantiles().
+    If param['pair_weights'] is given for an array of the same size, each value is counted with its weight, 
+    e.g for a sample of the pairs of units, see get_sample_pairs() and weighted_quantiles().
+
+    Parameters
+    ----------
+    vector : ndarray
+        A array of scores
+    quantiles : list
+        The quantiles to find, between 0 and 1
+    param : dict, optional
+        The param dictionary, by default None
+
+    Returns
+    -------
+    ndarray
+        The value of each quantile
+    """
+    weights = param.get('pair_weights') if param is not None else None
+    if weights is not None and np.size(weights) != np.size(vector):
+        weights = None
+
+    if param is not None and param.get('quantile_sketch', False):
+        return sketch_quantiles(vector, quantiles, param, weights = weights)
+
+    is_value = ~np.isnan(vector)
+    values = vector[is_value]
+    if values.size == 0:
+        return np.full(len(quantiles), np.nan)
+    if weights is not None:
+        return weighted_quantiles(values, np.reshape(weights, vector.shape)[is_value], quantiles)
+    return np.quantile(values, quantiles)
+
+def weighted_quantiles(values, weights, quantiles):
+    """
+    Finds quantiles of an array where each value is counted weight times, using the same linear interpolation between 
+    the sorted values as np.quantile, so is the same as np.quantile when every weight is 1.
+
+    Parameters
+    ----------
+    values : ndarray
+        A (n) array of values, without NaN
+    weights : ndarray
+        The (n) weight of each value
+    quantiles : list
+        The quantiles to find, between 0 and 1
+
+    Returns
+    -------
+    ndarray
+        The value of each quantile
+    """
+    order = np.argsort(values, kind = 'stable')
+    values = values[order]
+    cum_weights = np.cumsum(weights[order])
+
+    position = np.asarray(quantiles) * (cum_weights[-1] - 1)
+    low = np.floor(position)
+    idx_low = np.minimum(np.searchsorted(cum_weights, low, side = 'right'), len(values) - 1)
+    idx_high = np.minimum(np.searchsorted(cum_weights, low + 1, side = 'right'), len(values) - 1)
+    return values[idx_low] + (position - low) * (values[idx_high] - values[idx_low])
+
+def sketch_quantiles(vector, quantiles, param, n_bins = 2**16, weights = None):
+    """
+    Estimates quantiles of an array ignoring NaN values without sorting, by counting the values in n_bins equal bins
+    between the smallest and largest finite value. The array is read in chunks which fit in param['memory_limit'],
+    and each quantile is within one bin width, (max - min) / n_bins, of the exact value.
+    Infinite values are counted in the first or last bin.
+
+    Parameters
+    ----------
+    vector : ndarray
+        A array of scores
+    quantiles : list
+        The quantiles to find, between 0 and 1
+    param : dict
+        The param dictionary
+    n_bins : int, optional
+        The number of histogram bins, by default 2**16
+    weights : ndarray, optional
+        The weight each value is counted with, by default None
+
+    Returns
+    -------
+    ndarray
+        The estimated value of each quantile
+    """
+    values = vector.reshape(-1)
+    if weights is not None:
+        weights = np.reshape(weights, -1)
+    finite = np.isfinite(values)
+    if not np.any(finite):
+        return np.full(len(quantiles), np.nan)
+    low, high = np.min(values[finite]), np.max(values[finite])
+    bin_width = (high - low) / n_bins if high > low else 1
+
+    counts = np.zeros(n_bins, dtype = np.int64 if weights is None else np.float64)
+    # the chunk, the bin idx and the bool mask
+    chunk = get_pair_chunk_size(3 * 8, param)
+    for start in range(0, len(values), chunk):
+        tmp = values[start:start + chunk]
+        is_value = ~np.isnan(tmp)
+        bin_idx = np.clip((tmp[is_value] - low) / bin_width, 0, n_bins - 1).astype(np.int64)
+        tmp_weights = None if weights is None else weights[start:start + chunk][is_value]
+        counts += np.bincount(bin_idx, weights = tmp_weights, minlength = n_bins)
+
+    # linear interpolation between the sorted values, as np.quantile, assuming the values are spread evenly in each bin
+    cum_counts = np.cumsum(counts)
+    position = np.asarray(quantiles) * (cum_counts[-1] - 1)
+    bin_idx = np.searchsorted(cum_counts, position, side = 'right')
+    in_bin = (position - (cum_counts[bin_idx] - counts[bin_idx])) / counts[bin_idx]
+    return np.minimum(low + (bin_idx + in_bin) * bin_width, high)
+
+def re_scale(vector, param = None):
     """
     scale a score between 0 and 1 to use for a probability distribution.
 
@@ -9,18 +126,21 @@ def re_scale(vector):
     ----------
     vector : ndarray 
         A array of scores
+    param : dict, optional
+        The param dictionary, used to choose how the quantiles are found, by default None
 
     Returns
     -------
     ndarray
         re-scaled score array
     """
-    score = ( np.nanquantile(vector,0.99) - vector) / (np.nanquantile(vector,0.99) - np.nanmin(vector))
+    high, low = get_quantiles(vector, (0.99, 0), param)
+    score = ( high - vector) / (high - low)
     score[score<0] = 0
     score[np.isnan(score)] = 0 # set NaN values to 0
     return score
 
-def get_simple_metric(waveform_parameter, outlier = False):
+def get_simple_metric(waveform_parameter, outlier = False, param = None):
     """
     This function is suitable for, spatial decay, spatial decay fit, amplitude and other (n_units,2) parameters,
 
@@ -30,6 +150,8 @@ def get_simple_metric(waveform_parameter, outlier = False):
         A simple parameters where each unit/cv has one score
     outlier : bool, optional
         If True will remove more outliers before creating a score, by default False
+    param : dict, optional
+        The param dictionary, used to choose how the quantiles are found, by default None
 
     Returns
     -------
@@ -46,21 +168,23 @@ def get_simple_metric(waveform_parameter, outlier = False):
     diff = np.abs(x1 - x2) / np.nanmean(np.abs( np.stack((x1,x2), axis = -1)), axis = 2)
 
     if outlier == True: 
-        diff[diff<0] = np.nanquantile(diff, 0.9999) 
-        diff[ diff > np.nanquantile(diff,0.9999)] = np.nanquantile(diff, 0.9999)
+        max_diff = get_quantiles(diff, (0.9999,), param)[0]
+        diff[diff<0] = max_diff
+        diff[ diff > max_diff] = max_diff
 
     sqrt_diff = np.sqrt(diff) 
-    metric = re_scale(sqrt_diff)
+    metric = re_scale(sqrt_diff, param)
 
     return metric
 
-def get_wave_corr(avg_waveform, param):
+def normalise_waveforms(avg_waveform, param):
     """
-    Calculates the correlation between weighted average waveform, and rescales it into a score
+    Subtracts the mean and divides by the norm of each average waveform over param['waveidx'], 
+    so the correlation between two waveforms is their dot product.
 
     Parameters
     ----------
-    avg_waveform : ndarray (n_units, spike_width, 2)
+    avg_waveform : ndarray (spike_width, n_units, 2)
         The average waveform
     param : dict
         The param dictionary
@@ -68,28 +192,72 @@ def get_wave_corr(avg_waveform, param):
     Returns
     -------
     ndarray
-        The(n_units, n_units) score array for the waveform correlation
+        The (n_time, n_units, 2) normalised waveforms
     """
     waveidx = param['waveidx']
-    n_units = param['n_units']
+    wave = avg_waveform[waveidx,:,:] - np.mean(avg_waveform[waveidx,:,:], axis = 0)
+    wave /= np.linalg.norm(wave, axis = 0)
+    return wave
 
-    x1 = avg_waveform[waveidx,:,0].T 
-    x2 = avg_waveform[waveidx,:,1].T
+def wave_corr_to_score(wave_corr, param = None):
+    """
+    Turns waveform correlations into a score between 0 and 1, this is done in place.
 
-    #calculate the correlation
-    wave_corr_tmp = np.corrcoef(x1,x2)
-    wave_corr = wave_corr_tmp[:n_units,n_units:]
+    Parameters
+    ----------
+    wave_corr : ndarray
+        The correlation between the waveforms
+    param : dict, optional
+        The param dictionary, used to choose how the quantiles are found, by default None
 
+    Returns
+    -------
+    ndarray
+        The waveform correlation score
+    """
+    np.clip(wave_corr, -1, 1, out = wave_corr)
+    np.arctanh(wave_corr, out = wave_corr) # apply Fisher z transformation
 
-    wave_corr = np.arctanh(wave_corr) # apply Fisher z transformation
     #make into a score
-    wave_corr = (wave_corr - np.nanquantile(wave_corr,0.005)) / (np.nanquantile(wave_corr,0.995) - np.nanquantile(wave_corr, 0.005))
+    low, high = get_quantiles(wave_corr, (0.005, 0.995), param)
+    wave_corr -= low
+    wave_corr /= high - low
     wave_corr[np.isnan(wave_corr)] = 0
-    wave_corr[wave_corr<0] = 0
-    wave_corr[wave_corr>1] = 1 
+    np.clip(wave_corr, 0, 1, out = wave_corr)
 
     return wave_corr
 
+def get_wave_corr(avg_waveform, param):
+    """
+    Calculates the correlation between weighted average waveform, and rescales it into a score
+
+    Parameters
+    ----------
+    avg_waveform : ndarray (n_units, spike_width, 2)
+        The average waveform
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray
+        The(n_units, n_units) score array for the waveform correlation
+    """
+    n_units = param['n_units']
+    wave = normalise_waveforms(avg_waveform, param)
+    x1 = wave[:,:,0].T # (n_units, n_time)
+    x2 = wave[:,:,1]
+
+    #only the correlation between cv 1 and cv 2 is needed
+    wave_corr = np.zeros((n_units, n_units), dtype = wave.dtype)
+    row_tile, __ = get_tile_sizes(n_units, wave.itemsize, param)
+    for row in range(0, n_units, row_tile):
+        rows = slice(row, row + row_tile)
+        np.matmul(x1[rows], x2, out = wave_corr[rows])
+
+    with np.errstate(divide = 'ignore'):
+        return wave_corr_to_score(wave_corr, param)
+
 def get_waveforms_mse(avg_waveform, param):
     """
     Calculates the waveform mean square error, and rescales it into a score
@@ -107,15 +275,31 @@ def get_waveforms_mse(avg_waveform, param):
         The(n_units, n_units) score array for the waveform mean square error
     """
     waveidx = param['waveidx']
+    n_units = param['n_units']
     projected_waveform_norm = avg_waveform[waveidx,:,:]
     projected_waveform_norm =  (projected_waveform_norm - np.nanmin(projected_waveform_norm,axis = 0)) / (np.nanmax(projected_waveform_norm, axis=0) - np.nanmin(projected_waveform_norm, axis = 0))
 
-    x1 = np.tile(np.expand_dims(projected_waveform_norm[:,:,0], axis = 2), (1,1,projected_waveform_norm.shape[1]))
-    x2 = np.swapaxes(np.tile(np.expand_dims(projected_waveform_norm[:,:,1], axis = 2), (1,1,projected_waveform_norm.shape[1])), 1,2 )
-    raw_wave_mse = np.nanmean( (x1 - x2)**2, axis = 0 ).squeeze()
+    # sum (a - b)**2 = sum a**2 + sum b**2 - 2 sum a*b, where each sum is only over time points where both a and b are not NaN
+    # so each term is a matrix multiplication over time
+    is_valid = (~np.isnan(projected_waveform_norm)).astype(projected_waveform_norm.dtype)
+    wave = np.nan_to_num(projected_waveform_norm)
+    x1, x1_sq, x1_valid = wave[:,:,0].T, (wave[:,:,0]**2).T, is_valid[:,:,0].T # (n_units, n_time)
+    x2, x2_sq, x2_valid = wave[:,:,1], wave[:,:,1]**2, is_valid[:,:,1] # (n_time, n_units)
+
+    raw_wave_mse = np.zeros((n_units, n_units), dtype = wave.dtype)
+    row_tile, __ = get_tile_sizes(n_units, 4 * wave.itemsize, param)
+    for row in range(0, n_units, row_tile):
+        rows = slice(row, row + row_tile)
+        sq_diff = x1_sq[rows] @ x2_valid + x1_valid[rows] @ x2_sq - 2 * (x1[rows] @ x2)
+        n_valid = x1_valid[rows] @ x2_valid
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            raw_wave_mse[rows] = sq_diff / n_valid # NaN if there are no valid time points, like nanmean
+
+    # rounding can make the mse of identical waveforms slightly negative
+    raw_wave_mse[raw_wave_mse < 0] = 0
     raw_wave_mse_norm = np.sqrt(raw_wave_mse)
 
-    waveform_mse = re_scale(raw_wave_mse_norm)
+    waveform_mse = re_scale(raw_wave_mse_norm, param)
     return waveform_mse
 
 def flip_dim(avg_waveform_per_tp, param):
@@ -139,7 +323,7 @@ def flip_dim(avg_waveform_per_tp, param):
     spike_width = param['spike_width']
 
     flip_dim = np.array((1,)) # BE CAREFUL HERE, Which dimension is the x-axis  
-    avg_waveform_per_tp_flip = np.full((3, n_units,spike_width ,2 , len(flip_dim)+1), np.nan)
+    avg_waveform_per_tp_flip = np.full((3, n_units,spike_width ,2 , len(flip_dim)+1), np.nan, dtype = avg_waveform_per_tp.dtype)
 
     for i in range(len(flip_dim)):
         tmpdat = avg_waveform_per_tp[flip_dim[i]  ,:,:,:]
@@ -152,6 +336,237 @@ def flip_dim(avg_waveform_per_tp, param):
 
     return avg_waveform_per_tp_flip
 
+def get_tile_sizes(n_units, bytes_per_pair, param):
+    """
+    Chooses how many rows and columns of the (n_units, n_units) pair array to compute at once, so the 
+    temporary arrays for one tile fit in param['memory_limit'] bytes.
+    Full rows are used when possible, otherwise the columns are split as well.
+
+    Parameters
+    ----------
+    n_units : int
+        The number of units
+    bytes_per_pair : int
+        The number of bytes of temporary arrays needed per pair of units
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    int, int
+        The number of rows and columns in each tile
+    """
+    max_pairs = max(int(param.get('memory_limit', 2e9) // bytes_per_pair), 1)
+    col_tile = int(min(n_units, max_pairs))
+    row_tile = int(min(n_units, max(max_pairs // col_tile, 1)))
+    return row_tile, col_tile
+
+def get_flip_offsets(avg_waveform_per_tp):
+    """
+    Flipping the x axis, as in flip_dim(), maps x to (min(x) + max(x) - x) for each unit and cv. 
+    This returns min(x) + max(x), so the flipped positions never need to be made.
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
+
+    Returns
+    -------
+    ndarray
+        The (n_units, 2) offset for flipping the x axis
+    """
+    return np.nanmin(avg_waveform_per_tp[1], axis = 1) + np.nanmax(avg_waveform_per_tp[1], axis = 1)
+
+def compare_positions(pos_1, pos_2, centroid_1, centroid_2, offset_1, offset_2, is_peak, recentered = True, drift_1 = None, drift_2 = None):
+    """
+    The shared kernel of get_centroid_metrics() and get_centroid_metrics_pairs().
+    Compares the positions per time point of units in cv 1 with units in cv 2, for both the flipped and not
+    flipped x axis, and both the raw and re-centered positions. The inputs are broadcast together.
+    The drift correction of each unit, see get_unit_drift(), is added to the positions here instead of to the arrays.
+
+    Parameters
+    ----------
+    pos_1, pos_2 : ndarray (3, ..., n_time)
+        The positions per time point 
+    centroid_1, centroid_2 : ndarray (3, ...)
+        The average centroids
+    offset_1, offset_2 : ndarray (...)
+        The flip offsets, see get_flip_offsets()
+    is_peak : ndarray
+        A bool array marking the peak time point
+    recentered : bool, optional
+        If False the re-centered distance is not calculated and is returned as None, by default True
+    drift_1, drift_2 : ndarray (3, ...), optional
+        The drift correction of the units, by default None which is no drift correction
+
+    Returns
+    -------
+    ndarrays
+        The distance at the peak time, the variance of the distance over time and the mean re-centered distance
+        over time, each minimised over flips
+    """
+    diff = pos_1 - pos_2
+    diff_centroid = (centroid_1 - centroid_2)[..., np.newaxis]
+    diff_offset = (offset_1 - offset_2)[..., np.newaxis]
+    if drift_1 is not None:
+        # moving a unit by the drift moves its centroid the same, and the flip offset by twice the x drift
+        diff_drift = (drift_1 - drift_2)[..., np.newaxis]
+        diff += diff_drift
+        diff_centroid = diff_centroid + diff_drift
+        diff_offset = diff_offset + 2 * diff_drift[1]
+
+    # only the x axis (dim 1) is flipped
+    other_sq = diff[0]**2 + diff[2]**2
+    if recentered:
+        other_sq_rc = (diff[0] - diff_centroid[0])**2 + (diff[2] - diff_centroid[2])**2
+
+    euclid_dist = euclid_dist_var = euclid_dist_rc = None
+    for diff_x in (diff_offset - diff[1], diff[1]): # flipped, not flipped
+        tmp_euclid = np.sqrt(other_sq + diff_x**2)
+
+        tmp_dist = np.nanmin(tmp_euclid[..., is_peak], axis = -1)
+        # need ddof = 1 to match with ML
+        tmp_var = np.nanvar(tmp_euclid, axis = -1, ddof = 1)
+        if recentered:
+            tmp_rc = np.nanmean(np.sqrt(other_sq_rc + (diff_x - diff_centroid[1])**2), axis = -1)
+
+        if euclid_dist is None:
+            euclid_dist, euclid_dist_var = tmp_dist, tmp_var
+            euclid_dist_rc = tmp_rc if recentered else None
+        else:
+            euclid_dist = np.fmin(euclid_dist, tmp_dist)
+            euclid_dist_var = np.fmin(euclid_dist_var, tmp_var)
+            if recentered:
+                euclid_dist_rc = np.fmin(euclid_dist_rc, tmp_rc)
+
+    return euclid_dist, euclid_dist_var, euclid_dist_rc
+
+def get_centroid_metrics(avg_waveform_per_tp, avg_centroid, param):
+    """
+    Calculates the reduced Euclidean distances between units, which are used for the centroid scores, in one pass.
+    This replaces flip_dim(), get_Euclidean_dist() and get_recentered_euclidean_dist() followed by the reductions in 
+    centroid_metrics() and recentered_metrics(), without making the full (n_units, n_time, n_flip, n_units) arrays.
+    The units are compared in tiles which fit in param['memory_limit'], see get_tile_sizes()
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
+    avg_centroid : ndarray
+        The average centroid for each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        The (n_units, n_units) distance at the peak time, the variance over time of the distance
+        and the mean re-centered distance, each minimised over flips
+    """
+    n_units = param['n_units']
+    euclid_dist = np.full((n_units, n_units), np.nan, dtype = avg_waveform_per_tp.dtype)
+    euclid_dist_var = np.full((n_units, n_units), np.nan, dtype = avg_waveform_per_tp.dtype)
+    euclid_dist_rc = np.full((n_units, n_units), np.nan, dtype = avg_waveform_per_tp.dtype)
+
+    all_units = np.arange(n_units)
+    fill_centroid_metrics(avg_waveform_per_tp, avg_centroid, all_units, all_units, (euclid_dist, euclid_dist_var, euclid_dist_rc), param)
+
+    return euclid_dist, euclid_dist_var, euclid_dist_rc
+
+def fill_centroid_metrics(avg_waveform_per_tp, avg_centroid, row_units, col_units, out, param, unit_drift = None):
+    """
+    Calculates the reduced Euclidean distances, see get_centroid_metrics(), between the row_units in cv 1 and the 
+    col_units in cv 2, and writes them into the (n_units, n_units) arrays in out.
+    The units are compared in tiles which fit in param['memory_limit'], see get_tile_sizes()
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
+    avg_centroid : ndarray
+        The average centroid for each unit
+    row_units : ndarray
+        The idx of the units to compare in cv 1
+    col_units : ndarray
+        The idx of the units to compare in cv 2
+    out : tuple
+        The (n_units, n_units) arrays for the peak distance, distance variance and re-centered distance,
+        set to None to not calculate the re-centered distance
+    param : dict
+        The param dictionary
+    unit_drift : ndarray (3, n_units), optional
+        The drift correction of each unit, see get_unit_drift(), by default None
+    """
+    waveidx = param['waveidx']
+    is_peak = param['peak_loc'] - waveidx == 0
+
+    # (3, n_units, n_time) for each cv
+    pos_1 = avg_waveform_per_tp[:,row_units][:,:,waveidx,0]
+    pos_2 = avg_waveform_per_tp[:,col_units][:,:,waveidx,1]
+    centroid_1, centroid_2 = avg_centroid[:,row_units,0], avg_centroid[:,col_units,1]
+    offset = get_flip_offsets(avg_waveform_per_tp)
+    offset_1, offset_2 = offset[row_units,0], offset[col_units,1]
+    if unit_drift is not None:
+        drift_1, drift_2 = unit_drift[:,row_units], unit_drift[:,col_units]
+
+    # the difference (3 dims) and around 8 temporary arrays, for every time point
+    bytes_per_pair = 11 * len(waveidx) * avg_waveform_per_tp.itemsize
+    row_tile, col_tile = get_tile_sizes(max(len(row_units), len(col_units)), bytes_per_pair, param)
+    for row in range(0, len(row_units), row_tile):
+        rows = slice(row, row + row_tile)
+        for col in range(0, len(col_units), col_tile):
+            cols = slice(col, col + col_tile)
+            tile = np.ix_(row_units[rows], col_units[cols])
+            tile_drift = (drift_1[:,rows,np.newaxis], drift_2[:,np.newaxis,cols]) if unit_drift is not None else (None, None)
+            metrics = compare_positions(pos_1[:,rows,np.newaxis,:], pos_2[:,np.newaxis,cols,:], 
+                centroid_1[:,rows,np.newaxis], centroid_2[:,np.newaxis,cols], 
+                offset_1[rows,np.newaxis], offset_2[np.newaxis,cols], is_peak, out[2] is not None, *tile_drift)
+            for metric, metric_out in zip(metrics, out):
+                if metric_out is not None:
+                    metric_out[tile] = metric
+
+def update_centroid_metrics(avg_waveform_per_tp, avg_centroid, unit_drift, unit_shift, euclid_dist, euclid_dist_var, param):
+    """
+    After drift correction only the pairs of units which have been moved by a different amount need their
+    peak distance and distance variance recalculated, these are updated in place.
+    The re-centered distance does not change as the positions and the centroid of a unit are moved together.
+    So a new drift estimate can be tried by only recalculating the pairs of units it moves apart.
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point, without drift correction
+    avg_centroid : ndarray
+        The average centroid for each unit, without drift correction
+    unit_drift : ndarray (3, n_units)
+        The drift correction of each unit, see get_unit_drift()
+    unit_shift : ndarray (3, n_units)
+        How much each unit was moved since euclid_dist and euclid_dist_var were calculated
+    euclid_dist : ndarray
+        The (n_units, n_units) distance at the peak time, from before the drift correction
+    euclid_dist_var : ndarray
+        The (n_units, n_units) variance over time of the distance, from before the drift correction
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        The updated distance at the peak time and variance over time of the distance
+    """
+    # group units which were moved together, rounding the shifts to 0.01um to ignore floating point errors
+    __, group_id = np.unique(np.round(np.nan_to_num(unit_shift.T), 2), axis = 0, return_inverse = True)
+    group_id = group_id.reshape(-1)
+    groups = [np.flatnonzero(group_id == gid) for gid in range(group_id.max() + 1)]
+
+    for gid1, group1 in enumerate(groups):
+        for gid2, group2 in enumerate(groups):
+            if gid1 != gid2:
+                fill_centroid_metrics(avg_waveform_per_tp, avg_centroid, group1, group2, (euclid_dist, euclid_dist_var, None), param, unit_drift)
+
+    return euclid_dist, euclid_dist_var
+
 def get_Euclidean_dist(avg_waveform_per_tp_flip,param):
     """
     Calculated the Euclidean distance between the units at each time point and for the flipped axis case
@@ -188,173 +603,667 @@ def get_Euclidean_dist(avg_waveform_per_tp_flip,param):
     del tmp_euclid
     return euclid_dist
 
-def centroid_metrics(euclid_dist, param):
+def centroid_metrics(euclid_dist, param):
+    """
+    This function calculates the score for the centroid distance and centroid variance.
+
+    Parameters
+    ----------
+    euclid_dist : ndarray
+        The euclidean distance between each unit for each time point
+    param : _type_
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        An array (n_units, n_units) of scores for centroid distance and variance
+    """
+    waveidx = param['waveidx']
+    new_peak_loc = param['peak_loc']    
+
+    centroid_dist = np.nanmin( euclid_dist[:,new_peak_loc - waveidx ==0,:,:].squeeze(), axis =1 ).squeeze()
+
+    # need ddof = 1 to match with ML
+    centroid_var = np.nanmin( np.nanvar(euclid_dist, axis = 1, ddof = 1 ).squeeze(), axis =1 ).squeeze()
+
+    return centroid_scores(centroid_dist, centroid_var, param)
+
+def centroid_scores(euclid_dist, euclid_dist_var, param):
+    """
+    This function turns the reduced Euclidean distances into the centroid distance and centroid variance scores.
+
+    Parameters
+    ----------
+    euclid_dist : ndarray (n_units, n_units)
+        The distance between units at the peak time, minimised over flips
+    euclid_dist_var : ndarray (n_units, n_units)
+        The variance over time of the distance between units, minimised over flips
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        An array (n_units, n_units) of scores for centroid distance and variance
+    """
+    max_dist = param['max_dist']
+
+    centroid_dist = 1 - ((euclid_dist - np.nanmin(euclid_dist)) / (max_dist - np.nanmin(euclid_dist)))
+    centroid_dist[centroid_dist<0] = 0
+    centroid_dist[np.isnan(centroid_dist)] = 0
+
+    #Centroid Var
+    centroid_var = np.sqrt(euclid_dist_var)
+    centroid_var = re_scale(centroid_var, param)
+    centroid_var[np.isnan(centroid_var)] = 0
+
+    return centroid_dist, centroid_var
+
+def get_recentered_euclidean_dist(avg_waveform_per_tp_flip, avg_centroid, param):
+    """
+    Find a Euclidean distance where the location per time has been centered around the average position
+
+    Parameters
+    ----------
+    avg_waveform_per_tp_flip : ndarray
+        The average waveform per time point with the x axis flipped and not flipped
+    avg_centroid : ndarray
+        The average location for each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray
+        the re-centered euclidean distance
+    """
+
+    waveidx = param['waveidx']
+    n_units = param['n_units']
+    spike_width = param['spike_width']
+
+    # recentered projected location , aka subtract the avg location, the we can unique info
+    avg_centroid_broadcast = np.tile(np.expand_dims(avg_centroid, axis= (3,4)), (1,1,1,spike_width,2))
+    avg_waveform_per_tp_fip_recenterd = np.swapaxes( np.swapaxes(avg_waveform_per_tp_flip, 2,3) - avg_centroid_broadcast,2,3)
+    x1 = np.tile( np.expand_dims(avg_waveform_per_tp_fip_recenterd[:,:,waveidx,0,:], axis = -1), (1,1,1,1,n_units)).squeeze()
+    x2 = np.swapaxes(np.tile( np.expand_dims(avg_waveform_per_tp_fip_recenterd[:,:,waveidx,1,:], axis = -1), (1,1,1,1,n_units)).squeeze(), 1, 4)
+
+    w = np.isnan( np.abs(x1[0,:,:,:,:] - x2[0,:,:,:,:])).squeeze()
+
+    tmp_euclid = np.linalg.norm(x1-x2, axis = 0)
+    tmp_euclid[w] = np.nan
+    euclid_dist_2 = tmp_euclid
+    del x1
+    del x2
+    del w
+    del tmp_euclid
+    return euclid_dist_2
+
+def recentered_metrics(euclid_dist_2):
+    """
+    Calculates the re-centered centroid distance score metric
+
+    Parameters
+    ----------
+    euclid_dist_2 : ndarray
+        The re-centered euclidean distance
+
+    Returns
+    -------
+    ndarray
+        The centroid distance re_centered score metric
+    """
+    centroid_dist_recentered = np.nanmin( np.nanmean(euclid_dist_2, axis =1), axis =1)
+    return recentered_scores(centroid_dist_recentered)
+
+def recentered_scores(euclid_dist_rc, param = None):
+    """
+    Turns the mean re-centered Euclidean distance, minimised over flips, into the re-centered centroid distance score
+
+    Parameters
+    ----------
+    euclid_dist_rc : ndarray
+        The mean re-centered euclidean distance
+    param : dict, optional
+        The param dictionary, used to choose how the quantiles are found, by default None
+
+    Returns
+    -------
+    ndarray
+        The centroid distance re_centered score metric
+    """
+    centroid_dist_recentered = re_scale(euclid_dist_rc, param)
+    centroid_dist_recentered[np.isnan(centroid_dist_recentered)] = 0
+    return centroid_dist_recentered
+
+def get_trajectories(avg_waveform_per_tp_flip, param):
+    """
+    Finds the distance traveled by each unit between time points, and the angle of the movement between time points
+
+    Parameters
+    ----------
+    avg_waveform_per_tp_flip : ndarray
+        The average waveform per time point with the x axis flipped and not flipped
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        The (n_units, n_time - 1, 2, n_flip) angle and distance between time points
+    """
+    waveidx = param['waveidx']
+    min_angle_dist = param['min_angle_dist']
+
+    #Distance between time steps and angle
+    x1 = avg_waveform_per_tp_flip[:,:,waveidx[1]:waveidx[-1] +1,:,:]
+    x2 = avg_waveform_per_tp_flip[:,:,waveidx[0]:waveidx[-2] +1,:,:] # Difference between python and ML indexing
+
+    traj_dist = np.linalg.norm(x1-x2, axis= 0)
+
+    #only select points which have enough movement to get a angle
+    good_angle = traj_dist >= min_angle_dist
+    loc_angle = np.zeros_like(traj_dist)
+    for dim_id1 in range(avg_waveform_per_tp_flip.shape[0]):
+        for dim_id2 in range(dim_id1 + 1, avg_waveform_per_tp_flip.shape[0]):
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                ang = np.abs( x1[dim_id1] - x2[dim_id1]) / np.abs(x1[dim_id2] - x2[dim_id2])
+            # only selects angles for units where there is sufficient distance between time points, summing as nansum
+            loc_angle += np.nan_to_num(np.arctan(ang) * good_angle)
+
+    return loc_angle, traj_dist
+
+def get_trajectory_scores(avg_waveform_per_tp, param):
+    """
+    Calculates the trajectory angle and distance scores, see dist_angle().
+    Flipping the x axis and drift correction do not change the movement between time points,
+    so only the not flipped positions are needed and these scores do not need recalculating after drift correction.
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        The score arrays for the trajectory distance and angle
+    """
+    return dist_angle(avg_waveform_per_tp[..., np.newaxis], param)
+
+def dist_angle(avg_waveform_per_tp_flip, param):
+    """
+    This function uses the weighted average location per time point, to find metrics based of off:
+    The distance traveled by the unit at each time point
+    The angle between units at each time point 
+    The units are compared in tiles which fit in param['memory_limit'], see get_tile_sizes()
+
+    Parameters
+    ----------
+    avg_waveform_per_tp_flip : ndarray
+        The average waveform per time point with the x axis flipped and not flipped
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarrays
+        The score arrays for the trajectory distance and angle
+    """
+    n_units = param['n_units']
+
+    loc_angle, traj_dist = get_trajectories(avg_waveform_per_tp_flip, param)
+    # (n_units, n_flip, n_time - 1) for each cv, so the sums over time are over contiguous memory
+    angle_1 = np.ascontiguousarray(np.moveaxis(loc_angle[:,:,0,:], 1, -1))[:,np.newaxis]
+    angle_2 = np.ascontiguousarray(np.moveaxis(loc_angle[:,:,1,:], 1, -1))[np.newaxis]
+    dist_1 = np.ascontiguousarray(np.moveaxis(traj_dist[:,:,0,:], 1, -1))[:,np.newaxis]
+    dist_2 = np.ascontiguousarray(np.moveaxis(traj_dist[:,:,1,:], 1, -1))[np.newaxis]
+
+    traj_angle_sim = np.zeros((n_units, n_units), dtype = traj_dist.dtype)
+    traj_dist_sim = np.zeros((n_units, n_units), dtype = traj_dist.dtype)
+
+    # the (n_time - 1, n_flip) difference for each pair in the tile
+    bytes_per_pair = 2 * traj_dist.shape[1] * traj_dist.shape[3] * traj_dist.itemsize
+    row_tile, col_tile = get_tile_sizes(n_units, bytes_per_pair, param)
+    for row in range(0, n_units, row_tile):
+        rows = slice(row, row + row_tile)
+        for col in range(0, n_units, col_tile):
+            cols = slice(col, col + col_tile)
+            # the angles have no NaN values, so unlike the distance need no NaN penalty
+            angle_subtraction = np.abs(angle_1[rows] - angle_2[:,cols])
+            traj_angle_sim[rows,cols] = np.fmin.reduce( np.sum(angle_subtraction, axis = 3), axis = 2)
+
+            traj_dist_compared = np.abs(dist_1[rows] - dist_2[:,cols])
+            traj_dist_sim[rows,cols] = np.fmin.reduce( np.nansum(traj_dist_compared, axis = 3), axis = 2)
+
+    traj_angle_sim = re_scale(traj_angle_sim, param)
+    traj_angle_sim[np.isnan(traj_angle_sim)] = 0
+
+    traj_dist_sim = np.sqrt(traj_dist_sim)
+    traj_dist_sim = re_scale(traj_dist_sim, param)
+    traj_dist_sim[np.isnan(traj_dist_sim)] = 0
+
+    return traj_angle_sim, traj_dist_sim
+
+def get_candidate_pairs(avg_centroid, param):
+    """
+    Uses a KD-tree over the average centroid of each unit to find the pairs of units which are close enough
+    to be a possible match, so the metrics only need to be calculated for these pairs.
+    Every unit is paired with itself, and pairs are found in both orders.
+
+    Parameters
+    ----------
+    avg_centroid : ndarray
+        The average centroid for each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray
+        A (n_pairs, 2) array of the unit idx of each candidate pair, sorted by the first then second unit
+    """
+    from scipy.spatial import cKDTree
+
+    n_units = param['n_units']
+    #needs to be larger than max_dist, as the centroid is not the location at the peak and drift is not yet corrected
+    candidate_dist = param.get('candidate_dist', 2 * param['max_dist'])
+
+    centroid = np.nanmean(avg_centroid, axis = 2).T # (n_units, 3)
+    good_units = np.argwhere(np.all(np.isfinite(centroid), axis = 1)).squeeze(axis = 1)
+
+    tree = cKDTree(centroid[good_units])
+    close_pairs = good_units[tree.query_pairs(candidate_dist, output_type = 'ndarray')]
+
+    self_pairs = np.tile(np.arange(n_units)[:, np.newaxis], (1,2))
+    pairs = np.concatenate((self_pairs, close_pairs, close_pairs[:, ::-1]), axis = 0)
+    pairs = pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+    return pairs
+
+def get_sample_pairs(candidate_pairs, param):
+    """
+    Adds a random sample of param['sparse_sample_pairs'] of the other (non-candidate) pairs to the candidate pairs, so the
+    statistics used to re-scale the scores, find the number of matches and fit the probability distributions are found over
+    every pair of units, as when every pair is scored. Each sampled pair is weighted by n_other_pairs / n_sampled_pairs.
+    If there are no more than param['sparse_sample_pairs'] other pairs, every pair is used and the statistics are exact.
+
+    Parameters
+    ----------
+    candidate_pairs : ndarray (n_candidate_pairs, 2)
+        The candidate pairs, sorted by the first then second unit, see get_candidate_pairs()
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray, ndarray
+        The (n_pairs, 2) candidate and sampled pairs sorted by the first then second unit, and the (n_pairs) weight
+        of each pair, which is None if every pair is used
+    """
+    n_units = param['n_units']
+    n_sample = int(param.get('sparse_sample_pairs', 1e6))
+    candidate_idx = candidate_pairs[:,0].astype(np.int64) * n_units + candidate_pairs[:,1]
+    n_other = n_units**2 - len(candidate_idx)
+
+    rng = np.random.default_rng(0)
+    if n_other <= 2 * n_sample:
+        sample_idx = np.setdiff1d(np.arange(n_units**2, dtype = np.int64), candidate_idx, assume_unique = True)
+        if n_other > n_sample:
+            sample_idx = rng.choice(sample_idx, n_sample, replace = False)
+    else:
+        #most random pairs are not candidates, so draw more than needed and remove the candidates and repeats
+        sample_idx = np.zeros(0, dtype = np.int64)
+        while len(sample_idx) < n_sample:
+            draw = rng.integers(0, n_units**2, 2 * n_sample, dtype = np.int64)
+            sample_idx = np.union1d(sample_idx, draw[~np.isin(draw, candidate_idx)])
+        sample_idx = rng.choice(sample_idx, n_sample, replace = False)
+
+    pair_idx = np.concatenate((candidate_idx, sample_idx))
+    order = np.argsort(pair_idx)
+    pairs = np.stack(np.divmod(pair_idx[order], n_units), axis = 1)
+
+    weights = None
+    if len(sample_idx) < n_other:
+        weights = np.where(order < len(candidate_idx), 1, n_other / len(sample_idx))
+    return pairs, weights
+
+def get_pair_chunk_size(bytes_per_pair, param):
+    """
+    The number of pairs to compare at once, so the temporary arrays fit in param['memory_limit'] bytes.
+
+    Parameters
+    ----------
+    bytes_per_pair : int
+        The number of bytes of temporary arrays needed per pair of units
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    int
+        The number of pairs in each chunk
+    """
+    return max(int(param.get('memory_limit', 2e9) // bytes_per_pair), 1)
+
+def get_simple_metric_pairs(waveform_parameter, pairs, outlier = False, param = None):
+    """
+    The same as get_simple_metric(), only for the given candidate pairs.
+
+    Parameters
+    ----------
+    waveform_parameter : ndarray (n_units , 2)
+        A simple parameters where each unit/cv has one score
+    pairs : ndarray (n_pairs, 2)
+        The candidate pairs
+    outlier : bool, optional
+        If True will remove more outliers before creating a score, by default False
+    param : dict, optional
+        The param dictionary, used to choose how the quantiles are found, by default None
+
+    Returns
+    -------
+    ndarray
+        A (n_pairs) array of scores
+    """
+    x1 = waveform_parameter[pairs[:,0],0]
+    x2 = waveform_parameter[pairs[:,1],1]
+
+    diff = np.abs(x1 - x2) / np.nanmean(np.abs( np.stack((x1,x2), axis = -1)), axis = 1)
+
+    if outlier == True: 
+        max_diff = get_quantiles(diff, (0.9999,), param)[0]
+        diff[ diff > max_diff] = max_diff
+
+    return re_scale(np.sqrt(diff), param)
+
+def get_wave_corr_pairs(avg_waveform, pairs, param):
+    """
+    The same as get_wave_corr(), only for the given candidate pairs.
+
+    Parameters
+    ----------
+    avg_waveform : ndarray (spike_width, n_units, 2)
+        The average waveform
+    pairs : ndarray (n_pairs, 2)
+        The candidate pairs
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray
+        The (n_pairs) score array for the waveform correlation
+    """
+    x = normalise_waveforms(avg_waveform, param)
+
+    wave_corr = np.zeros(len(pairs), dtype = x.dtype)
+    chunk = get_pair_chunk_size(2 * x.shape[0] * x.itemsize, param)
+    for start in range(0, len(pairs), chunk):
+        tmp_pairs = pairs[start:start + chunk]
+        wave_corr[start:start + chunk] = np.einsum('tp,tp->p', x[:,tmp_pairs[:,0],0], x[:,tmp_pairs[:,1],1])
+
+    with np.errstate(divide = 'ignore'):
+        return wave_corr_to_score(wave_corr, param)
+
+def get_waveforms_mse_pairs(avg_waveform, pairs, param):
     """
-    This function calculates the score for the centroid distance and centroid variance.
+    The same as get_waveforms_mse(), only for the given candidate pairs.
 
     Parameters
     ----------
-    euclid_dist : ndarray
-        The euclidean distance between each unit for each time point
-    param : _type_
+    avg_waveform : ndarray (spike_width, n_units, 2)
+        The average waveform
+    pairs : ndarray (n_pairs, 2)
+        The candidate pairs
+    param : dict
         The param dictionary
 
     Returns
     -------
-    ndarrays
-        An array (n_units, n_units) of scores for centroid distance and variance
+    ndarray
+        The (n_pairs) score array for the waveform mean square error
     """
-    max_dist = param['max_dist']
     waveidx = param['waveidx']
-    new_peak_loc = param['peak_loc']    
-
-    centroid_dist = np.nanmin( euclid_dist[:,new_peak_loc - waveidx ==0,:,:].squeeze(), axis =1 ).squeeze()
-
-
-    centroid_dist = 1 - ((centroid_dist - np.nanmin(centroid_dist)) / (max_dist - np.nanmin(centroid_dist)))
-    centroid_dist[centroid_dist<0] = 0
-    centroid_dist[np.isnan(centroid_dist)] = 0
+    projected_waveform_norm = avg_waveform[waveidx,:,:]
+    projected_waveform_norm =  (projected_waveform_norm - np.nanmin(projected_waveform_norm,axis = 0)) / (np.nanmax(projected_waveform_norm, axis=0) - np.nanmin(projected_waveform_norm, axis = 0))
 
-    #Centroid Var
-    # need ddof = 1 to match with ML
-    centroid_var = np.nanmin( np.nanvar(euclid_dist, axis = 1, ddof = 1 ).squeeze(), axis =1 ).squeeze()
-    centroid_var = np.sqrt(centroid_var)
-    centroid_var = re_scale(centroid_var)
-    centroid_var[np.isnan(centroid_var)] = 0
+    raw_wave_mse = np.zeros(len(pairs), dtype = projected_waveform_norm.dtype)
+    chunk = get_pair_chunk_size(3 * len(waveidx) * projected_waveform_norm.itemsize, param)
+    for start in range(0, len(pairs), chunk):
+        tmp_pairs = pairs[start:start + chunk]
+        raw_wave_mse[start:start + chunk] = np.nanmean( (projected_waveform_norm[:,tmp_pairs[:,0],0] - projected_waveform_norm[:,tmp_pairs[:,1],1])**2, axis = 0)
 
-    return centroid_dist, centroid_var
+    return re_scale(np.sqrt(raw_wave_mse), param)
 
-def get_recentered_euclidean_dist(avg_waveform_per_tp_flip, avg_centroid, param):
+def get_centroid_metrics_pairs(avg_waveform_per_tp, avg_centroid, pairs, param, unit_drift = None):
     """
-    Find a Euclidean distance where the location per time has been centered around the average position
+    The same as get_centroid_metrics(), only for the given candidate pairs.
 
     Parameters
     ----------
-    avg_waveform_per_tp_flip : ndarray
-        The average waveform per time point with the x axis flipped and not flipped
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
     avg_centroid : ndarray
-        The average location for each unit
+        The average centroid for each unit
+    pairs : ndarray (n_pairs, 2)
+        The candidate pairs
     param : dict
         The param dictionary
+    unit_drift : ndarray (3, n_units), optional
+        The drift correction of each unit, see get_unit_drift(), by default None
 
     Returns
     -------
-    ndarray
-        the re-centered euclidean distance
+    ndarrays
+        The (n_pairs) distance at the peak time, the variance over time of the distance
+        and the mean re-centered distance, each minimised over flips
     """
-
     waveidx = param['waveidx']
-    n_units = param['n_units']
-    spike_width = param['spike_width']
+    is_peak = param['peak_loc'] - waveidx == 0
 
-    # recentered projected location , aka subtract the avg location, the we can unique info
-    avg_centroid_broadcast = np.tile(np.expand_dims(avg_centroid, axis= (3,4)), (1,1,1,spike_width,2))
-    avg_waveform_per_tp_fip_recenterd = np.swapaxes( np.swapaxes(avg_waveform_per_tp_flip, 2,3) - avg_centroid_broadcast,2,3)
-    x1 = np.tile( np.expand_dims(avg_waveform_per_tp_fip_recenterd[:,:,waveidx,0,:], axis = -1), (1,1,1,1,n_units)).squeeze()
-    x2 = np.swapaxes(np.tile( np.expand_dims(avg_waveform_per_tp_fip_recenterd[:,:,waveidx,1,:], axis = -1), (1,1,1,1,n_units)).squeeze(), 1, 4)
+    pos = [np.ascontiguousarray(avg_waveform_per_tp[:,:,waveidx,cv]) for cv in range(2)]
+    offset = get_flip_offsets(avg_waveform_per_tp)
 
-    w = np.isnan( np.abs(x1[0,:,:,:,:] - x2[0,:,:,:,:])).squeeze()
+    euclid_dist = np.full(len(pairs), np.nan, dtype = avg_waveform_per_tp.dtype)
+    euclid_dist_var = np.full(len(pairs), np.nan, dtype = avg_waveform_per_tp.dtype)
+    euclid_dist_rc = np.full(len(pairs), np.nan, dtype = avg_waveform_per_tp.dtype)
 
-    tmp_euclid = np.linalg.norm(x1-x2, axis = 0)
-    tmp_euclid[w] = np.nan
-    euclid_dist_2 = tmp_euclid
-    del x1
-    del x2
-    del w
-    del tmp_euclid
-    return euclid_dist_2
+    chunk = get_pair_chunk_size(17 * len(waveidx) * avg_waveform_per_tp.itemsize, param)
+    for start in range(0, len(pairs), chunk):
+        idx_1, idx_2 = pairs[start:start + chunk, 0], pairs[start:start + chunk, 1]
+        chunk_idx = slice(start, start + chunk)
+        chunk_drift = (unit_drift[:,idx_1], unit_drift[:,idx_2]) if unit_drift is not None else (None, None)
+        euclid_dist[chunk_idx], euclid_dist_var[chunk_idx], euclid_dist_rc[chunk_idx] = compare_positions(
+            pos[0][:,idx_1], pos[1][:,idx_2], avg_centroid[:,idx_1,0], avg_centroid[:,idx_2,1], 
+            offset[idx_1,0], offset[idx_2,1], is_peak, True, *chunk_drift)
 
-def recentered_metrics(euclid_dist_2):
+    return euclid_dist, euclid_dist_var, euclid_dist_rc
+
+def dist_angle_pairs(avg_waveform_per_tp_flip, pairs, param):
     """
-    Calculates the re-centered centroid distance score metric
+    The same as dist_angle(), only for the given candidate pairs.
 
     Parameters
     ----------
-    euclid_dist_2 : ndarray
-        The re-centered euclidean distance
+    avg_waveform_per_tp_flip : ndarray
+        The average waveform per time point with the x axis flipped and not flipped
+    pairs : ndarray (n_pairs, 2)
+        The candidate pairs
+    param : dict
+        The param dictionary
 
     Returns
     -------
-    ndarray
-        The centroid distance re_centered score metric
+    ndarrays
+        The (n_pairs) score arrays for the trajectory distance and angle
     """
-    centroid_dist_recentered = np.nanmin( np.nanmean(euclid_dist_2, axis =1), axis =1)
-    centroid_dist_recentered = re_scale(centroid_dist_recentered)
-    centroid_dist_recentered[np.isnan(centroid_dist_recentered)] = 0
-    return centroid_dist_recentered
+    loc_angle, traj_dist = get_trajectories(avg_waveform_per_tp_flip, param)
 
-def dist_angle(avg_waveform_per_tp_flip, param):
+    traj_angle_sim = np.full(len(pairs), np.nan, dtype = traj_dist.dtype)
+    traj_dist_sim = np.full(len(pairs), np.nan, dtype = traj_dist.dtype)
+    chunk = get_pair_chunk_size(4 * traj_dist.shape[1] * traj_dist.shape[3] * traj_dist.itemsize, param)
+    for start in range(0, len(pairs), chunk):
+        tmp_pairs = pairs[start:start + chunk]
+        angle_subtraction = np.abs(loc_angle[tmp_pairs[:,0],:,0,:] - loc_angle[tmp_pairs[:,1],:,1,:])
+        traj_angle_sim[start:start + chunk] = np.nanmin( np.nansum(angle_subtraction, axis = 1), axis = 1)
+
+        traj_dist_compared = np.abs(traj_dist[tmp_pairs[:,0],:,0,:] - traj_dist[tmp_pairs[:,1],:,1,:])
+        traj_dist_sim[start:start + chunk] = np.nanmin( np.nansum(traj_dist_compared, axis = 1), axis = 1)
+
+    traj_angle_sim = re_scale(traj_angle_sim, param)
+    traj_angle_sim[np.isnan(traj_angle_sim)] = 0
+
+    traj_dist_sim = re_scale(np.sqrt(traj_dist_sim), param)
+    traj_dist_sim[np.isnan(traj_dist_sim)] = 0
+
+    return traj_angle_sim, traj_dist_sim
+
+def pairs_to_sparse(values, pairs, param):
     """
-    This function uses the weighted average location per time point, to find metrics based of off:
-    The distance traveled by the unit at each time point
-    The angle between units at each time point 
+    Stores the scores for the scored pairs as a sparse (n_units, n_units) array, keeping the order of the pairs.
+    For (n_pairs, n_scores) values, e.g the predictors, a sparse (n_units**2, n_scores) array is made, where the row is
+    the index of the pair in the flattened (n_units, n_units) array.
 
     Parameters
     ----------
-    avg_waveform_per_tp_flip : ndarray
-        The average waveform per time point with the x axis flipped and not flipped
+    values : ndarray (n_pairs) or (n_pairs, n_scores)
+        The score for each scored pair
+    pairs : ndarray (n_pairs, 2)
+        The scored pairs
     param : dict
         The param dictionary
 
     Returns
     -------
-    ndarrays
-        The score arrays for the trajectory distance and angle
+    coo_array
+        The sparse score array
     """
-    waveidx = param['waveidx']
+    from scipy.sparse import coo_array
     n_units = param['n_units']
-    min_angle_dist = param['min_angle_dist']
-    
-    #Distance between time steps and angle
-    x1 = avg_waveform_per_tp_flip[:,:,waveidx[1]:waveidx[-1] +1,:,:]
-    x2 = avg_waveform_per_tp_flip[:,:,waveidx[0]:waveidx[-2] +1,:,:] # Difference between python and ML indexing
-
-
-
-    traj_dist = np.linalg.norm(x1-x2, axis= 0)
+    if values.ndim == 1:
+        return coo_array((values, (pairs[:,0], pairs[:,1])), shape = (n_units, n_units))
 
-    loc_angle = np.full(np.append(traj_dist.shape, 3), np.nan)
-    #only select points which have enough movement to get a angle
-    good_angle = np.zeros_like(traj_dist)
-    good_angle[traj_dist>=min_angle_dist] = 1
+    n_scores = values.shape[1]
+    pair_idx = pairs[:,0].astype(np.int64) * n_units + pairs[:,1]
+    return coo_array((values.reshape(-1), (np.repeat(pair_idx, n_scores), np.tile(np.arange(n_scores), len(pairs)))), 
+                     shape = (n_units**2, n_scores))
 
-    count_id = 0
-    for dim_id1 in range(avg_waveform_per_tp_flip.shape[0]):
-        for dim_id2 in np.arange(1,avg_waveform_per_tp_flip.shape[0]):
-            if dim_id2 <= dim_id1:
-                continue
-            ang = np.abs( x1[dim_id1,:,:,:,:] - x2[dim_id1,:,:,:,:]) / np.abs(x1[dim_id2,:,:,:,:] - x2[dim_id2,:,:,:,:])
-            
-            loc_angle[:,:,:,:,count_id] = np.arctan(ang) * good_angle # only selects angles for units where there is sufficient distance between time poitns
-            count_id +=1
+def get_pair_values(score):
+    """
+    The values of a score array for each scored pair, i.e the stored values of a sparse score array from pairs_to_sparse(),
+    or every value of a (n_units, n_units) score array. 
 
+    Parameters
+    ----------
+    score : ndarray or coo_array
+        The score array
 
-    loc_angle = np.nansum(loc_angle, axis=4)
-    x1 = np.tile (np.expand_dims(loc_angle[:,:,0,:], axis = -1), (1,1,1,n_units))
-    x2 = np.swapaxes(np.tile(np.expand_dims(loc_angle[:,:,1,:], axis = -1), (1,1,1,n_units)), 0,3)
+    Returns
+    -------
+    ndarray
+        The values of the scored pairs
+    """
+    from scipy.sparse import issparse
+    return score.data if issparse(score) else np.asarray(score)
 
+def sparse_to_dense(sparse_score, fill_value = 0):
+    """
+    Makes the full (n_units, n_units) array from a sparse score array, where all pairs which were
+    not scored are given fill_value. A dense score array is returned unchanged.
 
-    angle_subtraction = np.abs(x1-x2)
-    angle_subtraction[np.isnan(np.abs(x1 - x2))] = 2 * np.pi # make nan values punished 
+    Parameters
+    ----------
+    sparse_score : coo_array or ndarray
+        The sparse score array, from pairs_to_sparse()
+    fill_value : float, optional
+        The score given to the pairs which were not scored, by default 0
 
-    traj_angle_sim = np.nanmin( np.nansum(angle_subtraction, axis=1), axis = 1)
-    traj_angle_sim = re_scale(traj_angle_sim)
-    traj_angle_sim[np.isnan(traj_angle_sim)] = 0
+    Returns
+    -------
+    ndarray
+        The (n_units, n_units) score array
+    """
+    from scipy.sparse import issparse
+    if not issparse(sparse_score):
+        return np.asarray(sparse_score)
+    sparse_score = sparse_score.tocoo()
+    score = np.full(sparse_score.shape, fill_value, dtype = sparse_score.dtype)
+    score[sparse_score.row, sparse_score.col] = sparse_score.data
+    return score
 
-    x1 = np.tile (np.expand_dims(traj_dist[:,:,0,:], axis = -1), (1,1,1,n_units))
-    x2 = np.swapaxes(np.tile(np.expand_dims(traj_dist[:,:,1,:], axis = -1), (1,1,1,n_units)), 0,3)
 
-    traj_dist_compared = np.abs(x1-x2)
+def get_bin_idx(values, bins):
+    """
+    Finds the histogram bin of each value, using the same equally spaced bins as np.histogram, i.e bins[i] <= value < bins[i+1]
+    with the last bin also including bins[-1]. Values outside of the bins and NaN are given -1.
+    The bin is found by scaling the values, which is much faster than searching the bin edges for large arrays.
 
-    traj_dist_sim = np.nanmin( np.nansum(traj_dist_compared , axis = 1), axis= 1)
-    traj_dist_sim = np.sqrt(traj_dist_sim)
-    traj_dist_sim = re_scale(traj_dist_sim)
-    traj_dist_sim[np.isnan(traj_dist_sim)] = 0
+    Parameters
+    ----------
+    values : ndarray
+        The values to put in bins
+    bins : ndarray
+        The equally spaced bin edges, e.g param['bins']
 
-    return traj_angle_sim, traj_dist_sim
+    Returns
+    -------
+    ndarray
+        The bin index of each value, with the same shape as values
+    """
+    n_bins = len(bins) - 1
+    with np.errstate(invalid = 'ignore'):
+        scaled = values - bins[0]
+        scaled *= n_bins / (bins[-1] - bins[0])
+        bin_idx = np.floor(scaled).astype(np.int64)
+
+    #values within rounding error of a bin edge are compared to the edges
+    scaled -= bin_idx
+    edge_idx = np.flatnonzero((scaled < 1e-6) | (scaled > 1 - 1e-6))
+    bin_idx[(bin_idx < 0) | (bin_idx >= n_bins)] = -1
+
+    edge_values = values.reshape(-1)[edge_idx]
+    edge_bin_idx = np.searchsorted(bins, edge_values, side = 'right') - 1
+    edge_bin_idx[edge_values == bins[-1]] = n_bins - 1
+    edge_bin_idx[edge_bin_idx == n_bins] = -1
+    bin_idx.reshape(-1)[edge_idx] = edge_bin_idx
+    return bin_idx
+
+def get_histograms(bin_idx, groups, n_groups, n_bins, weights = None):
+    """
+    Counts the values in each bin for every group at once, with one np.bincount over the combined group and bin index.
+    Values with a bin index of -1 (see get_bin_idx()) or a group of -1 are not counted.
+    If weights are given, each value is counted with its weight.
 
+    Parameters
+    ----------
+    bin_idx : ndarray
+        The bin index of each value
+    groups : ndarray
+        The group of each value from -1 to n_groups - 1, with the same shape as bin_idx
+    n_groups : int
+        The number of groups
+    n_bins : int
+        The number of bins
+    weights : ndarray, optional
+        The weight of each value, with the same shape as bin_idx, by default None
 
-def get_threshold(total_score, within_session, euclid_dist, param, is_first_pass = True):
+    Returns
+    -------
+    ndarray (n_groups, n_bins)
+        The histogram of each group
+    """
+    #the group and bin are shifted by one, so the uncounted values are in the first row and column
+    key = groups.astype(np.int64) + 1
+    key *= n_bins + 1
+    key += bin_idx
+    key += 1
+    counts = np.bincount(key.reshape(-1), weights = None if weights is None else np.reshape(weights, -1), minlength = (n_groups + 1) * (n_bins + 1))
+    return counts.reshape(n_groups + 1, n_bins + 1)[1:, 1:]
+
+def get_threshold(total_score, session_switch, euclid_dist, param, is_first_pass = True, pairs = None):
     """
     Uses the total_score and Euclidean distance, to determine a threshold for putative matches.
 
@@ -362,62 +1271,75 @@ def get_threshold(total_score, within_session, euclid_dist, param, is_first_pass
     Total score for the matches to be smaller than expected, therefore we calculate the difference in mean
     for within and and between session to lower the threshold
 
+    The histograms of the diagonal and off-diagonal within session pairs are found in one pass, see get_histograms().
+    If pairs is given, total_score and euclid_dist are instead the values for that list of pairs, each counted with
+    its weight in param['pair_weights'] if given, see get_sample_pairs().
+
     Parameters
     ----------
     total_score : ndaray 
         The total scores for each metric
-    within_session : ndarray
-        An array marking what session each unit is in
+    session_switch : ndarray
+        An array which marks at which units a new session starts
     euclid_dist : ndarray
         The euclidean distance between each units centroid
     param : dict
         The param dictionary
     is_first_pass : bool, optional
         If it is the first pass i.e has between session drift correction been applied, by default True
+    pairs : ndarray (n_pairs, 2), optional
+        The pairs of units the (n_pairs) total_score and euclid_dist are for, by default None
 
     Returns
     -------
     float
         A threshold for matches / non-matches
     """
-    # take between session out
     score_vector = param['score_vector']
     Bins = param['bins']
 
-    tmp = total_score.copy()
-    tmp[euclid_dist > param['neighbour_dist'] ] = np.nan
-
-    tmp[within_session == 1] = np.nan
-
-    hd, __ = np.histogram(np.diag(tmp), Bins)
-    hd = hd /  param['n_units']
-    hnd, __ = np.histogram( (tmp - tmp *np.eye(param['n_units'])), Bins)
-    hnd = hnd / np.nansum( (tmp - tmp *np.eye(param['n_units'])) )
-    hp, __ = np.histogram(tmp, Bins)
-    hp = hp / np.nansum(tmp)
+    # 0 the diagonal, 1 other pairs in the same session, 2 pairs in different sessions and -1 for pairs further apart than neighbour_dist
+    weights = None
+    if pairs is None:
+        n_diag = param['n_units']
+        groups = np.full(total_score.shape, 2, dtype = np.int8)
+        for session in util.get_session_blocks(session_switch):
+            groups[session, session] = 1
+        np.fill_diagonal(groups, 0)
+        groups[euclid_dist > param['neighbour_dist']] = -1
+        n_valid_diag = np.sum((np.diag(groups) == 0) * ~np.isnan(np.diag(total_score)))
+    else:
+        is_diag = pairs[:,0] == pairs[:,1]
+        n_diag = np.count_nonzero(is_diag)
+        session_id = np.searchsorted(session_switch, pairs, side = 'right') - 1
+        groups = np.where(session_id[:,0] == session_id[:,1], 1, 2).astype(np.int8)
+        groups[is_diag] = 0
+        groups[euclid_dist > param['neighbour_dist']] = -1
+        n_valid_diag = np.count_nonzero((groups == 0) & ~np.isnan(total_score))
+        weights = param.get('pair_weights')
+        if weights is not None and np.size(weights) != len(pairs):
+            weights = None
+
+    hist = get_histograms(get_bin_idx(total_score, Bins), groups, 3, len(Bins) - 1, weights)
+
+    hd = hist[0] / n_diag
+    # the diagonal is counted as a score of 0 in the off-diagonal histogram
+    hnd = hist[1].copy()
+    hnd[0] += n_valid_diag
+    hnd = hnd / np.nansum(total_score if weights is None else total_score * weights, where = groups == 1)
 
     thrs_opt = score_vector[np.argwhere( (pf.smooth(hd,3) > pf.smooth(hnd,3) ) * (score_vector > 0.6) == True)][0]
     # if ThrsOpt.size == 0:
     #     ThrsOpt = 0.6 # give default threshold if above doestn return value
-    # fit tmp to a normal ditn
-    fit = tmp[ ~np.isnan(tmp) * (tmp < thrs_opt)]
-    muw = np.mean(fit)
-    stdw = np.std(fit)
+    # fit the within session scores to a normal ditn
+    is_fit = ((groups == 0) | (groups == 1)) * (total_score < thrs_opt)
+    muw = np.average(total_score[is_fit], weights = None if weights is None else weights[is_fit]) if np.any(is_fit) else np.nan
 
     if param['n_sessions'] > 1:
         if is_first_pass == True:
-            # take within session out
-
-            tmp = total_score.copy()
-            tmp[euclid_dist > param['neighbour_dist'] ] = np.nan
-
-            tmp[within_session == 0] = np.nan
-
-            ha, __ = np.histogram(tmp, Bins)
-            ha = ha / np.nansum(tmp)
-            fit = tmp[ ~np.isnan(tmp) * (tmp < thrs_opt)]
-            mua = np.mean(fit)
-            stda = np.std(fit)
+            # the between session scores
+            is_fit = (groups == 2) * (total_score < thrs_opt)
+            mua = np.average(total_score[is_fit], weights = None if weights is None else weights[is_fit]) if np.any(is_fit) else np.nan
 
 
             # for first pass only (i.e before drift correction)
@@ -439,38 +1361,27 @@ def get_good_matches(pairs, total_score):
     pairs : ndarray
         A list of matches
     total_score : ndarray
-        The total score array, the sum of all of the individual metric arrays
+        The total score array, the sum of all of the individual metric arrays, or the (n_pairs) total score of each given pair
 
     Returns
     -------
     ndarray
         A list of matches where each unit appears once
     """
+    scores = total_score if total_score.ndim == 1 else total_score[pairs[:,0], pairs[:,1]]
+    keep = np.ones(len(pairs), dtype = bool)
+
     # Need to make sure the first and second unit in the matches only appears once
     for pair_id in range(2):
+        idx = np.flatnonzero(keep)
+        #sort by unit then by decreasing score, the sort is stable so for equal scores the first pair is the best as with argmax
+        order = idx[np.lexsort((-scores[idx], pairs[idx, pair_id]))]
+        #the best match is the first pair of each unit, the worse matches are removed
+        is_first = np.ones(len(order), dtype = bool)
+        is_first[1:] = pairs[order[1:], pair_id] != pairs[order[:-1], pair_id]
+        keep[order[~is_first]] = False
 
-        idx, count = np.unique(pairs[:,pair_id], return_counts = True)
-        ls = np.argwhere(count != 1)
-        tmp_vals = idx[ls] # returns the unit idx for PairID, where there is more than one potential match
-
-        #Go through each case where there is more than 1 match
-        for i in range(len(tmp_vals)):
-            # find the unit idx pair, e.g if unit 2 matches with unit 272 and 278 this will find (2,272) then (2,278)
-            tmp_pair = np.argwhere(pairs[:,pair_id] == tmp_vals[i]) # idx of pair for the multiple matched unit
-            tmp = pairs[tmp_pair,:].squeeze() # unit idx pair, for each double match e.g (2,272) and (2,278)
-
-            scores = np.zeros(len(tmp))
-            for z in range(len(tmp)):
-                scores[z] = total_score[tmp[z,0], tmp[z,1]] #Get their score
-
-            best_match = np.argmax(scores)
-            #set the worse matches to -1
-            for z in range(len(tmp)):
-                if z != best_match:
-                    # cannot remove yet, as it will change all of the found indices, so set the value to -1, the at the end can remove all apperaances of -1
-                    pairs[tmp_pair[z], :] = np.full_like(pairs[tmp_pair[z], :], -1)
-    
-    good_pairs = np.delete(pairs, np.argwhere(pairs[:,0] == -1), axis = 0)
+    good_pairs = pairs[keep]
 
     return good_pairs
    
@@ -517,6 +1428,24 @@ def drift_correction_basic(candidate_pairs, session_switch, avg_centroid, avg_wa
 
     return drift, avg_centroid, avg_waveform_per_tp
 
+def get_drift_basic(pairs, avg_centroid):
+    """
+    Finds the drift between a pair of sessions, as the median difference in position of the putative matches
+
+    Parameters
+    ----------
+    pairs : ndarray
+        A list of potential matches, from the first to the second session
+    avg_centroid : ndarray
+        The average centroid for each unit
+
+    Returns
+    -------
+    ndarray
+        The (3) drift to add to the second session
+    """
+    return np.nanmedian( np.nanmean( avg_centroid[:, pairs[:,0],:], axis = 2) - np.nanmean( avg_centroid[:,pairs[:,1],:], axis = 2), axis = 1)
+
 def apply_drift_correction_basic(pairs, sid, session_switch, avg_centroid, avg_waveform_per_tp):
     """
     This function applies the basic style drift correction to a pair of sessions, as part of a n_session drift correction  
@@ -540,7 +1469,7 @@ def apply_drift_correction_basic(pairs, sid, session_switch, avg_centroid, avg_w
         The array of drift correction values, the avg_centroid and avg_waveform_per_tp updated with the drift correction, for all sessions
     """
 
-    drift = np.nanmedian( np.nanmean( avg_centroid[:, pairs[:,0],:], axis = 2) - np.nanmean( avg_centroid[:,pairs[:,1],:], axis = 2), axis = 1)
+    drift = get_drift_basic(pairs, avg_centroid)
 
 
     ##need to add the drift to the location
@@ -554,9 +1483,10 @@ def apply_drift_correction_basic(pairs, sid, session_switch, avg_centroid, avg_w
 
     return drift, avg_waveform_per_tp, avg_centroid
 
-def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, avg_waveform_per_tp, param):
+def get_drift_per_shank(pairs, sid, session_switch, avg_centroid, param):
     """
-    This is the same as "basic" drift correction, however treats each shank separately, if there is enough units per shank
+    Finds the drift for each shank, as the median difference in position of the putative matches on that shank,
+    see apply_drift_correction_per_shank()
 
     Parameters
     ----------
@@ -568,13 +1498,13 @@ def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, a
         What units does the session switch
     avg_centroid : ndarray
         The average centroid for each unit
-    avg_waveform_per_tp : ndarray
-        The average waveform per time point for each unit
+    param : dict
+        The param dictionary
 
     Returns
     -------
-    ndarray, ndarray, ndarray
-        The array of drift correction values, the avg_centroid and avg_waveform_per_tp updated with the drift correction, for all sessions
+    ndarray, list
+        The (n_shanks, 3) drift of each shank, and the idx of the units the drift of each shank is added to
     """
     shank_id = shank_ID_per_session(avg_centroid ,session_switch ,sid , param)
     n_shanks = param['no_shanks']
@@ -587,6 +1517,7 @@ def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, a
     max_dist = 0
     min_dist = 0
     drift_per_shank = np.zeros([n_shanks,3])
+    shank_units = []
 
     for i in range(n_shanks):
         max_dist += shank_dist #beginning of loop shift maximum distance
@@ -608,9 +1539,37 @@ def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, a
         drift_per_shank[i,:] = drift
 
         #need to get idx for each shank, to apply correct drift correction
+        shank_units.append(session_switch[sid] + np.flatnonzero( shank_id == i))
+
+        min_dist += shank_dist
+
+    return drift_per_shank, shank_units
+
+def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, avg_waveform_per_tp, param):
+    """
+    This is the same as "basic" drift correction, however treats each shank separately, if there is enough units per shank
+
+    Parameters
+    ----------
+    pairs : ndarray
+        A list of potential matches
+    sid : int
+        The session id
+    session_switch : ndarray
+        What units does the session switch
+    avg_centroid : ndarray
+        The average centroid for each unit
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point for each unit
 
-        shank_session_idx = session_switch[sid] + np.argwhere( shank_id == i) 
+    Returns
+    -------
+    ndarray, ndarray, ndarray
+        The array of drift correction values, the avg_centroid and avg_waveform_per_tp updated with the drift correction, for all sessions
+    """
+    drift_per_shank, shank_units = get_drift_per_shank(pairs, sid, session_switch, avg_centroid, param)
 
+    for drift, shank_session_idx in zip(drift_per_shank, shank_units):
         avg_waveform_per_tp[0,shank_session_idx,:,:] += drift[0]
         avg_waveform_per_tp[1,shank_session_idx,:,:] += drift[1]
         avg_waveform_per_tp[2,shank_session_idx,:,:] += drift[2]
@@ -619,8 +1578,6 @@ def apply_drift_correction_per_shank(pairs, sid, session_switch, avg_centroid, a
         avg_centroid[1,shank_session_idx,:] += drift[1]
         avg_centroid[2,shank_session_idx,:] += drift[2]
 
-        min_dist += shank_dist
-
     return drift_per_shank, avg_waveform_per_tp, avg_centroid
 
 def shank_ID_per_session(avg_centroid ,session_switch ,sid , param):
@@ -643,14 +1600,30 @@ def shank_ID_per_session(avg_centroid ,session_switch ,sid , param):
     ndarray
         An array assigning each unit to a shank
     """
+    return get_shank_id(avg_centroid[:, session_switch[sid]:session_switch[sid + 1]], param)
+
+def get_shank_id(avg_centroid, param):
+    """
+    This function use the average centroid, to assign each unit to a shank
 
+    Parameters
+    ----------
+    avg_centroid : ndarray
+        The average centroid for each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    ndarray
+        An array assigning each unit to a shank
+    """
     n_shanks = param['no_shanks']
     shank_dist = param['shank_dist']
     max_dist = 0
     min_dist = 0
 
-    #load centroid position for 1 recording session
-    centroid_pos = np.nanmean( avg_centroid[:, session_switch[sid]:session_switch[sid + 1],:], axis = 2)
+    centroid_pos = np.nanmean(avg_centroid, axis = 2)
     shank_id = np.zeros(centroid_pos.shape[1])
 
     #goes through each shank and assigns a unit a shank id depending on the area they are in
@@ -726,12 +1699,12 @@ def test_matches_per_shank(pairs, avg_centroid, sid, param):
     return do_per_shank_correction
 
 
-def drift_n_sessions(candidate_pairs, session_switch, avg_centroid, avg_waveform_per_tp, total_score, param, best_match = True, best_drift = True):
+def get_unit_drift(candidate_pairs, session_switch, avg_centroid, total_score, param, best_match = True, best_drift = True, pairs = None):
     """
-    This function applies drift correction between n_sessions, currently this is done by aligning session 2 to session 1,
-    then session 3 to session 2 etc.   
-    This function, calls another function to apply the drift correction, to be able to apply different type of drift correction 
-    easily.
+    Finds the drift correction between n_sessions, by aligning session 2 to session 1, then session 3 to session 2 etc.
+    The drift is returned as how much each unit should be moved, which the distance functions add on the fly, see
+    compare_positions(), so the average waveform per time point is never re-written.
+    If pairs is given, candidate_pairs and total_score are instead the values for that list of pairs.
 
     Parameters
     ----------
@@ -740,9 +1713,7 @@ def drift_n_sessions(candidate_pairs, session_switch, avg_centroid, avg_waveform
     session_switch : ndarray
         What units does the session switch
     avg_centroid : ndarray
-        The average centroid for each unit
-    avg_waveform_per_tp : ndarray
-        The average waveform per time point for each unit
+        The average centroid for each unit, without drift correction
     total_score : ndarray
         The summed array for each individual metric
     param : dict
@@ -751,38 +1722,106 @@ def drift_n_sessions(candidate_pairs, session_switch, avg_centroid, avg_waveform
         If True will only consider the best match for each unit, by default True
     best_drift : bool, optional
         If True will do per shank drift correction if there is sufficient units by default True
+    pairs : ndarray (n_pairs, 2), optional
+        The pairs of units the (n_pairs) candidate_pairs and total_score are for, by default None
 
     Returns
     -------
-    ndarray, ndarray, ndarray
-        The drift values, the avg_centroid and the avg_waveform_per_tp arrays drift corrected
+    ndarray, ndarray
+        The drift values, and the (3, n_units) drift correction of each unit
     """
     n_sessions = param['n_sessions']
-    best_pairs = np.argwhere(candidate_pairs == 1)
+    if pairs is None:
+        best_pairs = np.argwhere(candidate_pairs == 1)
+    else:
+        best_pairs = pairs[candidate_pairs == 1]
+        total_score = total_score[candidate_pairs == 1]
 
     #make it like the matlab code, (small unit idx, larger unit idx)
     best_pairs[:, [0,1]] = best_pairs[:, [1,0]]
 
     drifts = np.zeros( (n_sessions - 1, 3))
+    unit_drift = np.zeros((3, avg_centroid.shape[1]), dtype = avg_centroid.dtype)
 
     for did in range(n_sessions - 1):
             idx = np.argwhere( ( (best_pairs[:,0] >= session_switch[did]) * (best_pairs[:,0] < session_switch[did + 1]) *
                                 (best_pairs[:,1] >= session_switch[did + 1]) * (best_pairs[:,1] < session_switch[did + 2]) ) == True)
 
-            pairs = best_pairs[idx,:].squeeze()
+            session_pairs = best_pairs[idx,:].squeeze()
             if best_match == True:
-                pairs = get_good_matches(pairs, total_score)
+                session_pairs = get_good_matches(session_pairs, total_score if pairs is None else total_score[idx[:,0]])
+
+            #the centroids with the drift correction of the previous session pairs
+            drift_centroid = avg_centroid + unit_drift[:,:,np.newaxis]
 
             #Test to see if there are enough matches to do drift correction per shank
-            if test_matches_per_shank(pairs, avg_centroid, did, param) == True and best_drift == True:
+            if test_matches_per_shank(session_pairs, drift_centroid, did, param) == True and best_drift == True:
                 drifts = np.zeros( (n_sessions - 1, param['no_shanks'], 3))
-                drifts[did,:,:], avg_waveform_per_tp, avg_centroid = apply_drift_correction_per_shank(pairs, did, session_switch, avg_centroid, avg_waveform_per_tp, param)
+                drifts[did,:,:], shank_units = get_drift_per_shank(session_pairs, did, session_switch, drift_centroid, param)
+                for drift, shank_session_idx in zip(drifts[did], shank_units):
+                    unit_drift[:,shank_session_idx] += drift[:,np.newaxis]
                 print(f'Done drift correction per shank for session pair {did+1} and {did+2}')
-            elif len(pairs)>0: #if there exist pairs across sessions:
+            elif len(session_pairs)>0: #if there exist pairs across sessions:
                 drifts = np.zeros( (n_sessions - 1, 3))
-                drifts[did,:], avg_waveform_per_tp, avg_centroid = apply_drift_correction_basic(pairs, did, session_switch, avg_centroid, avg_waveform_per_tp)
-            elif len(pairs)==0:
+                drifts[did,:] = get_drift_basic(session_pairs, drift_centroid)
+                unit_drift[:,session_switch[did+1]:session_switch[did+2]] += drifts[did,:,np.newaxis]
+            elif len(session_pairs)==0:
                 print('No pairs across sessions to perform drift correction.')
+    return drifts, unit_drift
+
+def apply_unit_drift(array, unit_drift):
+    """
+    Adds the drift correction of each unit to a position array, such as avg_centroid or avg_waveform_per_tp
+
+    Parameters
+    ----------
+    array : ndarray (3, n_units, ...)
+        The positions of each unit
+    unit_drift : ndarray (3, n_units)
+        The drift correction of each unit, see get_unit_drift()
+
+    Returns
+    -------
+    ndarray
+        A drift corrected copy of the array
+    """
+    return array + unit_drift.reshape(unit_drift.shape + (1,) * (array.ndim - 2)).astype(array.dtype)
+
+def drift_n_sessions(candidate_pairs, session_switch, avg_centroid, avg_waveform_per_tp, total_score, param, best_match = True, best_drift = True):
+    """
+    This function applies drift correction between n_sessions, currently this is done by aligning session 2 to session 1,
+    then session 3 to session 2 etc.   
+    The drift is found by get_unit_drift() and added to avg_centroid and avg_waveform_per_tp in place,
+    extract_metric_scores() uses get_unit_drift() directly so the arrays are not re-written.
+
+    Parameters
+    ----------
+    candidate_pairs : ndarray
+        An array of likely matches
+    session_switch : ndarray
+        What units does the session switch
+    avg_centroid : ndarray
+        The average centroid for each unit
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point for each unit
+    total_score : ndarray
+        The summed array for each individual metric
+    param : dict
+        The param dictionary
+    best_match : bool, optional
+        If True will only consider the best match for each unit, by default True
+    best_drift : bool, optional
+        If True will do per shank drift correction if there is sufficient units by default True
+
+    Returns
+    -------
+    ndarray, ndarray, ndarray
+        The drift values, the avg_centroid and the avg_waveform_per_tp arrays drift corrected
+    """
+    drifts, unit_drift = get_unit_drift(candidate_pairs, session_switch, avg_centroid, total_score, param, best_match, best_drift)
+
+    avg_centroid += unit_drift[:,:,np.newaxis]
+    avg_waveform_per_tp += unit_drift[:,:,np.newaxis,np.newaxis]
     return drifts, avg_centroid, avg_waveform_per_tp
 
 
@@ -804,14 +1843,17 @@ def get_total_score(scores_to_include, param):
     ndarray
         The total scores for each unit, and the array version of scores_to_include
     """
-    total_score = np.zeros((param['n_units'],param['n_units']))
-    predictors =  np.zeros((param['n_units'],param['n_units'], 0))
+    dtype = param.get('dtype', 'float64')
+    #the scores are (n_units, n_units), or (n_pairs) when scoring a list of pairs
+    shape = np.shape(next(iter(scores_to_include.values())))
+    total_score = np.zeros(shape, dtype = dtype)
+    predictors =  np.zeros(shape + (0,), dtype = dtype)
 
 
     for sid in scores_to_include:
         tmp = scores_to_include[f'{sid}']
-        predictors = np.concatenate((predictors, np.expand_dims(tmp, axis = 2)), axis = 2)
-        total_score += tmp
+        predictors = np.concatenate((predictors, np.expand_dims(tmp, axis = -1)), axis = -1)
+        total_score += np.nan_to_num(tmp) # NaN scores are pairs which were not scored, see param['sparse_scores']
 
     total_score = (total_score - np.min(total_score)) / (np.max(total_score) - np.min(total_score))
 
@@ -1,10 +1,62 @@
 import UnitMatchPy.param_functions as pf
 import UnitMatchPy.metric_functions as mf
+import UnitMatchPy.utils as util
+import UnitMatchPy.bayes_functions as bf
+import UnitMatchPy.save_utils as su
+import UnitMatchPy.assign_unique_id as aid
 import numpy as np
+import os
+import time
+from functools import partial
+from joblib import Parallel, delayed, effective_n_jobs
+
+# the axis of each extracted wave property which indexes the units
+UNIT_AXIS = {'spatial_decay_fit' : 0, 'spatial_decay' : 0, 'avg_centroid' : 1, 'waveform_duration' : 0, 'avg_waveform_per_tp' : 1,
+             'good_wave_idxs' : 0, 'amplitude' : 0, 'avg_waveform' : 1, 'max_site' : 0, 'max_site_mean' : 0}
+
+# The metrics run by extract_metric_scores. Each metric gives the function called as function(*inputs, param = param),
+# the extracted wave properties it uses, the names of the (n_units, n_units) arrays it returns, whether it needs recalculating
+# after drift correction, and a rough relative cost so the slowest are started first.
+# Metrics marked candidate_pairs are calculated by get_location_pair_scores() instead when scoring a list of pairs, see get_pair_scores().
+# The pair_function gives the same scores for a list of pairs, as pair_function(*inputs, pairs, param = param), see get_pair_scores().
+# The centroid metrics are built into extract_metric_scores, as they are partly reused after drift correction.
+METRICS = {'amp' : {'function' : mf.get_simple_metric, 'inputs' : ['amplitude'], 'outputs' : ['amp_score'], 'drift' : False, 'cost' : 1,
+                    'pair_function' : mf.get_simple_metric_pairs},
+           'spatial_decay' : {'function' : mf.get_simple_metric, 'inputs' : ['spatial_decay'], 'outputs' : ['spatial_decay_score'], 'drift' : False, 'cost' : 1,
+                              'pair_function' : mf.get_simple_metric_pairs},
+           'wave_corr' : {'function' : mf.get_wave_corr, 'inputs' : ['avg_waveform'], 'outputs' : ['wave_corr_score'], 'drift' : False, 'cost' : 2,
+                          'pair_function' : mf.get_wave_corr_pairs},
+           'wave_mse' : {'function' : mf.get_waveforms_mse, 'inputs' : ['avg_waveform'], 'outputs' : ['wave_mse_score'], 'drift' : False, 'cost' : 2,
+                         'pair_function' : mf.get_waveforms_mse_pairs},
+           'trajectory' : {'function' : mf.get_trajectory_scores, 'inputs' : ['avg_waveform_per_tp'], 'outputs' : ['traj_angle_score', 'traj_dist_score'],
+                           'drift' : False, 'cost' : 10, 'candidate_pairs' : True}}
+CENTROID_METRICS_COST = 50
+
+# the extracted wave properties which are positions, so are drift corrected for metrics which are recalculated after drift correction
+DRIFT_PROPERTIES = ['avg_centroid', 'avg_waveform_per_tp']
+
+# The scores used to find matches, each is the mean of the listed metric outputs
+SCORES = {'amp_score' : ['amp_score'], 'spatial_decay_score' : ['spatial_decay_score'], 
+          'centroid_overlord_score' : ['centroid_dist_recentered', 'centroid_var'], 'centroid_dist' : ['centroid_dist'],
+          'waveform_score' : ['wave_corr_score', 'wave_mse_score'], 'trajectory_score' : ['traj_angle_score', 'traj_dist_score']}
+
+# The stages run by run_unit_match(), in order, and the outputs of each stage which are checkpointed to the run directory
+RUN_STAGES = {'load_waveforms' : ['wave_paths', 'unit_label_paths', 'channel_pos', 'waveform', 'clus_info'],
+              'extract_parameters' : ['extracted_wave_properties'],
+              'extract_metric_scores' : ['total_score', 'candidate_pairs', 'scores_to_include', 'predictors', 'extracted_wave_properties'],
+              'get_parameter_kernels' : ['parameter_kernels', 'priors', 'cond'],
+              'apply_naive_bayes' : ['output_prob_matrix'],
+              'assign_unique_id' : ['UIDs'],
+              'save_to_output' : ['matches']}
 
 def extract_parameters(waveform, channel_pos, clus_info, param):
     """
-    This function runs all of the extract parameters functions needed to run UnitMatch
+    This function runs all of the extract parameters functions needed to run UnitMatch.
+    If param['stage_cache_dir'] is given, the outputs are loaded from there if this stage has already been run on the
+    same inputs, see extract_parameters_stage_cached()
+    If param['cache_dirs'] is given, only units which are not in the cache are extracted, see extract_parameters_cached()
+    If param['n_jobs'] is not 1, the units are split into blocks of param['block_size'] units which are
+    processed in parallel, see extract_parameters_parallel()
 
     Parameters
     ----------
@@ -22,15 +74,29 @@ def extract_parameters(waveform, channel_pos, clus_info, param):
     dict
         The extracted waveform properties as a dictionary of arrays
     """
-    waveform = pf.detrend_waveform(waveform)
+    if param.get('stage_cache_dir') is not None:
+        return extract_parameters_stage_cached(waveform, channel_pos, clus_info, param)
+
+    util.plan_memory('extract_parameters', param, n_channels = waveform.shape[2])
+
+    if param.get('cache_dirs') is not None:
+        return extract_parameters_cached(waveform, channel_pos, clus_info, param)
+    if param.get('n_jobs', 1) != 1:
+        return extract_parameters_parallel(waveform, channel_pos, clus_info, param)
+
+    waveform = pf.detrend_waveform(waveform.astype(param.get('dtype', 'float64'), copy = False))
 
     max_site, good_idx, good_pos, max_site_mean = pf.get_max_sites(waveform, channel_pos, clus_info, param)
 
-    spatial_decay_fit , spatial_decay,  d_10, avg_centroid, avg_waveform, peak_time = pf.decay_and_average_waveform(waveform, channel_pos, good_idx, max_site, max_site_mean, clus_info, param)
+    #only the channels near each unit are used from here on
+    neighbour_channels, neighbour_pos = pf.get_neighbour_channels(good_idx, channel_pos, clus_info)
+    waveform = pf.crop_to_neighbours(waveform, neighbour_channels)
+
+    spatial_decay_fit , spatial_decay,  d_10, avg_centroid, avg_waveform, peak_time = pf.decay_and_average_waveform(waveform, channel_pos, neighbour_pos, max_site, max_site_mean, clus_info, param)
 
     amplitude, waveform, avg_waveform = pf.get_amplitude_shift_waveform(waveform, avg_waveform, peak_time, param)
 
-    waveform_duration, avg_waveform_per_tp, good_wave_idxs = pf.get_avg_waveform_per_tp(waveform,channel_pos, d_10, max_site_mean, amplitude, avg_waveform, clus_info, param)
+    waveform_duration, avg_waveform_per_tp, good_wave_idxs = pf.get_avg_waveform_per_tp(waveform, channel_pos, neighbour_pos, d_10, max_site_mean, amplitude, avg_waveform, clus_info, param)
 
     extracted_wave_properties = {'spatial_decay_fit' : spatial_decay_fit, 'spatial_decay' : spatial_decay , 'avg_centroid' : avg_centroid,
                                 'waveform_duration' : waveform_duration, 'avg_waveform_per_tp' : avg_waveform_per_tp, 'good_wave_idxs' : good_wave_idxs,
@@ -38,10 +104,241 @@ def extract_parameters(waveform, channel_pos, clus_info, param):
     
     return extracted_wave_properties
 
+def extract_parameters_block(waveform, unit_idxs, channel_pos, clus_info, param):
+    """
+    Runs extract_parameters() on a block of units, this is the job each worker runs in extract_parameters_parallel()
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, 2)
+        The average waveforms for ALL units, this can be a read-only memmap
+    unit_idxs : ndarray
+        The indices of the units in this block
+    channel_pos : list
+        The complete channel positions for each session
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    dict
+        The extracted waveform properties for the units in this block
+    """
+    block_clus_info, block_param = subset_units(clus_info, param, unit_idxs)
+    block_param['n_jobs'] = 1
+
+    #only copy the units in this block into the workers memory
+    block_waveform = np.array(waveform[unit_idxs[0]:unit_idxs[-1] + 1])
+
+    return extract_parameters(block_waveform, channel_pos, block_clus_info, block_param)
+
+def subset_units(clus_info, param, unit_idxs):
+    """
+    Makes copies of clus_info and param which describe only a subset of the units
+
+    Parameters
+    ----------
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+    unit_idxs : ndarray
+        The indices of the units in the subset
+
+    Returns
+    -------
+    dict, dict
+        The clus_info and param dictionaries for the subset of units
+    """
+    sub_clus_info = clus_info.copy()
+    sub_clus_info['session_id'] = clus_info['session_id'][unit_idxs]
+
+    sub_param = param.copy()
+    sub_param['n_units'] = len(unit_idxs)
+    return sub_clus_info, sub_param
+
+def merge_wave_properties(block_properties):
+    """
+    Merges a list of extracted wave properties dictionaries, each for a different set of units, 
+    into one extracted wave properties dictionary
+
+    Parameters
+    ----------
+    block_properties : list
+        A list of extracted wave properties dictionaries, in the order of the units
+
+    Returns
+    -------
+    dict
+        The extracted waveform properties as a dictionary of arrays
+    """
+    extracted_wave_properties = {}
+    for key, axis in UNIT_AXIS.items():
+        extracted_wave_properties[key] = np.concatenate([block[key] for block in block_properties], axis = axis)
+    return extracted_wave_properties
+
+def get_unit_properties(extracted_wave_properties, unit_idx):
+    """
+    Selects the extracted wave properties of a single unit
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted waveform properties as a dictionary of arrays
+    unit_idx : int
+        The index of the unit
+
+    Returns
+    -------
+    dict
+        The extracted wave properties for the unit, keeping the unit axis with length 1
+    """
+    return subset_wave_properties(extracted_wave_properties, [unit_idx])
+
+def subset_wave_properties(extracted_wave_properties, unit_idxs):
+    """
+    Selects the extracted wave properties of a subset of the units
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted waveform properties as a dictionary of arrays
+    unit_idxs : ndarray
+        The indices of the units in the subset
+
+    Returns
+    -------
+    dict
+        The extracted wave properties for the subset of units
+    """
+    sub_properties = {}
+    for key, axis in UNIT_AXIS.items():
+        sub_properties[key] = np.take(extracted_wave_properties[key], unit_idxs, axis = axis)
+    return sub_properties
+
+def extract_parameters_cached(waveform, channel_pos, clus_info, param):
+    """
+    Runs extract_parameters() using a per unit cache saved in param['cache_dirs'] (one directory per session, 
+    see util.get_cache_dirs()).
+    Each unit is saved with a key made from a hash of its raw waveform, channel positions and the param values
+    in util.EXTRACT_PARAM_KEYS, so only units which have not been seen with the same settings are extracted.
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, 2)
+        The average waveforms needed for UnitMatch
+    channel_pos : list
+        The complete channel positions for each session
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    dict
+        The extracted waveform properties as a dictionary of arrays
+    """
+    session_id = clus_info['session_id']
+    cache_dirs = param['cache_dirs']
+    keys = util.get_unit_cache_keys(waveform, channel_pos, session_id, param)
+
+    unit_properties = []
+    for i, key in enumerate(keys):
+        unit_properties.append(util.load_cached_unit(cache_dirs[session_id[i]], key))
+
+    miss_idxs = np.array([i for i, props in enumerate(unit_properties) if props is None], dtype = int)
+    print(f'Found {len(keys) - len(miss_idxs)} of {len(keys)} units in the cache')
+
+    if len(miss_idxs) > 0:
+        miss_clus_info, miss_param = subset_units(clus_info, param, miss_idxs)
+        miss_param['cache_dirs'] = None
+        miss_properties = extract_parameters(waveform[miss_idxs], channel_pos, miss_clus_info, miss_param)
+
+        for j, i in enumerate(miss_idxs):
+            unit_properties[i] = get_unit_properties(miss_properties, j)
+            util.save_cached_unit(cache_dirs[session_id[i]], keys[i], unit_properties[i])
+
+    return merge_wave_properties(unit_properties)
+
+def extract_parameters_stage_cached(waveform, channel_pos, clus_info, param):
+    """
+    Runs extract_parameters() using the stage cache in param['stage_cache_dir'].
+    The outputs are saved with a key made from a hash of the waveforms, channel positions, clus_info and the param
+    values in util.STAGE_PARAM_KEYS, and are loaded as memory mapped arrays when the key is already in the cache.
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, 2)
+        The average waveforms needed for UnitMatch
+    channel_pos : list
+        The complete channel positions for each session
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    dict
+        The extracted waveform properties as a dictionary of arrays
+    """
+    stage_cache_dir = param['stage_cache_dir']
+    key = util.get_stage_cache_key('extract_parameters', [waveform, channel_pos, clus_info], param)
+
+    extracted_wave_properties = util.load_cached_stage(stage_cache_dir, 'extract_parameters', key)
+    if extracted_wave_properties is None:
+        extracted_wave_properties = extract_parameters(waveform, channel_pos, clus_info, param | {'stage_cache_dir' : None})
+        util.save_cached_stage(stage_cache_dir, 'extract_parameters', key, extracted_wave_properties)
+
+    return extracted_wave_properties
+
+def extract_parameters_parallel(waveform, channel_pos, clus_info, param):
+    """
+    Runs extract_parameters() with the units split into blocks, which are processed by a pool of worker processes.
+    The waveform array is shared with the workers as a read-only memmap, so each worker only reads the units 
+    in its block instead of receiving a pickled copy of all of the waveforms.
+    Uses param['n_jobs'] workers (-1 for all cores) and param['block_size'] units per block.
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, 2)
+        The average waveforms needed for UnitMatch
+    channel_pos : list
+        The complete channel positions for each session
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    dict
+        The extracted waveform properties as a dictionary of arrays
+    """
+    n_units = param['n_units']
+    block_size = param.get('block_size', 100)
+
+    blocks = [np.arange(start, min(start + block_size, n_units)) for start in range(0, n_units, block_size)]
+
+    # arrays larger than max_nbytes are dumped once to a memmap, which all of the workers read from
+    block_properties = Parallel(n_jobs = param['n_jobs'], max_nbytes = '1M', mmap_mode = 'r')(
+        delayed(extract_parameters_block)(waveform, unit_idxs, channel_pos, clus_info, param) for unit_idxs in blocks)
+
+    return merge_wave_properties(block_properties)
+
 def extract_metric_scores(extracted_wave_properties, session_switch, within_session, param, niter  = 2):
     """
     This function runs all of the metric calculations and drift correction to calculate the probability
     distribution needed for UnitMatch.
+    The metrics in METRICS are run at the same time on param['n_jobs'] threads, see run_metrics(), and are
+    combined into the scores given by SCORES. Use register_score() to add a custom score.
+    If param['stage_cache_dir'] is given, the outputs are loaded from there if this stage has already been run on the
+    same inputs, see extract_metric_scores_stage_cached()
+    If param['sparse_scores'] is True, only the pairs which could be a match and a sample of the other pairs are scored,
+    see extract_metric_scores_sparse()
 
     Parameters
     ----------
@@ -50,7 +347,7 @@ def extract_metric_scores(extracted_wave_properties, session_switch, within_sess
     session_switch : ndarray
         An array which indicates when anew recording session starts
     within_session : ndarray
-        The array which gives each unit a label depending on their session
+        Not used, the sessions are found from session_switch
     param : dict
         The param dictionary
     niter : int, optional
@@ -63,68 +360,1053 @@ def extract_metric_scores(extracted_wave_properties, session_switch, within_sess
         The total scores and candidate pairs needed for probability analysis
     """
 
-    #unpack need arrays from the ExtractedWaveProperties dictionary
-    amplitude = extracted_wave_properties['amplitude']
-    spatial_decay = extracted_wave_properties['spatial_decay']
-    spatial_decay_fit = extracted_wave_properties['spatial_decay_fit']
-    avg_waveform = extracted_wave_properties['avg_waveform']
-    avg_waveform_per_tp = extracted_wave_properties['avg_waveform_per_tp']
-    avg_centroid = extracted_wave_properties['avg_centroid']
+    if param.get('stage_cache_dir') is not None:
+        return extract_metric_scores_stage_cached(extracted_wave_properties, session_switch, within_session, param, niter)
+    if param.get('sparse_scores', False):
+        return extract_metric_scores_sparse(extracted_wave_properties, session_switch, param, niter)
 
-    #These scores are NOT effected by the drift correction
-    amp_score = mf.get_simple_metric(amplitude)
-    spatial_decay_score = mf.get_simple_metric(spatial_decay)
-    spatial_decay_fit_score = mf.get_simple_metric(spatial_decay_fit, outlier = True)
-    wave_corr_score = mf.get_wave_corr(avg_waveform, param)
-    wave_mse_score = mf.get_waveforms_mse(avg_waveform, param)
+    #the temporary tiles of the metrics are limited so they fit alongside this stage's arrays
+    metric_param = param | {'memory_limit' : util.plan_memory('extract_metric_scores', param, n_scores = len(SCORES))}
 
-    #effected by drift
-    for i in range(niter):
-        avg_waveform_per_tp_flip = mf.flip_dim(avg_waveform_per_tp, param)
-        euclid_dist = mf.get_Euclidean_dist(avg_waveform_per_tp_flip, param)
+    #unpack need arrays from the ExtractedWaveProperties dictionary, in the dtype used for the scores
+    dtype = param.get('dtype', 'float64')
+    props = {key : np.asarray(value).astype(dtype, copy = False) for key, value in extracted_wave_properties.items()}
+    avg_waveform_per_tp = props['avg_waveform_per_tp']
+    avg_centroid = props['avg_centroid']
+
+    #the drift correction of each unit, which is added to the positions by the distance functions instead of to the arrays
+    unit_drift = np.zeros((3, param['n_units']), dtype = dtype)
 
-        centroid_dist, centroid_var = mf.centroid_metrics(euclid_dist, param)
+    metric_outputs = {}
+    for i in range(niter):
+        #the metrics NOT effected by the drift correction are only run on the first pass
+        tasks = {}
+        for name, metric in METRICS.items():
+            if i == 0 or metric['drift']:
+                inputs = [mf.apply_unit_drift(props[key], unit_drift) if i > 0 and key in DRIFT_PROPERTIES else props[key] for key in metric['inputs']]
+                tasks[name] = (metric['function'], inputs, metric['cost'])
 
-        euclid_dist_rc = mf.get_recentered_euclidean_dist(avg_waveform_per_tp_flip, avg_centroid, param)
+        if i == 0:
+            tasks['centroid'] = (mf.get_centroid_metrics, [avg_waveform_per_tp, avg_centroid], CENTROID_METRICS_COST)
+        else:
+            #only pairs of units which were moved by different amounts by the drift correction need to be recalculated
+            tasks['centroid'] = (mf.update_centroid_metrics, [avg_waveform_per_tp, avg_centroid, unit_drift, unit_shift, euclid_dist, euclid_dist_var], 
+                                 CENTROID_METRICS_COST)
 
-        centroid_dist_recentered = mf.recentered_metrics(euclid_dist_rc)
-        traj_angle_score, traj_dist_score = mf.dist_angle(avg_waveform_per_tp_flip, param)
+        results = run_metrics(tasks, metric_param)
 
+        for name, result in results.items():
+            if name in METRICS:
+                outputs = METRICS[name]['outputs']
+                metric_outputs.update(zip(outputs, result if len(outputs) > 1 else [result]))
 
-        # Average Euc Dist
-        euclid_dist = np.nanmin(euclid_dist[:,param['peak_loc'] - param['waveidx'] == 0, :,:].squeeze(), axis = 1 )
+        if i == 0:
+            euclid_dist, euclid_dist_var, euclid_dist_rc = results['centroid']
+            metric_outputs['centroid_dist_recentered'] = mf.recentered_scores(euclid_dist_rc, param)
+        else:
+            euclid_dist, euclid_dist_var = results['centroid']
+        metric_outputs['centroid_dist'], metric_outputs['centroid_var'] = mf.centroid_scores(euclid_dist, euclid_dist_var, param)
 
         # TotalScore
-        include_these_pairs = np.argwhere( euclid_dist < param['max_dist']) #array indices of pairs to include
-        include_these_pairs_idx = np.zeros_like(euclid_dist)
-        include_these_pairs_idx[euclid_dist < param['max_dist']] = 1 
-
-        # Make a dictionary of score to include
-        centroid_overlord_score = (centroid_dist_recentered + centroid_var) / 2
-        waveform_score = (wave_corr_score + wave_mse_score) / 2
-        trajectory_score = (traj_angle_score + traj_dist_score) / 2
+        include_these_pairs = euclid_dist < param['max_dist'] #pairs to include
+        n_include_pairs = np.count_nonzero(include_these_pairs)
 
-        scores_to_include = {'amp_score' : amp_score, 'spatial_decay_score' : spatial_decay_score, 'centroid_overlord_score' : centroid_overlord_score,
-                        'centroid_dist' : centroid_dist, 'waveform_score' : waveform_score, 'trajectory_score': trajectory_score }
+        # Make a dictionary of score to include, each score is the mean of its metrics
+        scores_to_include = {}
+        for score, outputs in SCORES.items():
+            scores_to_include[score] = metric_outputs[outputs[0]] if len(outputs) == 1 else sum(metric_outputs[key] for key in outputs) / len(outputs)
 
         total_score, predictors = mf.get_total_score(scores_to_include, param)
 
         #Initial thresholding
         if (i < niter - 1):
             #get the thershold for a match
-            thrs_opt = mf.get_threshold(total_score, within_session, euclid_dist, param, is_first_pass = True)
+            thrs_opt = mf.get_threshold(total_score, session_switch, euclid_dist, param, is_first_pass = True)
 
-            param['n_expected_matches'] = np.sum( (total_score > thrs_opt).astype(int))
-            prior_match = 1 - ( param['n_expected_matches'] / len(include_these_pairs))
+            param['n_expected_matches'] = np.count_nonzero(total_score > thrs_opt)
+            prior_match = 1 - ( param['n_expected_matches'] / n_include_pairs)
             candidate_pairs = total_score > thrs_opt
 
-            drifts, avg_centroid, avg_waveform_per_tp = mf.drift_n_sessions(candidate_pairs, session_switch, avg_centroid, avg_waveform_per_tp, total_score, param)
+            drifts, unit_shift = mf.get_unit_drift(candidate_pairs, session_switch, mf.apply_unit_drift(avg_centroid, unit_drift), total_score, param)
+            unit_drift = unit_drift + unit_shift
 
 
-    thrs_opt = mf.get_threshold(total_score, within_session, euclid_dist, param, is_first_pass = False)
-    param['n_expected_matches'] = np.sum( (total_score > thrs_opt).astype(int))
-    prior_match = 1 - ( param['n_expected_matches'] / len(include_these_pairs))
-    thrs_opt = np.quantile(total_score[include_these_pairs_idx.astype(bool)], prior_match)
+    thrs_opt = mf.get_threshold(total_score, session_switch, euclid_dist, param, is_first_pass = False)
+    param['n_expected_matches'] = np.count_nonzero(total_score > thrs_opt)
+    prior_match = 1 - ( param['n_expected_matches'] / n_include_pairs)
+    thrs_opt = mf.get_quantiles(total_score[include_these_pairs], (prior_match,), param)[0]
     candidate_pairs = total_score > thrs_opt
+    #every pair is scored, see extract_metric_scores_sparse()
+    param['pair_weights'] = None
+
+    #the drift corrected positions are kept in extracted_wave_properties, as used by the GUI and when saving
+    for key in DRIFT_PROPERTIES:
+        extracted_wave_properties[key] += unit_drift.reshape(unit_drift.shape + (1,) * (extracted_wave_properties[key].ndim - 2))
+
+    return total_score, candidate_pairs, scores_to_include, predictors
+
+def extract_metric_scores_sparse(extracted_wave_properties, session_switch, param, niter = 2):
+    """
+    Runs extract_metric_scores() only scoring the candidate pairs, the units with centroids closer than param['candidate_dist'],
+    and a random sample of param['sparse_sample_pairs'] of the other pairs, see mf.get_sample_pairs(). The sampled pairs are 
+    weighted, so the scores are re-scaled, thresholded and the number of expected matches found with the same statistics as 
+    when every pair is scored, these are exact if there are no more than param['sparse_sample_pairs'] other pairs.
+    The outputs are sparse arrays of only the scored pairs, and param['pair_weights'] is set to the weight of each scored pair,
+    so bf.get_parameter_kernels() and bf.apply_naive_bayes() only use the scored pairs. Pairs which are not scored have a 
+    match probability of 0.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    session_switch : ndarray
+        An array which indicates when anew recording session starts
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of pass through the function, 1 mean no drift correction, by default 2
+
+    Returns
+    -------
+    coo_arrays
+        The sparse (n_units, n_units) total scores, candidate pairs and scores to include, and the sparse (n_units**2, n_scores) predictors
+    """
+    dtype = param.get('dtype', 'float64')
+    avg_centroid = np.asarray(extracted_wave_properties['avg_centroid']).astype(dtype, copy = False)
+
+    #the candidate pairs are found before drift correction, which param['candidate_dist'] allows for
+    pairs, weights = mf.get_sample_pairs(mf.get_candidate_pairs(avg_centroid, param), param)
+    pair_weights = np.ones(len(pairs)) if weights is None else weights
+    print(f"Scoring {len(pairs)} of the {param['n_units']**2} pairs of units")
+
+    #the temporary tiles of the metrics are limited so they fit alongside this stage's arrays
+    metric_param = param | {'memory_limit' : util.plan_memory('extract_metric_scores', param, n_scores = len(SCORES), n_pairs = len(pairs))}
+
+    unit_drift = np.zeros((3, param['n_units']), dtype = dtype)
+    metric_outputs = None
+    for i in range(niter):
+        scores_to_include, metric_outputs = get_pair_scores(extracted_wave_properties, pairs, unit_drift, metric_param, metric_outputs, weights)
+        total_score, predictors = mf.get_total_score(scores_to_include, param)
+        euclid_dist = metric_outputs['euclid_dist']
+        thrs_opt = mf.get_threshold(total_score, session_switch, euclid_dist, param | {'pair_weights' : weights}, 
+                                    is_first_pass = i < niter - 1, pairs = pairs)
+
+        if i < niter - 1:
+            drifts, unit_shift = mf.get_unit_drift(total_score > thrs_opt, session_switch, mf.apply_unit_drift(avg_centroid, unit_drift), 
+                                                   total_score, param, pairs = pairs)
+            unit_drift = unit_drift + unit_shift
+
+    include_these_pairs = euclid_dist < param['max_dist']
+    param['n_expected_matches'] = int(round(np.sum(pair_weights[total_score > thrs_opt])))
+    prior_match = 1 - (param['n_expected_matches'] / np.sum(pair_weights[include_these_pairs]))
+    include_param = param | {'pair_weights' : None if weights is None else weights[include_these_pairs]}
+    thrs_opt = mf.get_quantiles(total_score[include_these_pairs], (prior_match,), include_param)[0]
+    candidate_pairs = total_score > thrs_opt
+    param['pair_weights'] = weights
+
+    for key in DRIFT_PROPERTIES:
+        extracted_wave_properties[key] += unit_drift.reshape(unit_drift.shape + (1,) * (extracted_wave_properties[key].ndim - 2))
+
+    scores_to_include = {score : mf.pairs_to_sparse(value, pairs, param) for score, value in scores_to_include.items()}
+    return (mf.pairs_to_sparse(total_score, pairs, param), mf.pairs_to_sparse(candidate_pairs, pairs, param), scores_to_include, 
+            mf.pairs_to_sparse(predictors, pairs, param))
+
+def extract_metric_scores_stage_cached(extracted_wave_properties, session_switch, within_session, param, niter = 2):
+    """
+    Runs extract_metric_scores() using the stage cache in param['stage_cache_dir'].
+    The outputs are saved with a key made from a hash of the extracted wave properties, session_switch, niter, the 
+    registered METRICS and SCORES and the param values in util.STAGE_PARAM_KEYS, so changing only the settings used 
+    after this stage (e.g. param['smooth_prob'] or param['match_threshold']) re-uses the cached scores.
+    As with extract_metric_scores(), param['n_expected_matches'] and param['pair_weights'] are set and the drift corrected 
+    positions are kept in extracted_wave_properties.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    session_switch : ndarray
+        An array which indicates when anew recording session starts
+    within_session : ndarray
+        Not used, the sessions are found from session_switch
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of pass through the function, by default 2
+
+    Returns
+    -------
+    ndarrays
+        The total scores and candidate pairs needed for probability analysis
+    """
+    stage_cache_dir = param['stage_cache_dir']
+    key = util.get_stage_cache_key('extract_metric_scores', [extracted_wave_properties, session_switch, niter, METRICS, SCORES, list(SCORES)], param)
+
+    outputs = util.load_cached_stage(stage_cache_dir, 'extract_metric_scores', key)
+    if outputs is None:
+        stage_param = param | {'stage_cache_dir' : None}
+        total_score, candidate_pairs, scores_to_include, predictors = extract_metric_scores(extracted_wave_properties, session_switch, 
+                                                                                             within_session, stage_param, niter)
+        param['n_expected_matches'] = stage_param['n_expected_matches']
+        param['pair_weights'] = stage_param['pair_weights']
+
+        outputs = {'total_score' : total_score, 'candidate_pairs' : candidate_pairs, 'scores_to_include' : scores_to_include, 
+                   'predictors' : predictors, 'n_expected_matches' : param['n_expected_matches'], 'pair_weights' : param['pair_weights']}
+        outputs.update({name : extracted_wave_properties[name] for name in DRIFT_PROPERTIES})
+        util.save_cached_stage(stage_cache_dir, 'extract_metric_scores', key, outputs)
+        return total_score, candidate_pairs, scores_to_include, predictors
+
+    param['n_expected_matches'] = outputs['n_expected_matches']
+    param['pair_weights'] = outputs['pair_weights']
+    for name in DRIFT_PROPERTIES:
+        extracted_wave_properties[name][...] = outputs[name]
+
+    return outputs['total_score'], outputs['candidate_pairs'], outputs['scores_to_include'], outputs['predictors']
+
+def register_score(name, function, inputs, drift = False, cost = 1, pair_function = None):
+    """
+    Adds a custom score to scores_to_include, which is then used to find matches in the same way as the built in scores.
+    The score is calculated as function(*inputs, param = param) and should return a (n_units, n_units) array of
+    scores between 0 and 1, where the row is the unit in cv 1 and the column the unit in cv 2.
+
+    Parameters
+    ----------
+    name : str
+        The name of the score
+    function : callable
+        The function which calculates the score
+    inputs : list
+        The names of the extracted wave properties the function takes, e.g ['amplitude', 'avg_waveform']
+    drift : bool, optional
+        If True the score is recalculated after drift correction, by default False
+    cost : float, optional
+        The rough time the score takes to calculate relative to the amplitude score, by default 1
+    pair_function : callable, optional
+        The function which calculates the score for a list of pairs, as pair_function(*inputs, pairs, param = param), 
+        needed to use the score with add_session(), by default None
+    """
+    METRICS[name] = {'function' : function, 'inputs' : inputs, 'outputs' : [name], 'drift' : drift, 'cost' : cost}
+    if pair_function is not None:
+        METRICS[name]['pair_function'] = pair_function
+    SCORES[name] = [name]
+
+def run_metrics(tasks, param):
+    """
+    Runs independent metric calculations at the same time on param['n_jobs'] threads, as the numpy functions they
+    use release the GIL. The most costly tasks are started first, and param['memory_limit'] is split between the threads.
+
+    Parameters
+    ----------
+    tasks : dict
+        For each task the (function, inputs, cost), the function is called as function(*inputs, param = param)
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    dict
+        The result of each task
+    """
+    n_threads = max(min(effective_n_jobs(param.get('n_jobs', 1)), len(tasks)), 1)
+    thread_param = param | {'memory_limit' : param.get('memory_limit', 2e9) / n_threads}
+
+    order = sorted(tasks, key = lambda name: tasks[name][2], reverse = True)
+    results = Parallel(n_jobs = n_threads, prefer = 'threads')(
+        delayed(tasks[name][0])(*tasks[name][1], param = thread_param) for name in order)
+
+    return dict(zip(order, results))
+
+def get_location_pair_scores(avg_waveform_per_tp, avg_centroid, pairs, unit_drift, param, drift_only = False):
+    """
+    Calculates the scores which use the location of the units per time point for a list of pairs,
+    re-scaled using only the given pairs.
+    If drift_only is True only the distance at the peak and the centroid distance and variance scores are calculated, as 
+    extract_metric_scores() keeps the re-centered distance and trajectory scores from before drift correction.
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray
+        The average waveform per time point
+    avg_centroid : ndarray
+        The average centroid of each unit
+    pairs : ndarray (n_pairs, 2)
+        The pairs of units to score
+    unit_drift : ndarray (3, n_units)
+        The drift correction of each unit, see mf.get_unit_drift()
+    param : dict
+        The param dictionary
+    drift_only : bool, optional
+        If True only the scores changed by drift correction are calculated, by default False
+
+    Returns
+    -------
+    dict
+        The (n_pairs) arrays of each score, and of the Euclidean distance at the peak
+    """
+    euclid_dist, euclid_dist_var, euclid_dist_rc = mf.get_centroid_metrics_pairs(avg_waveform_per_tp, avg_centroid, pairs, param, unit_drift)
+    centroid_dist, centroid_var = mf.centroid_scores(euclid_dist, euclid_dist_var, param)
+    scores = {'euclid_dist' : euclid_dist, 'centroid_dist' : centroid_dist, 'centroid_var' : centroid_var}
+    if drift_only == True:
+        return scores
+
+    #flipping the x axis does not change the movement between time points, so only the not flipped case is needed
+    traj_angle_score, traj_dist_score = mf.dist_angle_pairs(avg_waveform_per_tp[..., np.newaxis], pairs, param)
+    scores.update({'centroid_dist_recentered' : mf.recentered_scores(euclid_dist_rc, param),
+                   'traj_angle_score' : traj_angle_score,
+                   'traj_dist_score' : traj_dist_score})
+    return scores
+
+def get_pair_scores(extracted_wave_properties, pairs, unit_drift, param, metric_outputs = None, weights = None):
+    """
+    Calculates every score in SCORES for a list of pairs, using the pair_function of each metric in METRICS and
+    get_location_pair_scores(). The scores are re-scaled using only the given pairs, where each pair is counted with 
+    its weight if weights are given, see mf.get_sample_pairs().
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    pairs : ndarray (n_pairs, 2)
+        The pairs of units to score, the first unit uses cv 1 and the second unit cv 2
+    unit_drift : ndarray (3, n_units)
+        The drift correction of each unit, see mf.get_unit_drift()
+    param : dict
+        The param dictionary
+    metric_outputs : dict, optional
+        The metric outputs from a previous call, if given only the metrics effected by drift correction are 
+        recalculated, by default None
+    weights : ndarray, optional
+        The (n_pairs) weight of each pair used when re-scaling the scores, by default None
+
+    Returns
+    -------
+    dict, dict
+        The (n_pairs) array of each score in SCORES, and of each metric output
+    """
+    param = param | {'pair_weights' : weights}
+    dtype = param.get('dtype', 'float64')
+    props = {key : np.asarray(value).astype(dtype, copy = False) for key, value in extracted_wave_properties.items()}
+    first_pass = metric_outputs is None
+    metric_outputs = {} if first_pass else dict(metric_outputs)
+
+    tasks = {}
+    for name, metric in METRICS.items():
+        if (first_pass or metric['drift']) and not metric.get('candidate_pairs', False):
+            if 'pair_function' not in metric:
+                raise ValueError(f"The metric {name} has no pair_function, so can not be calculated for a list of pairs, see register_score()")
+            inputs = [mf.apply_unit_drift(props[key], unit_drift) if key in DRIFT_PROPERTIES else props[key] for key in metric['inputs']]
+            tasks[name] = (metric['pair_function'], inputs + [pairs], metric['cost'])
+    #after drift correction the re-centered distance and trajectory scores are kept, as in update_centroid_metrics()
+    tasks['location'] = (partial(get_location_pair_scores, drift_only = not first_pass), 
+                         [props['avg_waveform_per_tp'], props['avg_centroid'], pairs, unit_drift], CENTROID_METRICS_COST)
+
+    results = run_metrics(tasks, param)
+    for name, result in results.items():
+        if name in METRICS:
+            outputs = METRICS[name]['outputs']
+            metric_outputs.update(zip(outputs, result if len(outputs) > 1 else [result]))
+    metric_outputs.update(results['location'])
+
+    scores_to_include = {}
+    for score, outputs in SCORES.items():
+        scores_to_include[score] = metric_outputs[outputs[0]] if len(outputs) == 1 else sum(metric_outputs[key] for key in outputs) / len(outputs)
+
+    return scores_to_include, metric_outputs
+
+def get_session_subset_probability(extracted_wave_properties, clus_info, sessions, param, niter = 2):
+    """
+    Runs the metrics, drift correction, thresholds, probability distributions and naive Bayes for only the units in a subset
+    of the sessions, as if they were the only sessions given to UnitMatch.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary
+    sessions : ndarray
+        The (sorted) session ids to match
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of pass through extract_metric_scores(), by default 2
+
+    Returns
+    -------
+    ndarray (n_units_in_sessions, n_units_in_sessions)
+        The match probability of each pair of units in the sessions, in the order of the sessions
+    """
+    session_switch = clus_info['session_switch']
+    unit_idxs = np.concatenate([np.arange(session_switch[sid], session_switch[sid + 1]) for sid in sessions])
+    return get_unit_subset_probability(extracted_wave_properties, clus_info, unit_idxs, param, niter = niter)
+
+def get_unit_subset_probability(extracted_wave_properties, clus_info, unit_idxs, param, niter = 2):
+    """
+    Runs the metrics, drift correction, thresholds, probability distributions and naive Bayes for only a subset of the units,
+    as if they were the only units given to UnitMatch. Sessions with no units in the subset are skipped.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary
+    unit_idxs : ndarray
+        The (sorted) indices of the units to match
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of pass through extract_metric_scores(), by default 2
+
+    Returns
+    -------
+    ndarray (n_units_in_subset, n_units_in_subset)
+        The match probability of each pair of units in the subset
+    """
+    __, n_units_per_session = np.unique(clus_info['session_id'][unit_idxs], return_counts = True)
+
+    sub_param = param.copy()
+    sub_param['n_units'], __, sub_session_switch, sub_param['n_sessions'] = util.get_session_data(n_units_per_session)
+    sub_properties = subset_wave_properties(extracted_wave_properties, unit_idxs)
+
+    total_score, candidate_pairs, scores_to_include, predictors = extract_metric_scores(sub_properties, sub_session_switch, None, 
+                                                                                         sub_param, niter = niter)
+
+    n_units = sub_param['n_units']
+    prior_match = 1 - (sub_param['n_expected_matches'] / n_units**2)
+    priors = np.array((prior_match, 1 - prior_match))
+    cond = np.unique(mf.get_pair_values(candidate_pairs)).astype(int)
+
+    parameter_kernels = bf.get_parameter_kernels(scores_to_include, candidate_pairs, cond, sub_param, add_one = 1)
+    probability = bf.apply_naive_bayes(parameter_kernels, priors, predictors, sub_param, cond)
+    return probability[:,1].reshape(n_units, n_units)
+
+def get_partitions(extracted_wave_properties, clus_info, param):
+    """
+    Splits the units into groups which can never match each other, units on different probes (clus_info['probe'], if given)
+    and if param['partition_shanks'] is True units on different shanks, see mf.get_shank_id(). Neighbouring shanks are only
+    split if the gap between the centroids of the units either side of the shank boundary is larger than param['max_dist'].
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary, with an optional 'probe' array giving the probe of each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    list
+        The sorted unit indices in each partition
+    """
+    partition_id = np.zeros(param['n_units'], dtype = int)
+    if clus_info.get('probe') is not None:
+        partition_id = np.unique(np.asarray(clus_info['probe']), return_inverse = True)[1].reshape(-1)
+
+    if param.get('partition_shanks', False):
+        if param['no_shanks'] > 1 and param['shank_dist'] > param['max_dist']:
+            shank_id = mf.get_shank_id(extracted_wave_properties['avg_centroid'], param).astype(int)
+            centroid_x = np.nanmean(extracted_wave_properties['avg_centroid'], axis = 2)[1]
+
+            #neighbouring shanks with units closer than max_dist across the boundary are kept together
+            shank_group = np.zeros(param['no_shanks'], dtype = int)
+            used_shanks = np.unique(shank_id)
+            for left, right in zip(used_shanks[:-1], used_shanks[1:]):
+                gap = np.nanmin(centroid_x[shank_id == right]) - np.nanmax(centroid_x[shank_id == left])
+                shank_group[right:] += gap > param['max_dist']
+
+            partition_id = partition_id * param['no_shanks'] + shank_group[shank_id]
+            if shank_group[-1] == 0:
+                print("Not partitioning by shank, as there are units closer than param['max_dist'] either side of each shank boundary")
+        else:
+            print(f"Not partitioning by shank, as the {param['no_shanks']} shank(s) are not further apart than param['max_dist']")
+
+    return [np.flatnonzero(partition_id == pid) for pid in np.unique(partition_id)]
+
+def get_partitioned_probability(extracted_wave_properties, clus_info, param, niter = 2):
+    """
+    Only scores the pairs of units in the same partition, where units in different partitions can never match each other, 
+    see get_partitions(). The pairs of every partition are scored together, so the threshold and probability distributions
+    are fit once using the pairs of every partition, see get_pair_probability().
+    The probabilities are stitched into the (n_units, n_units) match probability, where pairs of units in different 
+    partitions have a probability of 0. As in extract_metric_scores(), the drift corrected positions are kept in extracted_wave_properties.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary, with an optional 'probe' array giving the probe of each unit
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of passes, 1 means no drift correction, by default 2
+
+    Returns
+    -------
+    ndarray (n_units, n_units)
+        The match probability of each pair of units
+    """
+    partitions = get_partitions(extracted_wave_properties, clus_info, param)
+    print(f'Matching {len(partitions)} partitions of {[len(unit_idxs) for unit_idxs in partitions]} units')
+
+    pairs = np.concatenate([get_block_pairs(unit_idxs, unit_idxs) for unit_idxs in partitions])
+    pair_prob = get_pair_probability(extracted_wave_properties, clus_info['session_switch'], pairs, param, niter = niter)
+
+    probability = np.zeros((param['n_units'], param['n_units']), dtype = pair_prob.dtype)
+    probability[pairs[:,0], pairs[:,1]] = pair_prob
+    return probability
+
+def get_block_pairs(row_idxs, col_idxs):
+    """
+    Makes the list of every pair of units in a block, in the same order as the flattened (n_rows, n_cols) block
+
+    Parameters
+    ----------
+    row_idxs : ndarray
+        The units used as cv 1
+    col_idxs : ndarray
+        The units used as cv 2
+
+    Returns
+    -------
+    ndarray (n_rows * n_cols, 2)
+        The pairs of units
+    """
+    return np.stack(np.meshgrid(row_idxs, col_idxs, indexing = 'ij'), axis = -1).reshape(-1, 2)
+
+def get_pair_probability(extracted_wave_properties, session_switch, pairs, param, niter = 2):
+    """
+    Runs the metrics, drift correction, thresholds, probability distributions and naive Bayes for only a list of pairs of units,
+    in the same way as extract_metric_scores(), bf.get_parameter_kernels() and bf.apply_naive_bayes() do for every pair.
+    The scores of all of the pairs are re-scaled together, and the threshold and probability distributions are fit once using all of the pairs.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters(), the drift corrected positions are kept in it, as in extract_metric_scores()
+    session_switch : ndarray
+        An array which indicates when anew recording session starts
+    pairs : ndarray (n_pairs, 2)
+        The pairs of units to match, which should include each unit paired with itself
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of passes, 1 means no drift correction, by default 2
+
+    Returns
+    -------
+    ndarray (n_pairs)
+        The match probability of each pair
+    """
+    unit_drift = np.zeros((3, param['n_units']), dtype = param.get('dtype', 'float64'))
+    avg_centroid = np.asarray(extracted_wave_properties['avg_centroid']).astype(unit_drift.dtype, copy = False)
+    metric_outputs = None
+    for i in range(niter):
+        print(f'Scoring {len(pairs)} pairs of units, pass {i + 1} of {niter}')
+        scores_to_include, metric_outputs = get_pair_scores(extracted_wave_properties, pairs, unit_drift, param, metric_outputs)
+        total_score, predictors = mf.get_total_score(scores_to_include, param)
+        euclid_dist = metric_outputs['euclid_dist']
+        thrs_opt = mf.get_threshold(total_score, session_switch, euclid_dist, param, is_first_pass = i < niter - 1, pairs = pairs)
+
+        if i < niter - 1:
+            drifts, unit_shift = mf.get_unit_drift(total_score > thrs_opt, session_switch, mf.apply_unit_drift(avg_centroid, unit_drift), 
+                                                   total_score, param, pairs = pairs)
+            unit_drift = unit_drift + unit_shift
+
+    param['n_expected_matches'] = np.count_nonzero(total_score > thrs_opt)
+    include_these_pairs = euclid_dist < param['max_dist']
+    prior_match = 1 - (param['n_expected_matches'] / np.count_nonzero(include_these_pairs))
+    thrs_opt = mf.get_quantiles(total_score[include_these_pairs], (prior_match,), param)[0]
+    candidate_pairs = total_score > thrs_opt
+
+    for key in DRIFT_PROPERTIES:
+        extracted_wave_properties[key] += unit_drift.reshape(unit_drift.shape + (1,) * (extracted_wave_properties[key].ndim - 2))
+
+    #the prior is over every pair of units, as for the full (n_units, n_units) match probability
+    prior_match = 1 - (param['n_expected_matches'] / param['n_units']**2)
+    priors = np.array((prior_match, 1 - prior_match))
+    labels = candidate_pairs.astype(int)
+    cond = np.unique(labels)
+
+    parameter_kernels = bf.get_parameter_kernels(scores_to_include, labels, cond, param, add_one = 1)
+    return bf.apply_naive_bayes(parameter_kernels, priors, predictors[np.newaxis], param, cond)[:,1]
+
+def get_within_session_probability(extracted_wave_properties, clus_info, param):
+    """
+    Runs the metrics, thresholds, probability distributions and naive Bayes only comparing units in the same session. 
+    This is all that is needed to find over-split units, e.g for the UnitMatch Phy plugin, and costs the sum of 
+    n_units_per_session**2 instead of n_units**2. The pairs of every session are scored together, so the threshold 
+    and probability distributions are fit once using the pairs of every session, see get_pair_probability().
+    As only units in the same session are compared there is no drift correction.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    list
+        The (n_units_in_session, n_units_in_session) match probabilities for each session
+    """
+    session_switch = clus_info['session_switch']
+    n_sessions = len(session_switch) - 1
+    print(f'Matching units within each of {n_sessions} sessions')
+
+    session_units = [np.arange(session_switch[sid], session_switch[sid + 1]) for sid in range(n_sessions)]
+    pairs = np.concatenate([get_block_pairs(unit_idxs, unit_idxs) for unit_idxs in session_units])
+    #with only pairs in the same session there is no drift to correct
+    pair_prob = get_pair_probability(extracted_wave_properties, session_switch, pairs, param, niter = 1)
+
+    session_probs = []
+    start = 0
+    for unit_idxs in session_units:
+        session_probs.append(pair_prob[start:start + len(unit_idxs)**2].reshape(len(unit_idxs), len(unit_idxs)))
+        start += len(unit_idxs)**2
+
+    return session_probs
+
+def get_session_windows(n_sessions, param):
+    """
+    Splits the sessions into overlapping windows of param['session_window'] + 1 consecutive sessions, so every pair of
+    sessions at most param['session_window'] sessions apart is in a window. The sessions in param['anchor_sessions'] 
+    are added to every window.
+
+    Parameters
+    ----------
+    n_sessions : int
+        The number of sessions
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    list
+        The sorted session ids in each window
+    """
+    window = param['session_window']
+    anchors = np.asarray(param.get('anchor_sessions', []), dtype = int)
+
+    starts = range(max(n_sessions - window, 1))
+    return [np.union1d(np.arange(start, min(start + window + 1, n_sessions)), anchors) for start in starts]
+
+def get_windowed_probability(extracted_wave_properties, clus_info, param, niter = 2):
+    """
+    Matches only pairs of sessions at most param['session_window'] sessions apart, plus every pair with a session in 
+    param['anchor_sessions'], see get_session_windows(). Only the pairs of units in these pairs of sessions are scored,
+    and the threshold, drift correction and probability distributions are found once using all of them, see get_pair_probability().
+    This makes long chronic recordings feasible, as the cost grows linearly with the number of sessions.
+    As in extract_metric_scores(), the drift corrected positions are kept in extracted_wave_properties.
+
+    Parameters
+    ----------
+    extracted_wave_properties : dict
+        The extracted properties from extract_parameters()
+    clus_info : dict
+        The clus_info dictionary
+    param : dict
+        The param dictionary
+    niter : int, optional
+        The number of passes, 1 means no drift correction, by default 2
+
+    Returns
+    -------
+    dict
+        The block sparse match probabilities, for each matched pair of sessions (sid_1, sid_2) the (n_units_in_sid_1, n_units_in_sid_2)
+        match probabilities, see util.blocks_to_dense()
+    """
+    session_switch = clus_info['session_switch']
+    n_sessions = len(session_switch) - 1
+    windows = get_session_windows(n_sessions, param)
+
+    session_pairs = []
+    for sessions in windows:
+        for sid_1 in sessions.tolist():
+            for sid_2 in sessions.tolist():
+                if (sid_1, sid_2) not in session_pairs:
+                    session_pairs.append((sid_1, sid_2))
+    print(f'Matching {len(session_pairs)} of {n_sessions**2} pairs of sessions')
+
+    session_units = [np.arange(session_switch[sid], session_switch[sid + 1]) for sid in range(n_sessions)]
+    pairs = np.concatenate([get_block_pairs(session_units[sid_1], session_units[sid_2]) for sid_1, sid_2 in session_pairs])
+    pair_prob = get_pair_probability(extracted_wave_properties, session_switch, pairs, param, niter = niter)
+
+    prob_blocks = {}
+    start = 0
+    for sid_1, sid_2 in session_pairs:
+        block_shape = (len(session_units[sid_1]), len(session_units[sid_2]))
+        prob_blocks[(sid_1, sid_2)] = pair_prob[start:start + np.prod(block_shape)].reshape(block_shape)
+        start += np.prod(block_shape)
+
+    return prob_blocks
+
+def save_within_session_prob_for_phy(param, good_units_only = False):
+    """
+    Runs UnitMatch within each session for every KiloSort directory in param['KS_dirs'], and saves the
+    match probabilities as probability_templates.npy in each directory for the UnitMatch Phy plugin.
+    See get_within_session_probability().
+
+    Parameters
+    ----------
+    param : dict
+        The param dictionary, with the list of KiloSort directories in param['KS_dirs']
+    good_units_only : bool, optional
+        If True only units marked as good are matched, the other units are given NaN, by default False
+
+    Returns
+    -------
+    list
+        The (n_units_in_session, n_units_in_session) match probabilities for each session
+    """
+    wave_paths, unit_label_paths, channel_pos = util.paths_from_KS(param['KS_dirs'])
+    param = util.get_probe_geometry(channel_pos[0], param)
+
+    waveform, session_id, session_switch, within_session, good_units, param = util.load_good_waveforms(wave_paths, unit_label_paths, param, 
+                                                                                                         good_units_only = good_units_only)
+    del within_session
+    clus_info = {'good_units' : good_units, 'session_switch' : session_switch, 'session_id' : session_id, 
+                 'original_ids' : np.concatenate(good_units)}
+
+    extracted_wave_properties = extract_parameters(waveform, channel_pos, clus_info, param)
+    del waveform
+
+    session_probs = get_within_session_probability(extracted_wave_properties, clus_info, param)
+    su.save_session_prob_for_phy(session_probs, param, clus_info)
+    return session_probs
+
+def run_unit_match(wave_paths, unit_label_paths, channel_pos, param, run_dir, save_dir, good_units_only = False, resume = True):
+    """
+    Runs all of UnitMatch, from loading the waveforms to saving the output in save_dir. The outputs of each stage in RUN_STAGES
+    (and the param dictionary after it) are saved to run_dir/stage, so if a run is stopped it is resumed from the last 
+    completed stage. The wall time and peak memory of each stage are printed and added to run_dir/run_log.csv.
+    NOTE - when resuming the saved param is used, to change param values use resume = False or param['stage_cache_dir']
+
+    Parameters
+    ----------
+    wave_paths : list
+        A list were each entry is a path to the RawWaveforms directory for each session
+    unit_label_paths : list
+        A list were each entry is a path to the unit labels for each session, see util.load_good_waveforms()
+    channel_pos : list
+        The complete channel positions for each session
+    param : dict
+        The param dictionary
+    run_dir : str
+        The directory to save the outputs of each stage in
+    save_dir : str
+        The directory to save the UnitMatch output in, see su.save_to_output()
+    good_units_only : bool, optional
+        If True will only load units marked as good, by default False
+    resume : bool, optional
+        If True the completed stages saved in run_dir are loaded instead of being run again, by default True
+
+    Returns
+    -------
+    dict
+        The outputs of every stage, including the final param dictionary
+    """
+    os.makedirs(run_dir, exist_ok = True)
+    log_path = os.path.join(run_dir, 'run_log.csv')
+    if os.path.exists(log_path) == False:
+        with open(log_path, 'w') as f:
+            f.write('stage,wall_time_s,peak_memory_bytes\n')
+
+    run = {'wave_paths' : wave_paths, 'unit_label_paths' : unit_label_paths, 'channel_pos' : channel_pos, 'param' : param,
+           'save_dir' : save_dir, 'good_units_only' : good_units_only}
+    for stage in RUN_STAGES:
+        stage_dir = os.path.join(run_dir, stage)
+        #only resume from stages which were completed before the first stage to be run
+        if resume == True and os.path.isdir(stage_dir):
+            run.update(util.load_outputs(stage_dir))
+            print(f'Loaded {stage} from {run_dir}')
+            continue
+        resume = False
+
+        print(f'Running {stage}')
+        util.reset_peak_memory()
+        start = time.perf_counter()
+        outputs = run_stage(stage, run)
+        wall_time = time.perf_counter() - start
+        peak_memory = util.get_peak_memory()
+
+        run.update(outputs)
+        util.save_outputs(stage_dir, outputs | {'param' : run['param']}, overwrite = True)
+        with open(log_path, 'a') as f:
+            f.write(f'{stage},{wall_time:.3f},{peak_memory}\n')
+        memory_info = '' if peak_memory is None else f', peak memory {peak_memory / 1e9:.3g} GB'
+        print(f'Finished {stage} in {wall_time:.1f} s{memory_info}')
+
+    return run
+
+def run_stage(stage, run):
+    """
+    Runs a single stage of run_unit_match()
+
+    Parameters
+    ----------
+    stage : str
+        The stage to run, from RUN_STAGES
+    run : dict
+        The inputs of run_unit_match() and the outputs of the previous stages
+
+    Returns
+    -------
+    dict
+        The outputs of the stage
+    """
+    param = run['param']
+    if stage == 'load_waveforms':
+        param = util.get_probe_geometry(run['channel_pos'][0], param)
+        waveform, session_id, session_switch, within_session, good_units, param = util.load_good_waveforms(run['wave_paths'], run['unit_label_paths'], 
+                                                                                                             param, good_units_only = run['good_units_only'])
+        clus_info = {'good_units' : good_units, 'session_switch' : session_switch, 'session_id' : session_id, 
+                     'original_ids' : np.concatenate(good_units)}
+        return {'wave_paths' : run['wave_paths'], 'unit_label_paths' : run['unit_label_paths'], 'channel_pos' : run['channel_pos'],
+                'waveform' : waveform, 'clus_info' : clus_info, 'param' : param}
+
+    if stage == 'extract_parameters':
+        return {'extracted_wave_properties' : extract_parameters(run['waveform'], run['channel_pos'], run['clus_info'], param)}
+
+    if stage == 'extract_metric_scores':
+        #the drift corrected positions are updated in extracted_wave_properties, so it is saved again
+        extracted_wave_properties = run['extracted_wave_properties']
+        total_score, candidate_pairs, scores_to_include, predictors = extract_metric_scores(extracted_wave_properties, run['clus_info']['session_switch'],
+                                                                                             None, param, niter = 2)
+        return {'total_score' : total_score, 'candidate_pairs' : candidate_pairs, 'scores_to_include' : scores_to_include,
+                'predictors' : predictors, 'extracted_wave_properties' : extracted_wave_properties}
+
+    if stage == 'get_parameter_kernels':
+        prior_match = 1 - (param['n_expected_matches'] / param['n_units']**2)
+        priors = np.array((prior_match, 1 - prior_match))
+        labels = run['candidate_pairs'].astype(int)
+        cond = np.unique(mf.get_pair_values(labels))
+        parameter_kernels = bf.get_parameter_kernels(run['scores_to_include'], labels, cond, param, add_one = 1)
+        return {'parameter_kernels' : parameter_kernels, 'priors' : priors, 'cond' : cond}
+
+    if stage == 'apply_naive_bayes':
+        probability = bf.apply_naive_bayes(run['parameter_kernels'], run['priors'], run['predictors'], param, run['cond'])
+        return {'output_prob_matrix' : probability[:,1].reshape(param['n_units'], param['n_units'])}
+
+    if stage == 'assign_unique_id':
+        return {'UIDs' : aid.assign_unique_id(run['output_prob_matrix'], param, run['clus_info'])}
+
+    if stage == 'save_to_output':
+        output_prob_matrix = run['output_prob_matrix']
+        output_threshold = np.zeros_like(output_prob_matrix)
+        output_threshold[output_prob_matrix > param['match_threshold']] = 1
+        matches = np.argwhere(output_threshold == 1)
+
+        #with param['sparse_scores'] the pairs which were not scored are saved with scores of 0
+        scores_to_include = {score : mf.sparse_to_dense(value, fill_value = 0) for score, value in run['scores_to_include'].items()}
+        total_score = mf.sparse_to_dense(run['total_score'], fill_value = 0)
+        extracted_wave_properties = run['extracted_wave_properties']
+        su.save_to_output(run['save_dir'], scores_to_include, matches, output_prob_matrix, extracted_wave_properties['avg_centroid'], 
+                          extracted_wave_properties['avg_waveform'], extracted_wave_properties['avg_waveform_per_tp'], 
+                          extracted_wave_properties['max_site'], total_score, output_threshold, run['clus_info'], param, UIDs = run['UIDs'])
+        return {'matches' : matches}
+
+    raise ValueError(f'{stage} is not one of the stages in RUN_STAGES')
+
+def load_run(run_dir):
+    """
+    Loads the outputs of every stage of a completed run_unit_match() run
+
+    Parameters
+    ----------
+    run_dir : str
+        The run directory given to run_unit_match()
+
+    Returns
+    -------
+    dict
+        The outputs of every stage, including the final param dictionary
+    """
+    run = {}
+    for stage in RUN_STAGES:
+        stage_dir = os.path.join(run_dir, stage)
+        if os.path.isdir(stage_dir) == False:
+            raise FileNotFoundError(f'{run_dir} does not have a completed {stage} stage, see run_unit_match()')
+        run.update(util.load_outputs(stage_dir))
+    return run
+
+def save_run(run, run_dir):
+    """
+    Saves the outputs of every stage to a run directory, so it can be loaded by load_run() or resumed by run_unit_match()
+
+    Parameters
+    ----------
+    run : dict
+        The outputs of every stage, see run_unit_match()
+    run_dir : str
+        The directory to save the run in
+    """
+    for stage, outputs in RUN_STAGES.items():
+        util.save_outputs(os.path.join(run_dir, stage), {name : run[name] for name in outputs} | {'param' : run['param']}, overwrite = True)
+
+def append_pair_blocks(old_array, pair_values, n_new):
+    """
+    Adds the values for pairs with a new unit, in the order of the pairs in add_session(), to a (n_old_units, n_old_units, ...) array
+
+    Parameters
+    ----------
+    old_array : ndarray (n_old_units, n_old_units, ...)
+        The values for the pairs of existing units
+    pair_values : ndarray (n_pairs, ...)
+        The values for the new units as cv 1 with every unit as cv 2, then the existing units as cv 1 with the new units as cv 2
+    n_new : int
+        The number of new units
+
+    Returns
+    -------
+    ndarray
+        The (n_units, n_units, ...) values for every pair of units
+    """
+    n_old = old_array.shape[0]
+    n_units = n_old + n_new
+    n_new_rows = n_new * n_units
+    extra_shape = pair_values.shape[1:]
+
+    array = np.empty((n_units, n_units) + extra_shape, dtype = np.result_type(old_array, pair_values))
+    array[:n_old, :n_old] = old_array
+    array[n_old:, :] = pair_values[:n_new_rows].reshape((n_new, n_units) + extra_shape)
+    array[:n_old, n_old:] = pair_values[n_new_rows:].reshape((n_old, n_new) + extra_shape)
+    return array
+
+def add_session(run_dir, new_run_dir, wave_path, unit_label_path, channel_pos, save_dir, good_units_only = False, refit_kernels = False, niter = 2):
+    """
+    Adds a new session to a completed run_unit_match() run, without re-running UnitMatch on the existing sessions.
+    The parameters are only extracted for the new session, and only the pairs with a new unit are scored, see get_pair_scores(),
+    so the cost grows with n_new_units * n_units instead of n_units**2. The new session is drift corrected to the last session,
+    and the existing match probabilities and unique ids are kept. The updated run is saved to new_run_dir, so further sessions
+    can be added, and the UnitMatch output to save_dir.
+    NOTE - the new scores are re-scaled using only the new pairs, so will differ slightly from a full run on every session.
+
+    Parameters
+    ----------
+    run_dir : str
+        The run directory of the existing sessions, see run_unit_match()
+    new_run_dir : str
+        The directory to save the run with the new session in
+    wave_path : str
+        The path to the RawWaveforms directory of the new session
+    unit_label_path : str
+        The path to the unit labels of the new session, see util.load_good_waveforms()
+    channel_pos : ndarray
+        The channel positions of the new session
+    save_dir : str
+        The directory to save the UnitMatch output in, see su.save_to_output()
+    good_units_only : bool, optional
+        If True will only load units marked as good, by default False
+    refit_kernels : bool, optional
+        If True the probability distributions are re-fit using the scores of every pair, and the match probabilities 
+        and unique ids of every pair are recalculated, otherwise the existing distributions are used, by default False
+    niter : int, optional
+        The number of passes, 1 means no drift correction, by default 2
+
+    Returns
+    -------
+    dict
+        The outputs of every stage for all of the sessions, as from run_unit_match()
+    """
+    run = load_run(run_dir)
+    param = dict(run['param'])
+    n_old = param['n_units']
+    if param.get('sparse_scores', False):
+        raise ValueError('add_session() needs the scores of every pair, so can not be used with a run with sparse_scores')
+
+    #load and extract the parameters of only the new session
+    waveform, session_id, session_switch, within_session, good_units, new_param = util.load_good_waveforms([wave_path], [unit_label_path], dict(param), 
+                                                                                                             good_units_only = good_units_only)
+    del within_session
+    if new_param['spike_width'] != param['spike_width']:
+        raise ValueError(f"The new session has a spike width of {new_param['spike_width']}, but the existing sessions have {param['spike_width']}")
+    new_clus_info = {'good_units' : good_units, 'session_switch' : session_switch, 'session_id' : session_id, 
+                     'original_ids' : np.concatenate(good_units)}
+    new_properties = extract_parameters(waveform, [channel_pos], new_clus_info, new_param)
+
+    n_new = new_param['n_units']
+    n_units = n_old + n_new
+    new_sid = param['n_sessions']
+    param['n_units'] = n_units
+    param['n_sessions'] = new_sid + 1
+    param['n_units_per_session'] = list(param['n_units_per_session']) + list(new_param['n_units_per_session'])
+
+    old_clus_info = run['clus_info']
+    clus_info = {'good_units' : list(old_clus_info['good_units']) + good_units, 
+                 'session_switch' : np.append(old_clus_info['session_switch'], n_units),
+                 'session_id' : np.append(old_clus_info['session_id'], np.full(n_new, new_sid)),
+                 'original_ids' : np.concatenate((old_clus_info['original_ids'], new_clus_info['original_ids']))}
+    #the existing units are already drift corrected
+    extracted_wave_properties = merge_wave_properties([run['extracted_wave_properties'], new_properties])
+
+    #the new units as cv 1 with every unit as cv 2, then the existing units as cv 1 with the new units as cv 2
+    new_units = np.arange(n_old, n_units)
+    pairs = np.concatenate((np.stack(np.meshgrid(new_units, np.arange(n_units), indexing = 'ij'), axis = -1).reshape(-1, 2),
+                            np.stack(np.meshgrid(np.arange(n_old), new_units, indexing = 'ij'), axis = -1).reshape(-1, 2)))
+    n_new_rows = n_new * n_units
+
+    parameter_kernels, priors, cond = run['parameter_kernels'], run['priors'], run['cond']
+    unit_drift = np.zeros((3, n_units), dtype = param.get('dtype', 'float64'))
+    metric_outputs = None
+    for i in range(niter):
+        print(f'Scoring the pairs with a new unit, pass {i + 1} of {niter}')
+        scores_to_include, metric_outputs = get_pair_scores(extracted_wave_properties, pairs, unit_drift, param, metric_outputs)
+        total_score, predictors = mf.get_total_score(scores_to_include, param)
+        #the new pairs are labelled with the same thresholds as in extract_metric_scores()
+        euclid_dist = metric_outputs['euclid_dist']
+        thrs_opt = mf.get_threshold(total_score, clus_info['session_switch'], euclid_dist, param, is_first_pass = i < niter - 1, pairs = pairs)
+
+        if i < niter - 1:
+            #the drift of the new session is found from its matches with the last session, using the new units as cv 1
+            last_start = old_clus_info['session_switch'][-2]
+            n_last = n_old - last_start
+            sub_score = np.zeros((n_last + n_new, n_last + n_new), dtype = total_score.dtype)
+            sub_score[n_last:, :n_last] = total_score[:n_new_rows].reshape(n_new, n_units)[:, last_start:n_old]
+            sub_candidates = np.zeros(sub_score.shape, dtype = bool)
+            sub_candidates[n_last:, :n_last] = sub_score[n_last:, :n_last] > thrs_opt
+
+            sub_centroid = mf.apply_unit_drift(extracted_wave_properties['avg_centroid'], unit_drift)[:, last_start:]
+            sub_param = param | {'n_sessions' : 2, 'n_units' : n_last + n_new}
+            drifts, sub_drift = mf.get_unit_drift(sub_candidates, np.array([0, n_last, n_last + n_new]), sub_centroid, sub_score, sub_param)
+            unit_drift[:, n_old:] += sub_drift[:, n_last:]
+
+    #the drift corrected positions are kept in extracted_wave_properties, as in extract_metric_scores()
+    for key in DRIFT_PROPERTIES:
+        extracted_wave_properties[key] = mf.apply_unit_drift(extracted_wave_properties[key], unit_drift)
+
+    n_expected_matches = np.count_nonzero(total_score > thrs_opt)
+    include_these_pairs = euclid_dist < param['max_dist']
+    prior_match = 1 - (n_expected_matches / np.count_nonzero(include_these_pairs))
+    thrs_opt = mf.get_quantiles(total_score[include_these_pairs], (prior_match,), param)[0]
+    param['n_expected_matches'] = param['n_expected_matches'] + n_expected_matches
+
+    scores_to_include = {score : append_pair_blocks(run['scores_to_include'][score], value, n_new) for score, value in scores_to_include.items()}
+    candidate_pairs = append_pair_blocks(run['candidate_pairs'], total_score > thrs_opt, n_new)
+    all_predictors = append_pair_blocks(run['predictors'], predictors, n_new)
+    if refit_kernels == True:
+        #every pair is re-scored with the new distributions, so the existing unique ids are re-assigned as well
+        prior_match = 1 - (param['n_expected_matches'] / n_units**2)
+        priors = np.array((prior_match, 1 - prior_match))
+        parameter_kernels = bf.get_parameter_kernels(scores_to_include, candidate_pairs.astype(int), cond, param, add_one = 1)
+        output_prob_matrix = bf.apply_naive_bayes(parameter_kernels, priors, all_predictors, param, cond)[:,1].reshape(n_units, n_units)
+        UIDs = aid.assign_unique_id(output_prob_matrix, param, clus_info)
+    else:
+        probability = bf.apply_naive_bayes(parameter_kernels, priors, predictors[np.newaxis], param, cond)[:,1]
+        output_prob_matrix = append_pair_blocks(run['output_prob_matrix'], probability, n_new)
+        UIDs = aid.append_unique_id(run['UIDs'], output_prob_matrix, n_old, param, clus_info)
 
-    return total_score, candidate_pairs, scores_to_include, predictors 
+    run.update({'wave_paths' : list(run['wave_paths']) + [wave_path], 'unit_label_paths' : list(run['unit_label_paths']) + [unit_label_path],
+                'channel_pos' : list(run['channel_pos']) + [channel_pos], 'waveform' : np.concatenate((run['waveform'], waveform)), 
+                'clus_info' : clus_info, 'extracted_wave_properties' : extracted_wave_properties, 
+                'total_score' : append_pair_blocks(run['total_score'], total_score, n_new), 'candidate_pairs' : candidate_pairs,
+                'scores_to_include' : scores_to_include, 'predictors' : all_predictors, 'parameter_kernels' : parameter_kernels, 
+                'priors' : priors, 'output_prob_matrix' : output_prob_matrix, 'UIDs' : UIDs, 'param' : param, 'save_dir' : save_dir})
+    run.update(run_stage('save_to_output', run))
+    save_run(run, new_run_dir)
+    return run
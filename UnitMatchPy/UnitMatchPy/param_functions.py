@@ -3,7 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.signal import detrend
 import scipy as sp
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 import pandas as pd
 
 def detrend_waveform(waveform):
@@ -78,7 +78,6 @@ def get_max_sites(waveform, channel_pos, clus_info, param):
     """
 
     n_units = param['n_units']
-    n_channels = param['n_channels']
     channel_radius = param['channel_radius']
     waveidx = param['waveidx']
     session_id = clus_info['session_id']
@@ -88,32 +87,72 @@ def get_max_sites(waveform, channel_pos, clus_info, param):
     max_site_mean= get_max_site(spatial_fp) # argument of MaxSite
 
     # Finds the indices where the distance from the max site mean is small
-    good_idx = np.empty((n_units, n_channels))
-    for i in range(channel_pos[0].shape[0]): #looping over each site, assuming all channel_pos, are the same no of channels
-        for j in range(n_units):
-            dist = np.linalg.norm(channel_pos[session_id[j]][max_site_mean[j],:] - channel_pos[session_id[j]][i,:])
-            good = dist < channel_radius
-            good_idx[j,i] = good
-
-    good_pos = np.zeros((n_units, n_channels, 3))
-    for i in range(n_units):
-        #gives the 3-d positions of the channels if they are close to the max site
-        good_pos[i] = channel_pos[session_id[i]] * np.tile(good_idx[i], (3,1)).T
-
-    # waveform_filt, is the waveform, only at 'good' spatial points and a waveidx/good time points
-    waveform_filt = np.zeros_like(waveform)
-    mask = np.zeros_like(waveform)
-    for i in range(n_units):
-        mask[i, waveidx[0]:waveidx[-1], good_idx[i,:].astype(bool),:] = 1 
+    unit_pos = np.stack(channel_pos)[session_id] # assuming all channel_pos, are the same no of channels
+    max_pos = unit_pos[np.arange(n_units), max_site_mean, :]
+    dist = np.linalg.norm(unit_pos - max_pos[:, np.newaxis, :], axis = 2)
+    good_idx = (dist < channel_radius).astype(float)
 
-    waveform_filt = mask * waveform #applying the filter, so only allow good time points/spatial points
+    #gives the 3-d positions of the channels if they are close to the max site
+    good_pos = unit_pos * good_idx[:,:,np.newaxis]
 
-    spatial_fp_filt = get_spatial_fp(waveform_filt)
+    # the spatial footprint, only at 'good' spatial points and a waveidx/good time points
+    spatial_fp_filt = get_spatial_fp(waveform[:, waveidx[0]:waveidx[-1], :, :]) * good_idx[:,:,np.newaxis]
 
     max_site = get_max_site(spatial_fp_filt) #This is the max site of each individual cv
 
     return max_site, good_idx, good_pos, max_site_mean
 
+def get_neighbour_channels(good_idx, channel_pos, clus_info):
+    """
+    This function finds the channels near each unit (the good idx), so the waveform can be cropped to these channels
+    and the cost of the rest of the parameter extraction doesn't depend on the number of channels on the probe.
+
+    Parameters
+    ----------
+    good_idx : ndarray (n_units, n_channels)
+        Marks the channels within channel_radius of each units max site
+    channel_pos : list
+        The channel positions for each session
+    clus_info : dict
+        The clus_info dictionary
+
+    Returns
+    -------
+    ndarrays
+        The neighbour channel indices (n_units, k_neigh) and their positions (n_units, k_neigh, 3).
+        Units with fewer than k_neigh neighbours are padded with other channels, which have a NaN position 
+    """
+    good_idx = good_idx.astype(bool)
+    k_neigh = max(np.max(np.sum(good_idx, axis = 1), initial = 0), 1)
+
+    #the good channels come first, in the same order as in channel_pos
+    neighbour_channels = np.argsort(~good_idx, axis = 1, kind = 'stable')[:, :k_neigh]
+    is_neighbour = np.take_along_axis(good_idx, neighbour_channels, axis = 1)
+
+    unit_pos = np.stack(channel_pos)[clus_info['session_id']]
+    neighbour_pos = np.take_along_axis(unit_pos, neighbour_channels[:,:,np.newaxis], axis = 1).astype(float)
+    neighbour_pos[~is_neighbour,:] = np.nan
+
+    return neighbour_channels, neighbour_pos
+
+def crop_to_neighbours(waveform, neighbour_channels):
+    """
+    Selects only the neighbour channels of each unit from the waveform
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, cv)
+        The waveforms for each unit and cv
+    neighbour_channels : ndarray (n_units, k_neigh)
+        The neighbour channels for each unit
+
+    Returns
+    -------
+    ndarray
+        The waveform on the neighbour channels (n_units, spike_width, k_neigh, cv)
+    """
+    return np.take_along_axis(waveform, neighbour_channels[:, np.newaxis, :, np.newaxis], axis = 2)
+
 def exponential_func(d, p_1, p_2):
     """
     The exponential decay function the waveform is fitted to, to get the decay parameters
@@ -142,19 +181,19 @@ def smooth(array, size = 2):
     out = np.convolve(np.squeeze(array), filt,'same') / np.convolve(tmp, filt ,'same')      
     return out
 
-def decay_and_average_waveform(waveform, channel_pos, good_idx, max_site, max_site_mean, clus_info, param):
+def decay_and_average_waveform(waveform, channel_pos, neighbour_pos, max_site, max_site_mean, clus_info, param):
     """
     This functions, extracts decay parameters of the units, and uses them to create weighted average waveforms 
     for each unit.
 
     Parameters
     ----------
-    waveform : ndarray (n_units, spike_width. n_channels, cv)
-        The waveforms for each unit and cv
+    waveform : ndarray (n_units, spike_width, k_neigh, cv)
+        The waveforms for each unit and cv, on the neighbour channels
     channel_pos : (n_units, 3)
         The spatial position of each unit
-    good_idx : ndarray
-        The good time points for each unit
+    neighbour_pos : ndarray (n_units, k_neigh, 3)
+        The positions of the neighbour channels for each unit, NaN for padding channels
     max_site : ndarray
         The maximum site for each unit
     max_site_mean : ndarray
@@ -171,25 +210,26 @@ def decay_and_average_waveform(waveform, channel_pos, good_idx, max_site, max_si
     """
     n_units = param['n_units']
     spike_width = param['spike_width']
-    n_channels = param['n_channels']
     new_peak_loc = param['peak_loc']
     waveidx = param['waveidx']
     channel_radius = param['channel_radius']
     session_id = clus_info['session_id']
+    dtype = param.get('dtype', 'float64')
 
-    spatial_decay_fit = np.zeros((n_units,2))
-    spatial_decay = np.zeros((n_units,2))
+    spatial_decay_fit = np.zeros((n_units,2), dtype = dtype)
+    spatial_decay = np.zeros((n_units,2), dtype = dtype)
     d_10 = np.zeros((n_units, 2))
-    avg_centroid = np.zeros((3,n_units, 2))
-    avg_waveform = np.zeros((spike_width, n_units, 2))
+    avg_centroid = np.zeros((3,n_units, 2), dtype = dtype)
+    avg_waveform = np.zeros((spike_width, n_units, 2), dtype = dtype)
     peak_time = np.zeros((n_units, 2))
 
     for i in range(n_units):
-        #use the good indices calculated, to get the nearby positions of each unit
-        good_pos = channel_pos[session_id[i]][good_idx[i,:].astype(bool),:]
+        #use the neighbour channels, to get the nearby positions of each unit
+        is_neighbour = ~np.isnan(neighbour_pos[i,:,0])
+        good_pos = neighbour_pos[i,is_neighbour,:]
         for cv in range(2):
             dist_to_max_chan = np.linalg.norm( good_pos - channel_pos[session_id[i]][max_site[i,cv]], axis= 1 )
-            tmp_amp = abs(waveform[i, new_peak_loc, good_idx[i,:].astype(bool), cv])
+            tmp_amp = abs(waveform[i, new_peak_loc, is_neighbour, cv])
 
             # need to remove 0 values, as divide by Dist2MaxChan, and need TmpAmp to be same size
             tmp_amp = tmp_amp[dist_to_max_chan != 0]
@@ -211,19 +251,16 @@ def decay_and_average_waveform(waveform, channel_pos, good_idx, max_site, max_si
             d_10[i,cv] = tmp_min # distance to where the amplitude decay to 10% of its peak
 
             # Find channel sites which are within d_10 of the max site for that unit and cv
-            tmp_idx = np.empty(n_channels)
-            for s in range(n_channels): #looping over each site
-
+            # as d_10 <= channel_radius these are all neighbour channels
 ########################################################################################################
-                #can change to use max site of each cv, or max site of the mean of each cv
-                #dist = np.linalg.norm(ChannelPos[SessionID[i]][MaxSite[i],:] - ChannelPos[SessionID[i]][s,:])
-                dist = np.linalg.norm(channel_pos[session_id[i]][max_site_mean[i],:] - channel_pos[session_id[i]][s,:])
+            #can change to use max site of each cv, or max site of the mean of each cv
+            #dist = np.linalg.norm(ChannelPos[SessionID[i]][MaxSite[i],:] - neighbour_pos[i], axis = 1)
+            dist = np.linalg.norm(channel_pos[session_id[i]][max_site_mean[i],:] - neighbour_pos[i], axis = 1)
 ########################################################################################################
 
-                good = dist < d_10[i,cv]
-                tmp_idx[s] = good
+            tmp_idx = dist < d_10[i,cv]
 
-            loc = channel_pos[session_id[i]][tmp_idx.astype(bool),:]
+            loc = neighbour_pos[i,tmp_idx,:]
 
             #average centroid is the sum of spatial footprint * position / spatial foot print
             spatial_fp = np.max(np.abs(waveform[i,:,tmp_idx.astype(bool),cv]), axis = 1)
@@ -261,8 +298,8 @@ def get_amplitude_shift_waveform(waveform, avg_waveform, peak_time, param):
 
     Parameters
     ----------
-    waveform : ndarray (n_units, spike_width, n_channels, cv)
-        The waveforms for each unit and cv
+    waveform : ndarray (n_units, spike_width, k_neigh, cv)
+        The waveforms for each unit and cv, on the neighbour channels
     avg_waveform : ndarray (n_units, spike_width, cv)
         The weighted average waveform over channels
     peak_time : ndarray
@@ -279,7 +316,7 @@ def get_amplitude_shift_waveform(waveform, avg_waveform, peak_time, param):
     spike_width = param['spike_width']
     new_peak_loc = param['peak_loc']
 
-    amplitude = np.zeros((n_units,2))
+    amplitude = np.zeros((n_units,2), dtype = param.get('dtype', 'float64'))
 
     for i in range(n_units):
         # Shift cv 2 so it has the there is maximum alignment between the 2 waveforms
@@ -327,16 +364,18 @@ def get_amplitude_shift_waveform(waveform, avg_waveform, peak_time, param):
     return amplitude, waveform, avg_waveform
 
 
-def get_avg_waveform_per_tp(waveform, channel_pos, d_10, max_site_mean, amplitude, avg_waveform, clus_info, param):
+def get_avg_waveform_per_tp(waveform, channel_pos, neighbour_pos, d_10, max_site_mean, amplitude, avg_waveform, clus_info, param):
     """
     This function calculates the weighted average waveform per time point, as well as the good time points for each unit
 
     Parameters
     ----------
-    waveform : ndarray (n_units, spike_width. n_channels, cv)
-        The waveforms for each unit and cv
+    waveform : ndarray (n_units, spike_width, k_neigh, cv)
+        The waveforms for each unit and cv, on the neighbour channels
     channel_pos : (n_units, 3)
         The spatial position of each unit
+    neighbour_pos : ndarray (n_units, k_neigh, 3)
+        The positions of the neighbour channels for each unit, NaN for padding channels
     d_10 : ndarray
         The distance at which the signal decays to 10% of the peak
     max_site_mean : ndarray
@@ -357,53 +396,85 @@ def get_avg_waveform_per_tp(waveform, channel_pos, d_10, max_site_mean, amplitud
     """
     n_units = param['n_units']
     spike_width = param['spike_width']
-    n_channels = param['n_channels']
     waveidx = param['waveidx']
     session_id = clus_info['session_id']
+    dtype = param.get('dtype', 'float64')
 
-    good_site_id = np.empty((n_units,n_channels,2))
-    waveform_duration = np.full((n_units,2), np.nan)
-    avg_waveform_per_tp = np.full((3, n_units,spike_width,2), np.nan)
-    good_wave_idxs = np.zeros((n_units, spike_width, 2))
+    #the distance of the neighbour channels to the max site, padding channels have a NaN distance so are never good
+    max_pos = np.stack(channel_pos)[session_id, max_site_mean, :]
+    dist = np.linalg.norm(neighbour_pos - max_pos[:, np.newaxis, :], axis = 2)
+    good_site_id = dist[:,:,np.newaxis] < np.abs(d_10[:,np.newaxis,:]) # (n_units, k_neigh, cv)
+
+    # select time points where the values are above 25% of the amplitude
+    above_thrs = np.abs(np.sign(amplitude) * avg_waveform[waveidx,:,:]) > (np.sign(amplitude) * amplitude * 0.25) # (len(waveidx), n_units, cv)
+    has_active = np.any(above_thrs, axis = 0)
+    first_active = np.argmax(above_thrs, axis = 0)
+    last_active = above_thrs.shape[0] - 1 - np.argmax(above_thrs[::-1], axis = 0)
+
+    waveform_duration = np.where(has_active, last_active - first_active + 1, np.nan)
+    for i, cv in np.argwhere(~has_active):
+        print(f'unit{i} is very likely bad, no good time points in average waveform')
+
+    #the active time points run from the first to the last point above threshold
+    tp = np.arange(spike_width)[np.newaxis,:,np.newaxis]
+    good_wave = (tp >= first_active[:,np.newaxis,:] + waveidx[0]) * (tp <= last_active[:,np.newaxis,:] + waveidx[0]) * has_active[:,np.newaxis,:]
+    good_wave_idxs = good_wave.astype(dtype) # (n_units, spike_width, cv)
+
+    #Projected location per time point, only the time points in waveidx can be active
+    tp_range = slice(waveidx[0], waveidx[-1] + 1)
+    weight = np.where(good_site_id[:,np.newaxis,:,:], np.abs(waveform[:,tp_range,:,:]), 0)
+    loc = np.where(np.isnan(neighbour_pos), 0, neighbour_pos).astype(dtype)
+    projected_loc = np.einsum('itsc,isd->ditc', weight, loc) / np.sum(weight, axis = 2)[np.newaxis]
+
+    avg_waveform_per_tp = np.full((3, n_units, spike_width, 2), np.nan, dtype = dtype)
+    avg_waveform_per_tp[:,:,tp_range,:] = np.where(good_wave[np.newaxis,:,tp_range,:], projected_loc, np.nan)
 
-    for i in range(n_units):   
-        for cv in range(2):
-            #dist = np.linalg.norm(ChannelPos[SessionID[i]][MaxSite[i,cv],:] - ChannelPos[SessionID[i]][:,:], axis = 1)
-            dist = np.linalg.norm(channel_pos[session_id[i]][max_site_mean[i],:] - channel_pos[session_id[i]][:,:], axis = 1)
-
-            test = dist < np.abs(d_10[i,cv])
-            good_site_id[i,:,cv] = test
-            loc = channel_pos[session_id[i]][good_site_id[i,:,cv].astype(bool), :]
-
-            # select time points where the values are above 25% of the amplitude
-            wave_duration_tmp = np.argwhere( np.abs(np.sign(amplitude[i,cv]) * avg_waveform[waveidx,i,cv] )> (np.sign(amplitude[i,cv]) * amplitude[i,cv] * 0.25))
-
-            if wave_duration_tmp.sum != 0:
-                try:
-                    wave_duration_tmp = np.arange(wave_duration_tmp[0],wave_duration_tmp[-1]+1) + waveidx[0]  
-                    wave_duration_tmp = np.expand_dims(wave_duration_tmp, axis = 1)
-                    waveform_duration[i,cv] = len(wave_duration_tmp) 
-                except:
-                    print(f'unit{i} is very likely bad, no good time points in average waveform')  
-                    waveform_duration[i,cv] = np.nan
-
-            else:
-                print(f'problem with active time points (waveform_duration) for unit {i}')
-            
-        #Projected location per time point 
-            for idx in wave_duration_tmp:
-                tmp = np.abs(waveform[i,idx,good_site_id[i,:,cv].astype(bool),cv])
-                tmp = np.expand_dims(tmp, axis = 1)
-                tmp = np.tile(tmp, (1,3))
-                tmp = np.sum(tmp * loc , axis = 0) / np.sum(tmp, axis = 0)
-                avg_waveform_per_tp[:,i,idx,cv] = tmp.reshape((3,1))
-                good_wave_idxs[i,idx,cv] = 1 
-    
     #apply some smoothing the the trajectories
-    for uid in range(n_units):
-        for cv in range(2):
-            for dim in range(avg_waveform_per_tp.shape[0]):
-                avg_waveform_per_tp[dim, uid, good_wave_idxs[uid,:,cv].astype(bool), cv] = gaussian_filter(avg_waveform_per_tp[dim, uid, good_wave_idxs[uid,:,cv].astype(bool), cv], 1, radius = 2, axes = 0)
-        
+    avg_waveform_per_tp = smooth_trajectories(avg_waveform_per_tp, first_active + waveidx[0], waveform_duration)
+
     return waveform_duration, avg_waveform_per_tp, good_wave_idxs
-        
\ No newline at end of file
+
+def smooth_trajectories(avg_waveform_per_tp, start, duration, sigma = 1, radius = 2):
+    """
+    Applies a gaussian filter to the active part of each trajectory, with each trajectory reflected at the
+    edges of its active time points. All of the trajectories are put in one padded array and filtered at once.
+
+    Parameters
+    ----------
+    avg_waveform_per_tp : ndarray (3, n_units, spike_width, cv)
+        The average waveform per time point
+    start : ndarray (n_units, cv)
+        The first active time point for each unit and cv
+    duration : ndarray (n_units, cv)
+        The number of active time points for each unit and cv, NaN if there are none
+    sigma : int, optional
+        The standard deviation of the gaussian kernel, by default 1
+    radius : int, optional
+        The radius of the gaussian kernel, by default 2
+
+    Returns
+    -------
+    ndarray
+        The smoothed average waveform per time point
+    """
+    length = np.nan_to_num(duration).astype(int)
+    if length.max(initial = 0) == 0:
+        return avg_waveform_per_tp
+
+    # index each trajectory from -radius to max_length + radius, reflecting as in scipy's 'reflect' mode
+    pad_idx = np.arange(-radius, length.max() + radius)[np.newaxis,:,np.newaxis]
+    period = 2 * np.maximum(length, 1)[:,np.newaxis,:]
+    pad_idx = np.mod(pad_idx, period)
+    pad_idx = np.where(pad_idx >= period // 2, period - 1 - pad_idx, pad_idx)
+    pad_idx = np.minimum(pad_idx + start[:,np.newaxis,:], avg_waveform_per_tp.shape[2] - 1) # (n_units, padded_length, cv)
+
+    padded = np.take_along_axis(avg_waveform_per_tp, np.broadcast_to(pad_idx, (3,) + pad_idx.shape), axis = 2)
+    padded = gaussian_filter1d(padded, sigma, axis = 2, radius = radius)
+
+    #put the smoothed values back in to the active time points
+    out_idx = np.arange(length.max())[np.newaxis,:,np.newaxis]
+    is_active = out_idx < length[:,np.newaxis,:]
+    unit_idx, tp_idx, cv_idx = np.nonzero(is_active)
+    avg_waveform_per_tp[:, unit_idx, start[unit_idx, cv_idx] + tp_idx, cv_idx] = padded[:, unit_idx, tp_idx + radius, cv_idx]
+
+    return avg_waveform_per_tp
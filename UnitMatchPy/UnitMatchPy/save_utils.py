@@ -431,17 +431,37 @@ def save_prob_for_phy(probability, param, clus_info):
     """
 
     session_switch = clus_info['session_switch']
-    n_units_per_session = param['n_units_per_session']
 
+    session_probs = []
     for sid in range(session_switch.shape[0] - 1):
+        session_probs.append(probability[session_switch[sid]:session_switch[sid+1], session_switch[sid]:session_switch[sid+1]])
+
+    save_session_prob_for_phy(session_probs, param, clus_info)
+
+def save_session_prob_for_phy(session_probs, param, clus_info):
+    """
+    Saves the UnitMatch probabilities for each session in param['KS_dirs'] to be used with the UnitMatch Phy plugin,
+    see overlord.get_within_session_probability() to calculate only these probabilities.
+
+    Parameters
+    ----------
+    session_probs : list
+        The (n_units_in_session, n_units_in_session) probability array for each session
+    param : dictionary
+        The param dictionary
+    clus_info : dictionary
+        The clus_info dictionary
+    """
+    n_units_per_session = param['n_units_per_session']
+
+    for sid, session_output in enumerate(session_probs):
         #file to save the array in
-        save_file_tmp = os.path.join(param['KSdirs'][sid], 'probability_templates.npy')
+        save_file_tmp = os.path.join(param['KS_dirs'][sid], 'probability_templates.npy')
 
         matrix_prob = np.full((n_units_per_session[sid], n_units_per_session[sid]), np.nan) #Make the size of all the units
 
-        session_output = probability[session_switch[sid]:session_switch[sid+1], session_switch[sid]:session_switch[sid+1]]
         #If Only good units where used add values know to a matrix of NaNs 
-        if session_switch[sid+1] - session_switch[sid] != n_units_per_session[sid]:
+        if session_output.shape[0] != n_units_per_session[sid]:
             all_good_units = clus_info['good_units'][sid].squeeze().astype(int)
             for id, gid in enumerate(clus_info['good_units'][sid].astype(int)):
                 matrix_prob[gid, all_good_units] = session_output[id,:]
@@ -2,8 +2,21 @@
 import numpy as np
 import pandas as pd
 import os
+import sys
+import shutil
+import pickle
+import hashlib
 import matplotlib.pyplot as plt
 
+# the param values which change the extracted parameters of a unit
+EXTRACT_PARAM_KEYS = ['spike_width', 'waveidx', 'peak_loc', 'channel_radius', 'dtype']
+
+# the param values which change the outputs of each stage cached in param['stage_cache_dir']
+STAGE_PARAM_KEYS = {'extract_parameters' : EXTRACT_PARAM_KEYS,
+                    'extract_metric_scores' : ['spike_width', 'waveidx', 'peak_loc', 'dtype', 'max_dist', 'neighbour_dist', 'min_angle_dist',
+                                               'bins', 'score_vector', 'sparse_scores', 'candidate_dist', 'sparse_sample_pairs', 'quantile_sketch',
+                                               'no_shanks', 'shank_dist', 'units_per_shank_thrs', 'n_units', 'n_sessions']}
+
 def load_tsv(path):
     """
     Loadsa .tsv file as a numpy array, with the headers removed
@@ -69,9 +82,28 @@ def get_session_data(n_units_per_session):
 
     return n_units, sessionid, session_switch, n_sessions
 
+def get_session_blocks(session_switch):
+    """
+    Gives the slice of the units in each session, so same session (diagonal block) pairs can be found from 
+    session_switch without making a (n_units, n_units) array
+
+    Parameters
+    ----------
+    session_switch : ndarray
+        A array which marks at which units the a new session starts
+
+    Returns
+    -------
+    list
+        The slice of units for each session
+    """
+    return [slice(session_switch[i], session_switch[i + 1]) for i in range(len(session_switch) - 1)]
+
 def get_within_session(session_id, param):
     """
-    Creates an array with 1 if the units are in the same session and a 0 otherwise
+    Creates an array with 1 (True) if the units are in different sessions and a 0 (False) otherwise.
+    UnitMatch only needs session_switch, see get_session_blocks(), this array is for selecting between session pairs
+    e.g output_threshold * within_session
 
     Parameters
     ----------
@@ -83,17 +115,34 @@ def get_within_session(session_id, param):
     Returns
     -------
     ndarray
-        A n_unit * n_unit array which marks units in the same session
+        A n_unit * n_unit bool array which marks units in different sessions
     """
-    n_units = param['n_units']
+    within_session = np.expand_dims(session_id , axis=1) != np.expand_dims(session_id, axis=0)
 
-    tmp1 = np.expand_dims(session_id , axis=1)
-    tmp2 = np.expand_dims(session_id, axis=0)
+    return within_session
 
-    within_session = np.ones((n_units, n_units))
-    within_session[tmp1 == tmp2] = 0
+def blocks_to_dense(blocks, session_switch, fill_value = np.nan):
+    """
+    Converts block sparse (session pair) arrays, e.g from overlord.get_windowed_probability(), to one (n_units, n_units) array
 
-    return within_session
+    Parameters
+    ----------
+    blocks : dict
+        For each pair of sessions (sid_1, sid_2) the (n_units_in_sid_1, n_units_in_sid_2) array
+    session_switch : ndarray
+        A array which marks at which units the a new session starts
+    fill_value : float, optional
+        The value given to pairs of sessions without a block, by default np.nan
+
+    Returns
+    -------
+    ndarray (n_units, n_units)
+        The dense array
+    """
+    dense = np.full((session_switch[-1], session_switch[-1]), fill_value)
+    for (sid_1, sid_2), block in blocks.items():
+        dense[session_switch[sid_1]:session_switch[sid_1 + 1], session_switch[sid_2]:session_switch[sid_2 + 1]] = block
+    return dense
 
 def load_good_waveforms(wave_paths, unit_label_paths, param, good_units_only = True):
     """
@@ -148,7 +197,7 @@ def load_good_waveforms(wave_paths, unit_label_paths, param, good_units_only = T
             #load in the first good unit, to get the shape of each waveform
             p_file = os.path.join(wave_paths[ls],f'Unit{int(good_units[ls][0].squeeze())}_RawSpikes.npy')
             tmp = np.load(p_file)
-            tmp_waveform = np.zeros( (len(good_units[ls]), tmp.shape[0], tmp.shape[1], tmp.shape[2]))
+            tmp_waveform = np.zeros( (len(good_units[ls]), tmp.shape[0], tmp.shape[1], tmp.shape[2]), dtype = param.get('dtype', 'float64'))
 
             for i in range(len(good_units[ls])):
                 #loads in all GoodUnits for that session
@@ -165,7 +214,7 @@ def load_good_waveforms(wave_paths, unit_label_paths, param, good_units_only = T
             #load in the first good unit, to get the shape of each waveform
             p_file = os.path.join(wave_paths[ls],f'Unit{int(all_units[ls][0])}_RawSpikes.npy')
             tmp = np.load(p_file)
-            tmp_waveform = np.zeros( (len(os.listdir(wave_paths[ls])), tmp.shape[0], tmp.shape[1], tmp.shape[2]))
+            tmp_waveform = np.zeros( (len(os.listdir(wave_paths[ls])), tmp.shape[0], tmp.shape[1], tmp.shape[2]), dtype = param.get('dtype', 'float64'))
 
             for i in range(len(os.listdir(wave_paths[ls]))):
                 #loads in all GoodUnits for that session
@@ -274,7 +323,7 @@ def load_good_units(good_units, wave_paths, param):
         #load in the first good unit, to get the shape of each waveform
         tmp_path = os.path.join(wave_paths[ls], f'Unit{int(good_units[ls][0].squeeze())}_RawSpikes.npy')
         tmp = np.load(tmp_path)
-        tmp_waveform = np.zeros( (len(good_units[ls]), tmp.shape[0], tmp.shape[1], tmp.shape[2]))
+        tmp_waveform = np.zeros( (len(good_units[ls]), tmp.shape[0], tmp.shape[1], tmp.shape[2]), dtype = param.get('dtype', 'float64'))
 
         for i in range(len(good_units[ls])):
             #loads in all GoodUnits for that session
@@ -318,27 +367,26 @@ def evaluate_output(output_prob, param, within_session, session_switch, match_th
     param : dict
         The param dictionary
     within_session : ndarray
-        The array which marks units pairs in the same session
+        Not used, the sessions are found from session_switch
     session_switch : ndarray
         The array which marks when a new session starts
     match_threshold : float, optional
         The threshold value which decides matches, by default 0.5
     """
 
-    output_threshold = np.zeros_like(output_prob)
-    output_threshold[output_prob > match_threshold] = 1
+    output_threshold = output_prob > match_threshold
 
     # get the number of diagonal matches
-    n_diag = np.sum(output_threshold[np.eye(param['n_units']).astype(bool)])
+    n_diag = np.sum(np.diag(output_threshold))
     self_match = n_diag / param['n_units'] *100
     print(f'The percentage of units matched to themselves is: {self_match}%')
     print(f'The percentage of false -ve\'s then is: {100 - self_match}% \n')
 
-    #off-diagonal miss-matches
-    n_off_diag = np.zeros_like(output_prob)
-    n_off_diag = output_threshold
-    n_off_diag[within_session == 1] = 0 
-    n_off_diag[np.eye(param['n_units']) == 1] = 0 
+    #off-diagonal miss-matches in each session
+    n_off_diag = np.zeros(param['n_sessions'])
+    for did, session in enumerate(get_session_blocks(session_switch)):
+        tmp_diag = output_threshold[session, session]
+        n_off_diag[did] = tmp_diag.sum() - np.sum(np.diag(tmp_diag))
     false_positive_est =  n_off_diag.sum() / (param['n_units']) 
     print(f'The rate of miss-match(es) per expected match {false_positive_est}')
 
@@ -346,10 +394,8 @@ def evaluate_output(output_prob, param, within_session, session_switch, match_th
     #compute matlab FP per session per session
     false_positive_est_per_session = np.zeros(param['n_sessions'])
     for did in range(param['n_sessions']):
-        tmp_diag = output_threshold[session_switch[did]:session_switch[did + 1], session_switch[did]:session_switch[did + 1]]
-        n_units = tmp_diag.shape[0]
-        tmp_diag[np.eye(n_units) == 1] = 0 
-        false_positive_est_per_session[did] = tmp_diag.sum() / (n_units ** 2 - n_units) * 100
+        n_units = session_switch[did + 1] - session_switch[did]
+        false_positive_est_per_session[did] = n_off_diag[did] / (n_units ** 2 - n_units) * 100
         print(f'The percentage of false +ve\'s is {false_positive_est_per_session[did]}% for session {did +1}')
 
     print('\nThis assumes that the spike sorter has made no mistakes')
@@ -618,7 +664,7 @@ def get_probe_geometry(channel_pos, param, verbose = False):
     Parameters
     ----------
     channel_pos : ndarray
-        The channel positions of a session 
+        The channel positions of a session, either the (x, y) positions or the 3 column positions from paths_from_KS()
     param : dict
         The param dict
     verbose : bool, optional
@@ -629,6 +675,10 @@ def get_probe_geometry(channel_pos, param, verbose = False):
     param
         The param dictionary updated with the calculated params
     """
+    #the first column of the paths_from_KS() positions is a constant, the x and y positions follow
+    if channel_pos.shape[1] == 3:
+        channel_pos = channel_pos[:, 1:]
+
     min_new_shank_distance = param['min_new_shank_distance']
     x_val = np.unique(channel_pos[:,0])
     x_val = np.sort(x_val) #make sure they are in ascending order 
@@ -653,4 +703,417 @@ def get_probe_geometry(channel_pos, param, verbose = False):
     param['shank_dist'] = shank_dist
     if verbose == True:
         print(f'We have found {n_shanks} with spacing ~ {shank_spacing}')
-    return param
\ No newline at end of file
+    return param
+
+def get_cache_dirs(wave_paths):
+    """
+    Gives a directory next to each RawWaveforms directory, to use as param['cache_dirs'] 
+    to cache the extracted parameters of each unit
+
+    Parameters
+    ----------
+    wave_paths : list
+        A list were each entry is a path to the RawWaveforms directory for each session
+
+    Returns
+    -------
+    list
+        The path to the cache directory for each session
+    """
+    cache_dirs = []
+    for wave_path in wave_paths:
+        cache_dirs.append(os.path.join(os.path.dirname(os.path.normpath(wave_path)), 'UnitMatchCache'))
+    return cache_dirs
+
+def get_unit_cache_keys(waveform, channel_pos, session_id, param):
+    """
+    Creates a key for each unit, which is a hash of the units raw waveform, the channel positions
+    of its session and the param values used when extracting parameters
+
+    Parameters
+    ----------
+    waveform : ndarray (n_units, spike_width, n_channels, 2)
+        The raw average waveforms
+    channel_pos : list
+        The channel positions for each session
+    session_id : ndarray
+        The session id for each unit
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    list
+        The hash for each unit
+    """
+    param_hash = hashlib.sha1()
+    for key in EXTRACT_PARAM_KEYS:
+        param_hash.update(key.encode())
+        param_hash.update(np.asarray(param[key]).tobytes())
+
+    session_hashes = []
+    for pos in channel_pos:
+        session_hash = param_hash.copy()
+        session_hash.update(np.ascontiguousarray(pos, dtype = np.float64).tobytes())
+        session_hashes.append(session_hash)
+
+    keys = []
+    for i in range(waveform.shape[0]):
+        unit_hash = session_hashes[session_id[i]].copy()
+        unit_hash.update(np.ascontiguousarray(waveform[i]).tobytes())
+        keys.append(unit_hash.hexdigest())
+    return keys
+
+def load_cached_unit(cache_dir, key):
+    """
+    Loads the cached extracted parameters for a single unit
+
+    Parameters
+    ----------
+    cache_dir : str
+        The path to the cache directory
+    key : str
+        The units hash, from get_unit_cache_keys()
+
+    Returns
+    -------
+    dict
+        The extracted wave properties of the unit, None if the unit is not in the cache
+    """
+    path = os.path.join(cache_dir, f'{key}.npz')
+    if os.path.exists(path) == False:
+        return None
+    with np.load(path) as f:
+        return dict(f)
+
+def save_cached_unit(cache_dir, key, unit_properties):
+    """
+    Saves the extracted parameters for a single unit to the cache
+
+    Parameters
+    ----------
+    cache_dir : str
+        The path to the cache directory
+    key : str
+        The units hash, from get_unit_cache_keys()
+    unit_properties : dict
+        The extracted wave properties of the unit
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    #write to a temporary file first, so an interrupted run can't leave a broken file in the cache
+    tmp_path = os.path.join(cache_dir, f'{key}.tmp.npz')
+    np.savez(tmp_path, **unit_properties)
+    os.replace(tmp_path, os.path.join(cache_dir, f'{key}.npz'))
+
+def update_hash(value_hash, value):
+    """
+    Adds a value to a hash, going into dictionaries (in key order), lists and tuples. Functions are added by name.
+
+    Parameters
+    ----------
+    value_hash : hashlib hash
+        The hash to update
+    value : any
+        The value to add to the hash
+    """
+    if isinstance(value, dict):
+        value_hash.update(f'dict{len(value)}'.encode())
+        for key, item in sorted(value.items(), key = lambda item: str(item[0])):
+            update_hash(value_hash, key)
+            update_hash(value_hash, item)
+    elif isinstance(value, (list, tuple)):
+        value_hash.update(f'list{len(value)}'.encode())
+        for item in value:
+            update_hash(value_hash, item)
+    elif value is None or isinstance(value, str):
+        value_hash.update(repr(value).encode())
+    elif callable(value):
+        value_hash.update(f'{value.__module__}.{value.__qualname__}'.encode())
+    else:
+        value = np.ascontiguousarray(value)
+        if value.dtype == object:
+            update_hash(value_hash, value.tolist())
+        else:
+            value_hash.update(f'{value.dtype.str}{value.shape}'.encode())
+            value_hash.update(value)
+
+def get_stage_cache_key(stage, inputs, param):
+    """
+    Creates a key for the outputs of a stage of UnitMatch, which is a hash of the stage's inputs
+    and the param values in STAGE_PARAM_KEYS[stage]
+
+    Parameters
+    ----------
+    stage : str
+        'extract_parameters' or 'extract_metric_scores'
+    inputs : list
+        The arrays (or dictionaries/lists of arrays) given to the stage
+    param : dict
+        The param dictionary
+
+    Returns
+    -------
+    str
+        The hash of the stage
+    """
+    stage_hash = hashlib.sha1(stage.encode())
+    update_hash(stage_hash, inputs)
+    for key in STAGE_PARAM_KEYS[stage]:
+        update_hash(stage_hash, key)
+        update_hash(stage_hash, param.get(key))
+    return stage_hash.hexdigest()
+
+def load_cached_stage(stage_cache_dir, stage, key):
+    """
+    Loads the cached outputs of a stage of UnitMatch, see load_outputs()
+
+    Parameters
+    ----------
+    stage_cache_dir : str
+        The path to the stage cache directory, param['stage_cache_dir']
+    stage : str
+        'extract_parameters' or 'extract_metric_scores'
+    key : str
+        The stage's hash, from get_stage_cache_key()
+
+    Returns
+    -------
+    dict
+        The outputs of the stage, None if the stage is not in the cache
+    """
+    path = os.path.join(stage_cache_dir, stage, key)
+    if os.path.isdir(path) == False:
+        return None
+    print(f'Loaded {stage} from the cache')
+    return load_outputs(path)
+
+def save_cached_stage(stage_cache_dir, stage, key, outputs):
+    """
+    Saves the outputs of a stage of UnitMatch to the cache, see save_outputs()
+
+    Parameters
+    ----------
+    stage_cache_dir : str
+        The path to the stage cache directory, param['stage_cache_dir']
+    stage : str
+        'extract_parameters' or 'extract_metric_scores'
+    key : str
+        The stage's hash, from get_stage_cache_key()
+    outputs : dict
+        The outputs to save
+    """
+    save_outputs(os.path.join(stage_cache_dir, stage, key), outputs)
+
+def save_outputs(path, outputs, overwrite = False):
+    """
+    Saves a dictionary of outputs to a directory. Each numeric array, including arrays in nested dictionaries, is saved
+    as its own .npy file so it can be memory mapped when loaded, everything else is saved in outputs.pickle
+
+    Parameters
+    ----------
+    path : str
+        The directory to save the outputs in
+    outputs : dict
+        The outputs to save
+    overwrite : bool, optional
+        If True replaces outputs already saved in path, otherwise they are kept, by default False
+    """
+    #write to a temporary directory first, so an interrupted run can't leave broken outputs
+    tmp_path = f'{os.path.normpath(path)}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors = True)
+    os.makedirs(tmp_path)
+
+    #the arrays are replaced by None in the saved outputs, and put back from their .npy file when loading
+    skeleton = {}
+    arrays = []
+    stack = [(outputs, skeleton, ())]
+    while len(stack) > 0:
+        values, target, key_path = stack.pop()
+        for key, value in values.items():
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                file = f"{'.'.join(str(k) for k in key_path + (key,))}.npy"
+                np.save(os.path.join(tmp_path, file), value)
+                arrays.append((file, key_path + (key,)))
+                target[key] = None
+            elif isinstance(value, dict):
+                target[key] = {}
+                stack.append((value, target[key], key_path + (key,)))
+            else:
+                target[key] = value
+
+    with open(os.path.join(tmp_path, 'outputs.pickle'), 'wb') as fp:
+        pickle.dump({'outputs' : skeleton, 'arrays' : arrays}, fp)
+
+    if overwrite == True:
+        shutil.rmtree(path, ignore_errors = True)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        #the outputs have already been saved, e.g. by another run
+        shutil.rmtree(tmp_path, ignore_errors = True)
+
+def load_outputs(path):
+    """
+    Loads outputs saved by save_outputs(), the arrays are memory mapped copy-on-write
+    so only the parts which are used are read and changing them does not change the saved files
+
+    Parameters
+    ----------
+    path : str
+        The directory the outputs were saved in
+
+    Returns
+    -------
+    dict
+        The saved outputs
+    """
+    with open(os.path.join(path, 'outputs.pickle'), 'rb') as fp:
+        saved = pickle.load(fp)
+
+    outputs = saved['outputs']
+    for file, key_path in saved['arrays']:
+        target = outputs
+        for key in key_path[:-1]:
+            target = target[key]
+        target[key_path[-1]] = np.load(os.path.join(path, file), mmap_mode = 'c')
+    return outputs
+
+def reset_peak_memory():
+    """
+    Resets the peak resident memory of this process, so get_peak_memory() gives the peak from now on.
+    This is only possible on Linux, on other systems the peak is since the process started.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_memory():
+    """
+    Finds the peak resident memory of this process, since reset_peak_memory() was last called on Linux.
+    Worker processes, e.g. from param['n_jobs'], are not included.
+
+    Returns
+    -------
+    int
+        The peak memory in bytes, None if it can not be found on this system
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    #ru_maxrss is in kB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def get_system_memory():
+    """
+    Finds the total physical memory of the machine
+
+    Returns
+    -------
+    int
+        The memory in bytes, None if it can not be found on this system
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_memory(param, n_channels = None, n_scores = 6, n_pairs = None):
+    """
+    Estimates the peak memory of each stage of UnitMatch, not including the temporary tiles
+    which are limited by param['memory_limit']. These are rough estimates of the largest arrays made.
+
+    Parameters
+    ----------
+    param : dict
+        The param dictionary
+    n_channels : int, optional
+        The number of channels in the raw waveforms, by default param['n_channels']
+    n_scores : int, optional
+        The number of scores used in scores_to_include, by default 6
+    n_pairs : int, optional
+        The number of pairs of units which are scored, by default n_units**2
+
+    Returns
+    -------
+    dict
+        The estimated peak memory in bytes for 'extract_parameters', 'extract_metric_scores' and 'apply_naive_bayes'
+    """
+    n_units = param['n_units']
+    if n_pairs is None:
+        n_pairs = n_units**2
+    itemsize = np.dtype(param.get('dtype', 'float64')).itemsize
+    spike_width = param['spike_width']
+    if n_channels is None:
+        n_channels = param['n_channels']
+
+    waveform = n_units * spike_width * n_channels * 2 * itemsize
+    # the average waveform (per time point) and the other per unit properties
+    per_unit = 10 * n_units * spike_width * 2 * itemsize
+
+    memory = {}
+    # the de-trended waveforms, the working copies made while de-trending and the cropped waveforms
+    memory['extract_parameters'] = 4 * waveform + per_unit
+    # around 24 (n_units, n_units) arrays of metrics, distances, scores and threshold copies, the predictors and the threshold histogram key
+    memory['extract_metric_scores'] = per_unit + (24 + n_scores) * n_pairs * itemsize + n_pairs * 8
+    # the predictors, the score bin of each predictor, the likelihood of each predictor and the likelihood and probabilities
+    memory['apply_naive_bayes'] = n_pairs * n_scores * (2 * itemsize + 8) + 4 * n_pairs * itemsize
+    return memory
+
+def plan_memory(stage, param, n_channels = None, n_scores = 6, n_pairs = None):
+    """
+    Checks a stage of UnitMatch will fit in param['max_memory'] bytes, which is the machine's memory if it is None.
+    If the memory left after the stage's arrays, see estimate_memory(), is less than param['memory_limit'] then 
+    a lower limit is returned for the stage's temporary tiles, param is not changed. Raises a MemoryError before any 
+    large arrays are made if the stage can not fit.
+
+    Parameters
+    ----------
+    stage : str
+        'extract_parameters', 'extract_metric_scores' or 'apply_naive_bayes'
+    param : dict
+        The param dictionary
+    n_channels : int, optional
+        The number of channels in the raw waveforms, by default param['n_channels']
+    n_scores : int, optional
+        The number of scores used in scores_to_include, by default 6
+    n_pairs : int, optional
+        The number of pairs of units which are scored, by default n_units**2
+
+    Returns
+    -------
+    float
+        The max size in bytes of the temporary tiles for this stage, to use instead of param['memory_limit']
+    """
+    memory_limit = param.get('memory_limit', 2e9)
+    max_memory = param.get('max_memory')
+    if max_memory is None:
+        max_memory = get_system_memory()
+        if max_memory is None:
+            return memory_limit
+
+    needed = estimate_memory(param, n_channels, n_scores, n_pairs)[stage]
+    # leave room for reasonably sized tiles
+    min_tile_memory = 64 * 2**20
+    if needed + min_tile_memory > max_memory:
+        hints = {'extract_parameters' : "extract the parameters for fewer units at a time, e.g using param['cache_dirs']",
+                 'extract_metric_scores' : "use param['dtype'] = 'float32' or match fewer units/sessions at a time",
+                 'apply_naive_bayes' : "use param['dtype'] = 'float32' or match fewer units/sessions at a time"}
+        raise MemoryError(f"{stage} needs around {needed / 1e9:.3g} GB for {param['n_units']} units plus room for temporary arrays, "
+                          f"which is more than the {max_memory / 1e9:.3g} GB available, see param['max_memory']. To fix this {hints[stage]}.")
+
+    # the parameters are extracted per unit, so do not use param['memory_limit']
+    if stage != 'extract_parameters' and max_memory - needed < memory_limit:
+        memory_limit = max_memory - needed
+        print(f"Using a memory_limit of {memory_limit / 1e9:.3g} GB so {stage} fits in {max_memory / 1e9:.3g} GB")
+    return memory_limit
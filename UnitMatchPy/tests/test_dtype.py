@@ -0,0 +1,71 @@
+import os
+import numpy as np
+
+import UnitMatchPy.overlord as ov
+import UnitMatchPy.default_params as default_params
+
+
+def make_sessions(root, n_units = 30, n_shared = 25, n_channels = 96, spike_width = 82, seed = 0):
+    """
+    Saves a deterministic synthetic two session recording in the KiloSort layout used by run_unit_match(),
+    where n_shared units are found in both sessions and the second session has drifted 20um along the probe.
+    """
+    rng = np.random.default_rng(seed)
+    #Neuropixels 1.0 like layout, 4 columns with 20um between rows
+    x_pos = np.array([11, 27, 43, 59])
+    pos = np.array([[x_pos[i % 4], 20 * (i // 2)] for i in range(n_channels)], dtype = float)
+    channel_pos = np.insert(pos, 0, np.ones(n_channels), axis = 1)
+
+    n_true = 2 * n_units - n_shared
+    locs = np.stack((rng.uniform(10, 60, n_true), rng.uniform(40, 10 * n_channels - 40, n_true)), axis = 1)
+    amps = rng.uniform(50, 200, n_true)
+    widths = rng.uniform(15, 35, n_true)
+    sigma = rng.uniform(1.5, 4, n_true)
+    repol = rng.uniform(0.1, 0.8, n_true)
+    lag = rng.uniform(4, 14, n_true)
+    time = np.arange(spike_width)
+
+    session_units = [np.arange(n_units), np.arange(n_units - n_shared, n_true)]
+    wave_paths, unit_label_paths = [], []
+    for sid, units in enumerate(session_units):
+        wave_path = os.path.join(root, f'session_{sid}', 'RawWaveforms')
+        os.makedirs(wave_path)
+        for i, unit in enumerate(units):
+            dist = np.linalg.norm(pos - (locs[unit] + np.array((0, 20 * sid))), axis = 1)
+            footprint = amps[unit] * np.exp(-dist / widths[unit])
+            #the spike arrives later further from the soma, giving a trajectory
+            tt = time[:, np.newaxis] - (pos[:, 1] - locs[unit, 1]) / 60
+            waveform = np.zeros((spike_width, n_channels, 2))
+            for cv in range(2):
+                peak = 41 + rng.integers(-2, 3)
+                shape = -np.exp(-0.5 * ((tt - peak) / sigma[unit])**2) + repol[unit] * np.exp(-0.5 * ((tt - peak - lag[unit]) / 5)**2)
+                waveform[:, :, cv] = shape * footprint + rng.normal(0, 2, (spike_width, n_channels))
+            np.save(os.path.join(wave_path, f'Unit{i}_RawSpikes.npy'), waveform)
+
+        unit_label_path = os.path.join(root, f'session_{sid}', 'cluster_group.tsv')
+        with open(unit_label_path, 'w') as f:
+            f.write('cluster_id\tgroup\n' + ''.join(f'{i}\tgood\n' for i in range(len(units))))
+        wave_paths.append(wave_path)
+        unit_label_paths.append(unit_label_path)
+
+    return wave_paths, unit_label_paths, [channel_pos, channel_pos]
+
+
+def run_with_dtype(sessions, run_dir, dtype):
+    param = default_params.get_default_param()
+    param['dtype'] = dtype
+    return ov.run_unit_match(*sessions, param, str(run_dir), str(run_dir / 'output'))
+
+
+def test_float32_gives_the_same_matches(tmp_path):
+    sessions = make_sessions(tmp_path / 'data')
+    run_64 = run_with_dtype(sessions, tmp_path / 'run_64', 'float64')
+    run_32 = run_with_dtype(sessions, tmp_path / 'run_32', 'float32')
+
+    assert run_32['output_prob_matrix'].dtype == np.float32
+    match_threshold = run_64['param']['match_threshold']
+    assert np.array_equal(run_64['output_prob_matrix'] > match_threshold, run_32['output_prob_matrix'] > match_threshold)
+    #the synthetic units found in both sessions should be matched
+    assert np.sum(run_64['output_prob_matrix'] > match_threshold) > 2 * 25
+    for uid_64, uid_32 in zip(run_64['UIDs'], run_32['UIDs']):
+        assert np.array_equal(uid_64, uid_32)